@@ -1,5 +1,9 @@
 from django.contrib import admin
-from acra.models import CrashReport
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.utils.html import format_html
+from acra.models import CrashReport, CrashGroup
 
 
 def statusUpdate(self, request, queryset):
@@ -14,6 +18,15 @@ def statusUpdate(self, request, queryset):
 statusUpdate.short_description = "Mark selected report(s) as solved"
 
 
+class CrashReportChangeList(ChangeList):
+
+    def get_queryset(self, request):
+        # the text columns, compressed or not, are most of the table; only load the ones the list shows
+        return super(CrashReportChangeList, self).get_queryset(request).defer(
+            *[field.name for field in CrashReport._meta.concrete_fields
+              if isinstance(field, models.TextField) and field.name not in self.list_display])
+
+
 class CrashReportAdmin(admin.ModelAdmin):
     fieldsets = [
         ('Application Information', {'fields': ['app_version_name', 'app_version_code', 'package_name']}),
@@ -33,7 +46,7 @@ class CrashReportAdmin(admin.ModelAdmin):
     ]
     list_display = ('installation_id', 'is_silent', 'brand', 'product', 'android_version', 'created', 'app_version_name', 'solved')
     readonly_fields = (
-    'report_id', 'installation_id', 'brand', 'product', 'phone_model', 'android_version', 'user_app_start_date',
+    'group', 'report_id', 'installation_id', 'brand', 'product', 'phone_model', 'android_version', 'user_app_start_date',
     'user_crash_date', 'created', 'app_version_name', 'app_version_code', 'package_name', 'logcat', 'stack_trace',
     'environment', 'shared_preferences', 'total_mem_size', 'available_mem_size', 'dumpsys_meminfo',
     'initial_configuration', 'file_path', 'crash_configuration', 'build', 'display', 'settings_global',
@@ -42,5 +55,30 @@ class CrashReportAdmin(admin.ModelAdmin):
     search_fields = ['brand', 'product', 'description']
     actions = [statusUpdate]
 
+    def get_changelist(self, request, **kwargs):
+        return CrashReportChangeList
+
 
 admin.site.register(CrashReport, CrashReportAdmin)
+
+
+class CrashGroupAdmin(admin.ModelAdmin):
+    fields = ['exception', 'package_name', 'app_version_name', 'app_version_code', 'count', 'sample_count', 'samples',
+              'first_seen', 'last_seen', 'description', 'solved', 'stack_trace', 'fingerprint']
+    list_display = ('exception', 'package_name', 'app_version_name', 'count', 'sample_count', 'first_seen', 'last_seen', 'solved')
+    readonly_fields = ('exception', 'package_name', 'app_version_name', 'app_version_code', 'count', 'sample_count',
+                       'samples', 'first_seen', 'last_seen', 'stack_trace', 'fingerprint')
+    list_filter = ['solved', 'package_name', 'app_version_code']
+    search_fields = ['exception', 'fingerprint', 'description']
+    ordering = ['-last_seen']
+    actions = [statusUpdate]
+
+    def samples(self, obj):
+        url = reverse('admin:acra_crashreport_changelist') + '?group__id__exact=%d' % obj.pk
+        return format_html('<a href="{}">{} stored reports</a>', url, obj.sample_count)
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(CrashGroup, CrashGroupAdmin)
@@ -0,0 +1,154 @@
+'''
+Crash reports are appended to a file in ACRA_BUFFER_DIR as they come in, one JSON object per line, and inserted in
+batches by manage.py flush_crash_reports. With ACRA_BUFFER_DIR unset they're inserted as they come.
+
+Writers lock the file while appending. The flusher renames it before reading, so new reports go to a fresh file, then
+takes the lock to wait for any writer still appending to the old one. A writer that opened the old file just before
+the rename notices and writes to the new one. Each renamed file is inserted in one transaction, which also records it
+as a FlushedBufferFile, and then deleted. A flusher that dies before committing leaves the file to be inserted again by
+the next one; one that dies after leaves it to be deleted without inserting it twice.
+'''
+
+import datetime, fcntl, glob, os, time, uuid
+
+import simplejson
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from acra.models import CrashReport, CrashGroup, FlushedBufferFile
+
+BUFFER_NAME = "reports.jsonl"
+FLUSHING_SUFFIX = ".flushing"
+# records of flushed files are deleted with the files, and after this if the flusher died in between
+FLUSHED_FILE_LIFESPAN = datetime.timedelta(days=1)
+
+
+def get_buffer_dir():
+    return getattr(settings, 'ACRA_BUFFER_DIR', None)
+
+
+def get_buffer_path():
+    return os.path.join(get_buffer_dir(), BUFFER_NAME)
+
+
+def append_report(report):
+    '''
+    :param report: dict of CrashReport field -> value
+    '''
+    line = simplejson.dumps(report) + "\n"
+    if not os.path.isdir(get_buffer_dir()):
+        os.makedirs(get_buffer_dir())
+
+    while True:
+        fd = os.open(get_buffer_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # renamed by the flusher since we opened it
+                if os.fstat(fd).st_ino != os.stat(get_buffer_path()).st_ino:
+                    continue
+            except OSError:
+                continue
+            os.write(fd, line)
+            if getattr(settings, 'ACRA_BUFFER_FSYNC', True):
+                os.fsync(fd)
+            return
+        finally:
+            os.close(fd)
+
+
+def get_buffer_size():
+    try:
+        return os.path.getsize(get_buffer_path())
+    except OSError:
+        return 0
+
+
+def save_reports(reports):
+    '''
+    :param reports: dicts of CrashReport field -> value
+    :return: number of reports stored, which is less than given past ACRA_SAMPLES_PER_GROUP
+    '''
+    samples = CrashGroup.add_reports([CrashReport(**report) for report in reports])
+    CrashReport.objects.bulk_create(samples, batch_size=getattr(settings, 'ACRA_FLUSH_BATCH_SIZE', 500))
+    return len(samples)
+
+
+def flush():
+    '''
+    Inserts the buffered reports, and any left by a flusher that died
+    :return: number of reports read from the buffer
+    '''
+    if os.path.exists(get_buffer_path()):
+        try:
+            os.rename(get_buffer_path(), "%s-%s%s" % (get_buffer_path(), uuid.uuid4().hex, FLUSHING_SUFFIX))
+        except OSError:
+            pass  # another flusher got it
+
+    count = 0
+    for path in glob.glob(get_buffer_path() + "-*" + FLUSHING_SUFFIX):
+        count += flush_file(path)
+    FlushedBufferFile.objects.filter(created__lt=timezone.now() - FLUSHED_FILE_LIFESPAN).delete()
+    return count
+
+
+def flush_file(path):
+    try:
+        f = open(path)
+    except IOError:
+        return 0  # another flusher finished it
+
+    with f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            return 0
+        name = os.path.basename(path)
+        count = 0
+        with transaction.atomic():
+            # otherwise inserted by a flusher that died before deleting it
+            if not FlushedBufferFile.objects.filter(name=name).exists():
+                FlushedBufferFile.objects.create(name=name)
+                count = insert_lines(f)
+        os.remove(path)
+        FlushedBufferFile.objects.filter(name=name).delete()
+    return count
+
+
+def insert_lines(f):
+    '''
+    :return: number of reports read from f
+    '''
+    batch_size = getattr(settings, 'ACRA_FLUSH_BATCH_SIZE', 500)
+    count = 0
+    batch = []
+    for line in f:
+        try:
+            batch.append(simplejson.loads(line))
+        except ValueError:
+            continue  # a line cut short by a crash
+        if len(batch) >= batch_size:
+            save_reports(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        save_reports(batch)
+        count += len(batch)
+    return count
+
+
+def run_flusher(should_stop=lambda: False, poll_interval=0.5):
+    '''
+    Flushes whenever the buffer holds ACRA_FLUSH_BYTES or ACRA_FLUSH_INTERVAL seconds have passed since the last flush
+    '''
+    last_flush = time.time()
+    while not should_stop():
+        size = get_buffer_size()
+        if size >= getattr(settings, 'ACRA_FLUSH_BYTES', 1024 * 1024) or \
+                (size and time.time() - last_flush >= getattr(settings, 'ACRA_FLUSH_INTERVAL', 5)):
+            flush()
+            last_flush = time.time()
+        else:
+            time.sleep(poll_interval)
+    flush()
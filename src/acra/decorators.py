@@ -1,22 +1,80 @@
-from django.http import HttpResponse
+import hashlib, hmac
+
 from functools import wraps
 
+from django.conf import settings
+from django.contrib.auth import authenticate, get_user_model
+from django.db import router
+from django.db.models.signals import post_save
+from django.http import HttpResponse
+
+from project.process_cache import ProcessCache
+
+REQUIRED_PERMISSIONS = ('acra.add_crashreport', 'acra.change_crashreport', 'acra.delete_crashreport')
+
+
+class CredentialCache(ProcessCache):
+    '''
+    Basic auth credentials this process has already checked, so a burst of crash reports doesn't hash the password
+    for each one. Only an HMAC of username and password is kept, mapped to the user id, for ACRA_AUTH_CACHE_TIMEOUT.
+    '''
+    version_key = "acra_credential_cache_version"
+
+    def get_timeout(self):
+        return settings.ACRA_AUTH_CACHE_TIMEOUT
+
+    def get_size(self):
+        return settings.ACRA_AUTH_CACHE_SIZE
+
+    def get_digest(self, username, password):
+        return hmac.new(settings.SECRET_KEY, "%s:%s" % (username, password), hashlib.sha256).hexdigest()
+
+
+credential_cache = CredentialCache()
+
+
+def clear_cached_credentials(sender, instance, **kwargs):
+    # a new password or a deactivated account takes effect in every process. Only users with a password can be cached,
+    # which leaves out the app's users, who are saved all the time
+    if instance.has_usable_password():
+        credential_cache.invalidate()
+
+post_save.connect(clear_cached_credentials, sender=settings.AUTH_USER_MODEL, dispatch_uid='acra_clear_cached_credentials')
+
+
+def get_user(username, password):
+    '''
+    :return: the user with these credentials and the permissions to report crashes, or None
+    '''
+    User = get_user_model()
+    digest = credential_cache.get_digest(username, password)
+    user_id = credential_cache.get(digest)
+    if user_id is not None:
+        # only the id is loaded, which is all the report view needs
+        return User.from_db(router.db_for_read(User), ['id'], [user_id])
+
+    user = authenticate(username=username, password=password)
+    if user is None or not user.has_perms(REQUIRED_PERMISSIONS):
+        return None
+    credential_cache.set(digest, user.pk)
+    return user
+
 
 def http_basic_auth(func):
+    '''
+    Sets request.user from the basic auth header, without logging the user in, so reports don't write sessions
+    '''
     @wraps(func)
     def _decorator(request, *args, **kwargs):
-        from django.contrib.auth import authenticate, login
         if request.META.has_key('HTTP_AUTHORIZATION'):
             authmeth, auth = request.META['HTTP_AUTHORIZATION'].split(' ', 1)
             if authmeth.lower() == 'basic':
                 auth = auth.strip().decode('base64')
                 username, password = auth.split(':', 1)
-                user = authenticate(username=username, password=password)
-                print user
+                user = get_user(username, password)
                 if user is not None:
-                    if user.has_perm('acra.add_crashreport') and user.has_perm('acra.change_crashreport') and user.has_perm('acra.delete_crashreport'):
-                        login(request, user)
-                        return func(request, *args, **kwargs)
+                    request.user = user
+                    return func(request, *args, **kwargs)
         response = HttpResponse()
         response.status_code = 401
         return response
@@ -0,0 +1,50 @@
+import base64, zlib
+
+from django.db import models
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext_lazy as _
+
+COMPRESSED_PREFIX = "zlib:"
+
+
+def compress(value):
+    return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(force_text(value).encode("utf8")))
+
+
+def decompress(value):
+    if not value.startswith(COMPRESSED_PREFIX):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode("utf8")
+
+
+class CompressedTextField(models.TextField):
+    '''
+    Text that is zlib compressed in the database, base64 encoded since the column is still text. Values shorter than
+    min_length are stored as they are, as are rows written before a field became compressed; reading tells them apart
+    by COMPRESSED_PREFIX, which is why a value starting with it is always compressed. Lookups other than isnull don't
+    work on the compressed values.
+    '''
+    description = _("Compressed text")
+
+    def __init__(self, *args, **kwargs):
+        self.min_length = kwargs.pop("min_length", 256)
+        super(CompressedTextField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CompressedTextField, self).deconstruct()
+        if self.min_length != 256:
+            kwargs["min_length"] = self.min_length
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return decompress(value)
+
+    def get_prep_value(self, value):
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if value is None:
+            return value
+        if len(value) < self.min_length and not value.startswith(COMPRESSED_PREFIX):
+            return value
+        return compress(value)
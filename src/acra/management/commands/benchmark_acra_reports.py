@@ -0,0 +1,50 @@
+import base64, time
+
+import simplejson
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from acra import views
+from acra.decorators import credential_cache, REQUIRED_PERMISSIONS
+
+REPORT = dict(REPORT_ID="benchmark", APP_VERSION_CODE="1", APP_VERSION_NAME="1.0", PACKAGE_NAME="benchmark",
+              BRAND="benchmark", PRODUCT="benchmark", ANDROID_VERSION="6.0", STACK_TRACE="java.lang.Exception\n" * 50,
+              LOGCAT="benchmark\n" * 500)
+
+
+class Command(BaseCommand):
+    help = "Posts crash reports to the report view and prints reports per second with and without the credential " \
+           "cache. Runs in a transaction that is rolled back, so nothing is kept."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reports", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["reports"])
+            transaction.set_rollback(True)
+
+    def run(self, count):
+        user = get_user_model().objects.create_user("acra-benchmark", "acra-benchmark@example.com", "benchmark")
+        user.user_permissions.set(Permission.objects.filter(content_type__app_label="acra",
+                                                            codename__in=[p.split(".")[1] for p in REQUIRED_PERMISSIONS]))
+        authorization = "Basic " + base64.b64encode("acra-benchmark:benchmark")
+        body = simplejson.dumps(REPORT)
+        factory = RequestFactory()
+
+        for cached in (False, True):
+            credential_cache.clear()
+            start = time.time()
+            for _ in xrange(count):
+                if not cached:
+                    credential_cache.clear()
+                request = factory.post("/acra/report/", body, content_type="application/json", HTTP_AUTHORIZATION=authorization)
+                response = views.report(request)
+                assert response.status_code == 200, response.status_code
+            duration = time.time() - start
+            self.stdout.write("%s: %.1f reports/s, %.2fms per report" % (
+                "cached" if cached else "uncached", count / duration, duration / count * 1000))
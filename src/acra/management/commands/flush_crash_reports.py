@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from acra import buffer
+
+
+class Command(BaseCommand):
+    help = "Inserts the crash reports buffered in ACRA_BUFFER_DIR. With --loop it keeps running and flushes every " \
+           "ACRA_FLUSH_INTERVAL seconds, or sooner once ACRA_FLUSH_BYTES are waiting; run that under the process " \
+           "supervisor, and this without it from cron to pick up after a flusher that died."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true")
+
+    def handle(self, *args, **options):
+        if not buffer.get_buffer_dir():
+            self.stderr.write("ACRA_BUFFER_DIR isn't set, reports are saved as they come in")
+            return
+        if options["loop"]:
+            buffer.run_flusher()
+        else:
+            self.stdout.write("Flushed %d reports" % buffer.flush())
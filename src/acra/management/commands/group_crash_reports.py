@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from acra.models import CrashReport, CrashGroup
+
+
+class Command(BaseCommand):
+    help = "Puts crash reports stored before reports were grouped into CrashGroups, and deletes the ones past " \
+           "ACRA_SAMPLES_PER_GROUP for their group."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        grouped = deleted = 0
+        last_pk = 0
+        fields = ("id", "package_name", "app_version_name", "app_version_code", "stack_trace")
+        while True:
+            reports = list(CrashReport.objects.filter(group__isnull=True, pk__gt=last_pk).order_by("pk").only(*fields)[:options["batch_size"]])
+            if not reports:
+                break
+            last_pk = reports[-1].pk
+
+            samples = CrashGroup.add_reports(reports)
+            for report in samples:
+                CrashReport.objects.filter(pk=report.pk).update(group=report.group)
+            sample_ids = set(report.pk for report in samples)
+            extra_ids = [report.pk for report in reports if report.pk not in sample_ids]
+            CrashReport.objects.filter(pk__in=extra_ids).delete()
+            grouped += len(samples)
+            deleted += len(extra_ids)
+
+        self.stdout.write("Grouped %d reports, deleted %d" % (grouped, deleted))
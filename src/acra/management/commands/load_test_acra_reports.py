@@ -0,0 +1,91 @@
+import base64, threading, time
+
+import simplejson
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+
+from acra import buffer, views
+from acra.decorators import REQUIRED_PERMISSIONS
+from acra.models import CrashReport, CrashGroup
+
+PACKAGE_NAME = "acra-load-test"
+
+
+class Command(BaseCommand):
+    help = "Posts crash reports to the report view from several threads for a while, with the flusher running, and " \
+           "prints the reports per second accepted and inserted. Writes to the database, so run it on staging; the " \
+           "reports and groups it creates are deleted afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seconds", type=float, default=10)
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--crashes", type=int, default=20, help="Distinct stack traces")
+
+    def handle(self, *args, **options):
+        if not buffer.get_buffer_dir():
+            raise CommandError("Set ACRA_BUFFER_DIR first")
+
+        User = get_user_model()
+        user = User.objects.create_user("acra-load-test", "acra-load-test@example.com", "load-test")
+        try:
+            user.user_permissions.set(Permission.objects.filter(content_type__app_label="acra",
+                                                                codename__in=[p.split(".")[1] for p in REQUIRED_PERMISSIONS]))
+            self.run(options)
+        finally:
+            CrashReport.objects.filter(package_name=PACKAGE_NAME).delete()
+            CrashGroup.objects.filter(package_name=PACKAGE_NAME).delete()
+            user.delete()
+
+    def run(self, options):
+        factory = RequestFactory()
+        authorization = "Basic " + base64.b64encode("acra-load-test:load-test")
+        stop_posting = threading.Event()
+        stop_flushing = threading.Event()
+        accepted = [0] * options["threads"]
+
+        def post(thread):
+            try:
+                while not stop_posting.is_set():
+                    crash = accepted[thread] % options["crashes"]
+                    body = simplejson.dumps(dict(PACKAGE_NAME=PACKAGE_NAME, APP_VERSION_CODE="1", REPORT_ID=str(accepted[thread]),
+                                                 STACK_TRACE="java.lang.Exception: %d\n\tat Load.test(Load.java:%d)" % (thread, crash),
+                                                 LOGCAT="load test\n" * 500))
+                    request = factory.post("/acra/report/", body, content_type="application/json", HTTP_AUTHORIZATION=authorization)
+                    if views.report(request).status_code == 200:
+                        accepted[thread] += 1
+            finally:
+                connection.close()
+
+        def flush():
+            try:
+                buffer.run_flusher(stop_flushing.is_set)
+            finally:
+                connection.close()
+
+        before = CrashGroup.objects.filter(package_name=PACKAGE_NAME).count()
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        posters = [threading.Thread(target=post, args=(thread,)) for thread in xrange(options["threads"])]
+        start = time.time()
+        for thread in posters:
+            thread.start()
+        time.sleep(options["seconds"])
+        stop_posting.set()
+        for thread in posters:
+            thread.join()
+        posted = time.time() - start
+
+        stop_flushing.set()
+        flusher.join()
+        flushed = time.time() - start
+
+        counted = sum(CrashGroup.objects.filter(package_name=PACKAGE_NAME).values_list("count", flat=True))
+        self.stdout.write("Accepted %d reports in %.1fs, %.0f/s, with %d threads" % (sum(accepted), posted, sum(accepted) / posted, options["threads"]))
+        self.stdout.write("Inserted %d in %.1fs, %.0f/s, into %d groups" % (counted, flushed, counted / flushed,
+                                                                           CrashGroup.objects.filter(package_name=PACKAGE_NAME).count() - before))
+        if counted != sum(accepted):
+            raise CommandError("%d reports were accepted but not inserted" % (sum(accepted) - counted))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 03:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('acra', '0003_crashreport_is_silent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrashGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=40, unique=True)),
+                ('package_name', models.CharField(default=b'', max_length=100, verbose_name=b'Package Name')),
+                ('app_version_name', models.CharField(default=b'', max_length=50, verbose_name=b'Version Name')),
+                ('app_version_code', models.CharField(default=b'', max_length=50, verbose_name=b'Version Code')),
+                ('exception', models.CharField(default=b'', max_length=255)),
+                ('stack_trace', models.TextField(default=b'', verbose_name=b'Normalized Stack Trace')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name=b'Reports')),
+                ('sample_count', models.PositiveIntegerField(default=0, verbose_name=b'Stored Reports')),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+                ('last_seen', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('description', models.TextField(blank=True, default=b'')),
+                ('solved', models.CharField(choices=[(b'solved', b'Solved'), (b'unsolved', b'Unsolved')], default=b'unsolved', max_length=10, verbose_name=b'Status')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='crashreport',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reports', to='acra.CrashGroup'),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 03:12
+from __future__ import unicode_literals
+
+import acra.fields
+from django.db import migrations, transaction
+
+COMPRESSED_FIELDS = ('build', 'device_features', 'dumpsys_meminfo', 'environment', 'logcat', 'settings_global',
+                     'settings_secure', 'settings_system')
+BATCH_SIZE = 200
+
+
+def compress_reports(apps, schema_editor):
+    # a batch per transaction, so a big table converts a bit at a time and an interrupted run picks up where it was
+    CrashReport = apps.get_model('acra', 'CrashReport')
+    reports = CrashReport.objects.using(schema_editor.connection.alias).order_by('pk').only('pk', *COMPRESSED_FIELDS)
+    last_pk = 0
+    while True:
+        batch = list(reports.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic(using=schema_editor.connection.alias):
+            for report in batch:
+                report.save(update_fields=COMPRESSED_FIELDS)
+        last_pk = batch[-1].pk
+
+
+def decompress_reports(apps, schema_editor):
+    connection = schema_editor.connection
+    table = connection.ops.quote_name('acra_crashreport')
+    columns = [connection.ops.quote_name(field) for field in COMPRESSED_FIELDS]
+    last_pk = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, %s FROM %s WHERE id > %%s ORDER BY id LIMIT %d' % (', '.join(columns), table, BATCH_SIZE),
+                           [last_pk])
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for row in rows:
+                    cursor.execute('UPDATE %s SET %s WHERE id = %%s' % (table, ', '.join('%s = %%s' % column for column in columns)),
+                                   [acra.fields.decompress(value) if value else value for value in row[1:]] + [row[0]])
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('acra', '0004_crash_groups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crashreport',
+            name='build',
+            field=acra.fields.CompressedTextField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='device_features',
+            field=acra.fields.CompressedTextField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='dumpsys_meminfo',
+            field=acra.fields.CompressedTextField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='environment',
+            field=acra.fields.CompressedTextField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='logcat',
+            field=acra.fields.CompressedTextField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='settings_global',
+            field=acra.fields.CompressedTextField(default=b'', verbose_name=b'Global Settings'),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='settings_secure',
+            field=acra.fields.CompressedTextField(default=b'', verbose_name=b'Secure Settings'),
+        ),
+        migrations.AlterField(
+            model_name='crashreport',
+            name='settings_system',
+            field=acra.fields.CompressedTextField(default=b'', verbose_name=b'System Settings'),
+        ),
+        migrations.RunPython(compress_reports, decompress_reports),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.utils.timezone import utc
 from datetime import datetime
-import json
+from collections import OrderedDict
+import hashlib, json, re
+
+from acra.fields import CompressedTextField
 
 REPORT_STATUS = (
     ("solved", "Solved"),
@@ -9,11 +15,92 @@ REPORT_STATUS = (
 )
 
 
+FRAME_RE = re.compile(r"^at ")
+EXCEPTION_RE = re.compile(r"^(Caused by: )?([\w$.]+)(:.*)?$")
+ADDRESS_RE = re.compile(r"(0x[0-9a-fA-F]+|@[0-9a-fA-F]+)")
+
+
+def normalize_stack_trace(stack_trace):
+    '''
+    Keeps the exception class names and frames of a Java stack trace and drops exception messages and object
+    addresses, which differ between reports of the same crash
+    '''
+    lines = []
+    for line in stack_trace.splitlines():
+        line = line.strip()
+        if FRAME_RE.match(line):
+            lines.append(ADDRESS_RE.sub("", line))
+        elif not line.startswith("..."):
+            match = EXCEPTION_RE.match(line)
+            if match:
+                lines.append((match.group(1) or "") + match.group(2))
+    return "\n".join(lines)
+
+
+def get_fingerprint(report):
+    key = u"%s\n%s\n%s" % (report.package_name, report.app_version_code, normalize_stack_trace(report.stack_trace))
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+class CrashGroup(models.Model):
+    '''
+    All the reports of one crash: the same normalized stack trace in the same app version. Only the first
+    ACRA_SAMPLES_PER_GROUP reports are stored, the rest are just counted.
+    '''
+    fingerprint = models.CharField(max_length=40, unique=True)
+    package_name = models.CharField(max_length=100, default="", verbose_name='Package Name')
+    app_version_name = models.CharField(max_length=50, default="", verbose_name='Version Name')
+    app_version_code = models.CharField(max_length=50, default="", verbose_name='Version Code')
+    exception = models.CharField(max_length=255, default="")
+    stack_trace = models.TextField(default="", verbose_name='Normalized Stack Trace')
+    count = models.PositiveIntegerField(default=0, verbose_name='Reports')
+    sample_count = models.PositiveIntegerField(default=0, verbose_name='Stored Reports')
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(default=timezone.now, db_index=True)
+    description = models.TextField(default="", blank=True)
+    solved = models.CharField(max_length=10, choices=REPORT_STATUS, default="unsolved", verbose_name='Status')
+
+    @staticmethod
+    def add_reports(reports):
+        '''
+        Counts unsaved reports against their groups, creating the groups as needed
+        :return: the reports that should be stored as samples, with their group set
+        '''
+        by_fingerprint = OrderedDict()
+        for report in reports:
+            by_fingerprint.setdefault(get_fingerprint(report), []).append(report)
+
+        samples = []
+        max_samples = getattr(settings, 'ACRA_SAMPLES_PER_GROUP', 10)
+        for fingerprint, group_reports in by_fingerprint.items():
+            first = group_reports[0]
+            normalized = normalize_stack_trace(first.stack_trace)
+            group, _ = CrashGroup.objects.get_or_create(fingerprint=fingerprint, defaults=dict(
+                package_name=first.package_name, app_version_name=first.app_version_name,
+                app_version_code=first.app_version_code, exception=normalized.split("\n", 1)[0][:255],
+                stack_trace=normalized))
+
+            with transaction.atomic():
+                sample_count = CrashGroup.objects.select_for_update().values_list("sample_count", flat=True).get(pk=group.pk)
+                group_samples = group_reports[:max(max_samples - sample_count, 0)]
+                CrashGroup.objects.filter(pk=group.pk).update(count=F("count") + len(group_reports),
+                                                              sample_count=F("sample_count") + len(group_samples),
+                                                              last_seen=timezone.now())
+            for report in group_samples:
+                report.group = group
+            samples.extend(group_samples)
+        return samples
+
+    def __unicode__(self):
+        return "%s in %s %s" % (self.exception, self.package_name, self.app_version_name)
+
+
 class CrashReport(models.Model):
+    group = models.ForeignKey(CrashGroup, null=True, blank=True, on_delete=models.SET_NULL, related_name="reports")
     stack_trace = models.TextField(default="")
-    logcat = models.TextField(default="")
+    logcat = CompressedTextField(default="")
     shared_preferences = models.TextField(default="")
-    environment = models.TextField(default="")
+    environment = CompressedTextField(default="")
     total_mem_size = models.BigIntegerField(default=0, verbose_name='Total Memory Size')
     initial_configuration = models.TextField(default="")
     display = models.TextField(default="")
@@ -21,17 +108,17 @@ class CrashReport(models.Model):
     phone_model = models.CharField(max_length=50, default="")
     user_comment = models.TextField(default="")
     crash_configuration = models.TextField(default="")
-    device_features = models.TextField(default="")
-    settings_system = models.TextField(default="", verbose_name='System Settings')
+    device_features = CompressedTextField(default="")
+    settings_system = CompressedTextField(default="", verbose_name='System Settings')
     file_path = models.CharField(max_length=100, default="")
     installation_id = models.CharField(max_length=100, default="")
     user_crash_date = models.CharField(max_length=50, default="", verbose_name='Crash Date')
     app_version_name = models.CharField(max_length=50, default="", verbose_name='Version Name')
     user_app_start_date = models.CharField(max_length=50, default="", verbose_name='Application Start Date')
-    settings_global = models.TextField(default="", verbose_name='Global Settings')
-    build = models.TextField(default="")
-    settings_secure = models.TextField(default="", verbose_name='Secure Settings')
-    dumpsys_meminfo = models.TextField(default="")
+    settings_global = CompressedTextField(default="", verbose_name='Global Settings')
+    build = CompressedTextField(default="")
+    settings_secure = CompressedTextField(default="", verbose_name='Secure Settings')
+    dumpsys_meminfo = CompressedTextField(default="")
     user_email = models.CharField(max_length=50, default="")
     report_id = models.CharField(max_length=100, default="")
     product = models.CharField(max_length=50, default="")
@@ -52,3 +139,49 @@ class CrashReport(models.Model):
     def __unicode__(self):
         return ('Device: %s %s - Android: %s - Application: %s Version: %s') % (
             self.brand, self.product, self.android_version, self.app_version_name, self.app_version_code)
+
+
+class FlushedBufferFile(models.Model):
+    '''
+    A buffer file whose reports have been inserted, recorded in the same transaction, so a flusher that dies before
+    deleting the file doesn't insert it again (see acra.buffer)
+    '''
+    name = models.CharField(max_length=100, unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+# fields of CrashReport that come from the app, by name
+REPORT_FIELDS = dict((field.name, field) for field in CrashReport._meta.fields
+                     if field.name not in ("id", "group", "description", "solved", "created"))
+
+
+def clean_report(data):
+    '''
+    :param data: an ACRA report, whose keys are the upper case names of our fields
+    :return: dict of field name -> value for the fields we know, converted to their types and cut to their lengths
+    '''
+    report = dict()
+    for key, value in data.items():
+        field = REPORT_FIELDS.get(key.lower())
+        if field is None:
+            continue
+        if isinstance(field, models.BooleanField):
+            value = value in (True, 1, "true", "True")
+        elif isinstance(field, models.BigIntegerField):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                continue
+        elif value is None:
+            value = ""
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        else:
+            value = unicode(value)
+            if field.max_length:
+                value = value[:field.max_length]
+        report[field.name] = value
+    return report
@@ -0,0 +1,167 @@
+import simplejson, base64, datetime, os, shutil, tempfile, StringIO
+import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from . import buffer
+from .decorators import credential_cache, CredentialCache
+from .models import CrashReport, CrashGroup, FlushedBufferFile, normalize_stack_trace, clean_report
+
+User = get_user_model()
+
+
+class AcraReportTestCase(TestCase):
+
+    def setUp(self):
+        self.reporter = User.objects.create_user("reporter", "reporter@bob.johnson", "secret")
+        self.reporter.user_permissions.set(Permission.objects.filter(content_type__app_label="acra"))
+        credential_cache.clear()
+
+    def post_report(self, password="secret", **report):
+        report = dict(dict(REPORT_ID="1", STACK_TRACE="java.lang.Exception", APP_VERSION_CODE="3"), **report)
+        return self.client.post("/acra/report/", simplejson.dumps(report), content_type="application/json",
+                                HTTP_AUTHORIZATION="Basic " + base64.b64encode("reporter:" + password))
+
+    def test_credential_cache(self):
+        self.assertEqual(self.post_report().status_code, 200)
+        with mock.patch("acra.decorators.authenticate") as authenticate:
+            self.assertEqual(self.post_report().status_code, 200)
+            self.assertFalse(authenticate.called)
+        self.assertEqual(self.post_report(password="wrong").status_code, 401)
+        self.assertEqual(CrashReport.objects.count(), 2)
+        self.assertEqual(Session.objects.count(), 0)
+
+        self.reporter.set_password("changed")
+        self.reporter.save()
+        self.assertEqual(self.post_report().status_code, 401)
+
+    @override_settings(AUTH_CACHE_VERSION_INTERVAL=datetime.timedelta(0))
+    def test_credential_cache_invalidated_in_other_processes(self):
+        self.assertEqual(self.post_report().status_code, 200)
+        other_process = CredentialCache()
+        digest = other_process.get_digest("reporter", "secret")
+        other_process.set(digest, self.reporter.id)
+
+        self.reporter.is_active = False
+        self.reporter.save()
+        self.assertIsNone(other_process.get(digest))
+        self.assertEqual(self.post_report().status_code, 401)
+
+        # the app's users have no password, and saving them leaves the cache alone
+        other_process.set(digest, self.reporter.id)
+        User.objects.create(username="app@bob.johnson", email="app@bob.johnson")
+        self.assertEqual(other_process.get(digest), self.reporter.id)
+
+    def test_normalize_stack_trace(self):
+        self.assertEqual(normalize_stack_trace("java.lang.NullPointerException: Attempt to invoke on object@1f2e3d\n"
+                                               "\tat com.example.Foo.bar(Foo.java:12)\n"
+                                               "\tat com.example.Foo$1.run(Foo.java:30)\n"
+                                               "Caused by: java.io.IOException: read failed, id 1234\n"
+                                               "\t... 5 more"),
+                         "java.lang.NullPointerException\nat com.example.Foo.bar(Foo.java:12)\nat com.example.Foo$1.run(Foo.java:30)\n"
+                         "Caused by: java.io.IOException")
+
+    @override_settings(ACRA_SAMPLES_PER_GROUP=3)
+    def test_crash_groups(self):
+        for i in xrange(5):
+            self.assertEqual(self.post_report(STACK_TRACE="java.lang.Exception: try %d\n\tat com.example.Foo.bar(Foo.java:12)" % i).status_code, 200)
+        self.post_report(STACK_TRACE="java.lang.Exception: try\n\tat com.example.Foo.bar(Foo.java:12)", APP_VERSION_CODE=4)
+
+        groups = CrashGroup.objects.order_by("id")
+        self.assertEqual([(group.app_version_code, group.count, group.sample_count) for group in groups], [("3", 5, 3), ("4", 1, 1)])
+        self.assertEqual(groups[0].exception, "java.lang.Exception")
+        self.assertEqual(groups[0].reports.count(), 3)
+        self.assertEqual(CrashReport.objects.count(), 4)
+
+        User.objects.create_superuser("admin", "admin@bob.johnson", "admin")
+        self.client.login(username="admin", password="admin")
+        self.assertContains(self.client.get("/admin/acra/crashgroup/%d/change/" % groups[0].id), "3 stored reports")
+        response = self.client.get("/admin/acra/crashreport/?group__id__exact=%d" % groups[0].id)
+        self.assertEqual(len(response.context["cl"].result_list), 3)
+
+    @override_settings(ACRA_SAMPLES_PER_GROUP=2)
+    def test_group_crash_reports(self):
+        for i in xrange(3):
+            CrashReport.objects.create(stack_trace="java.lang.Exception: %d" % i, app_version_code="3")
+        CrashReport.objects.create(stack_trace="java.lang.RuntimeException", app_version_code="3")
+        call_command("group_crash_reports", batch_size=2, stdout=StringIO.StringIO())
+
+        self.assertEqual(sorted(CrashGroup.objects.values_list("exception", "count", "sample_count")),
+                         [("java.lang.Exception", 3, 2), ("java.lang.RuntimeException", 1, 1)])
+        self.assertFalse(CrashReport.objects.filter(group__isnull=True).exists())
+        self.assertEqual(CrashReport.objects.count(), 3)
+
+    def test_clean_report(self):
+        self.assertEqual(clean_report(dict(BRAND="x" * 60, TOTAL_MEM_SIZE="1024", AVAILABLE_MEM_SIZE="?", IS_SILENT="true",
+                                           BUILD=dict(BOARD="msm"), SOLVED="solved", ID=5, UNKNOWN="")),
+                         dict(brand="x" * 50, total_mem_size=1024, is_silent=True, build='{"BOARD": "msm"}'))
+        self.assertEqual(self.post_report(**{"USER_COMMENT": None}).status_code, 200)
+        self.assertEqual(self.client.post("/acra/report/", "[1]", content_type="application/json",
+                                          HTTP_AUTHORIZATION="Basic " + base64.b64encode("reporter:secret")).status_code, 400)
+
+    def test_buffered_reports(self):
+        buffer_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(ACRA_BUFFER_DIR=buffer_dir, ACRA_BUFFER_FSYNC=False, ACRA_FLUSH_BATCH_SIZE=2):
+                for i in xrange(3):
+                    self.assertEqual(self.post_report(REPORT_ID=str(i)).status_code, 200)
+                self.assertEqual(CrashReport.objects.count(), 0)
+
+                # left behind by a flusher that died
+                with open(os.path.join(buffer_dir, "reports.jsonl-dead.flushing"), "w") as f:
+                    f.write(simplejson.dumps(dict(report_id="dead", stack_trace="java.lang.Exception")) + "\n")
+                    f.write('{"report_id": "cut')
+
+                output = StringIO.StringIO()
+                call_command("flush_crash_reports", stdout=output)
+                self.assertEqual(output.getvalue().strip(), "Flushed 4 reports")
+                self.assertEqual(sorted(CrashReport.objects.values_list("report_id", flat=True)), ["0", "1", "2", "dead"])
+                self.assertEqual(CrashGroup.objects.get(app_version_code="3").count, 3)
+                self.assertEqual(os.listdir(buffer_dir), [])
+
+                # a flusher that died after committing, before deleting the file
+                self.post_report(REPORT_ID="3")
+                with mock.patch("acra.buffer.os.remove", side_effect=OSError):
+                    with self.assertRaises(OSError):
+                        buffer.flush()
+                self.assertEqual(buffer.flush(), 0)
+                self.assertEqual(CrashGroup.objects.get(app_version_code="3").count, 4)
+                self.assertEqual(os.listdir(buffer_dir), [])
+                self.assertFalse(FlushedBufferFile.objects.exists())
+        finally:
+            shutil.rmtree(buffer_dir)
+
+    def test_compressed_fields(self):
+        logcat = u"I/ActivityManager: Start proc \u2603\n" * 200
+        self.assertEqual(self.post_report(LOGCAT=logcat, BUILD="short", ENVIRONMENT="zlib:not compressed").status_code, 200)
+        report = CrashReport.objects.get()
+        self.assertEqual((report.logcat, report.build, report.environment), (logcat, "short", "zlib:not compressed"))
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT logcat, build, dumpsys_meminfo FROM acra_crashreport")
+            stored_logcat, stored_build, stored_meminfo = cursor.fetchone()
+        self.assertTrue(stored_logcat.startswith("zlib:"))
+        self.assertLess(len(stored_logcat), len(logcat) / 10)
+        self.assertEqual((stored_build, stored_meminfo), ("short", ""))
+
+        User.objects.create_superuser("admin", "admin@bob.johnson", "admin")
+        self.client.login(username="admin", password="admin")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get("/admin/acra/crashreport/").status_code, 200)
+        self.assertFalse([query for query in queries if "logcat" in query["sql"] or "settings_global" in query["sql"]])
+
+        # columns that aren't model fields don't get in the way
+        with mock.patch("acra.admin.CrashReportAdmin.list_display", ("__str__", "installation_id", "stack_trace")):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get("/admin/acra/crashreport/").status_code, 200)
+        self.assertFalse([query for query in queries if "logcat" in query["sql"]])
+
+    def test_permissions(self):
+        self.reporter.user_permissions.clear()
+        self.assertEqual(self.post_report().status_code, 401)
@@ -1,5 +1,5 @@
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
 from django.db.models import Count
 from django.db import connection
@@ -7,7 +7,8 @@ from django.contrib.auth.decorators import login_required
 
 import simplejson
 
-from acra.models import CrashReport
+from acra.models import clean_report
+from acra import buffer
 from acra.decorators import http_basic_auth
 
 
@@ -19,16 +20,17 @@ def report(request):
 
     if request.method == "PUT" or request.method == "POST":
 
-        json_data = simplejson.loads(request.body)
-
-        notallow = ["description", "solved", ]
-        crashreport = CrashReport()
-
-        for key in json_data.keys():
-
-            if not key.lower() in notallow:
-                setattr(crashreport, key.lower(), json_data[key])
-
-        crashreport.save()
+        try:
+            json_data = simplejson.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not isinstance(json_data, dict):
+            return HttpResponseBadRequest()
+
+        crashreport = clean_report(json_data)
+        if buffer.get_buffer_dir():
+            buffer.append_report(crashreport)
+        else:
+            buffer.save_reports([crashreport])
 
     return HttpResponse(simplejson.dumps({"ok": "true"}), content_type="application/json")
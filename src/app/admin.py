@@ -2,10 +2,12 @@ from django.contrib import admin
 from django.contrib.auth import admin as auth_admin
 from django import forms
 
-import fields, csv, zipfile, os, uuid, errno, datetime
+import fields, csv, os, errno
 import simplejson, pytz
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse, FileResponse, Http404
+from django.conf.urls import url
+from django.utils.html import format_html
 
 from django.contrib.admin.widgets import AdminTextareaWidget, AdminTextInputWidget
 from django.template.loader import render_to_string
@@ -13,10 +15,16 @@ from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 
 from django.db.models import Count, Case, When, IntegerField, Sum
+from django.db import connections, router
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 from django.conf import settings
 from django import utils
 
-from .models import User, Experiment, JawboneMeasurement, Checkin
+from .models import User, Experiment, JawboneMeasurement, Checkin, ProfiledUser, RequestProfile, ExportJob
+from .exports import (csv_lines, experiments_json, USER_CSV_COLUMNS, EXPERIMENT_CSV_COLUMNS, CHECKIN_CSV_COLUMNS,
+                      JAWBONE_MEASUREMENT_CSV_COLUMNS)
 
 
 def register(model):
@@ -26,49 +34,99 @@ def register(model):
 
     return inner
 
-def export_users_csv(modeladmin,request, queryset):
-    import csv
-    from django.utils.encoding import smart_str
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=UserData.csv'
-    writer = csv.writer(response, csv.excel)
-    response.write(u'\ufeff'.encode('utf8')) # BOM (optional...Excel needs it to open UTF-8 file properly)
-    writer.writerow([
-        smart_str(u"ID"),
-        smart_str(u"User"),
-        smart_str(u"JawboneAccessToken"),
-        smart_str(u"JawboneResetToken"),
-        smart_str(u"JawboneUserID"),
-        smart_str(u"DateOfBirth"),
-        smart_str(u"Race"),
-        smart_str(u"Gender"),
-        smart_str(u"Happy"),
-        smart_str(u"Stress"),
-        smart_str(u"Activity"),
-        smart_str(u"SleepQuality"),
-        smart_str(u"Timezone"),
-        
-    ])
-    for obj in queryset:
-        writer.writerow([
-            smart_str(obj.pk),
-            smart_str(obj.username),
-            smart_str(obj.jawbone_access_token),
-            smart_str(obj.jawbone_reset_token),
-            smart_str(obj.jawbone_user_id),
-            smart_str(obj.date_of_birth),
-            smart_str(obj.race),
-            smart_str(obj.gender),
-            smart_str(obj.happy),
-            smart_str(obj.stress),
-            smart_str(obj.activity),
-            smart_str(obj.sleep_quality),
-            smart_str(obj.timezone)
-        ])
+
+ROW_ESTIMATE_CACHE_TIMEOUT = 5 * 60
+
+
+def estimate_row_count(model):
+    '''
+    :return: the database's estimate of the number of rows in model's table, which for InnoDB can be some tens of
+    percent off, or None if the database doesn't keep one
+    '''
+    using = router.db_for_read(model)
+    if connections[using].vendor != 'mysql':
+        return None
+    cache_key = "row_estimate:%s" % model._meta.db_table
+    estimate = cache.get(cache_key)
+    if estimate is None:
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                           [model._meta.db_table])
+            row = cursor.fetchone()
+        estimate = row[0] if row else None
+        cache.set(cache_key, estimate, ROW_ESTIMATE_CACHE_TIMEOUT)
+    return estimate
+
+
+class ApproximateCountPaginator(Paginator):
+    '''
+    Doesn't COUNT(*) big tables: an unfiltered changelist gets the database's estimate of the table size, and a
+    filtered one is only counted up to settings.ADMIN_EXACT_COUNT_LIMIT rows, past which pages aren't reachable.
+    Set show_full_result_count = False along with it.
+    '''
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_row_count(self.object_list.model)
+            if estimate is not None and estimate > settings.ADMIN_EXACT_COUNT_LIMIT:
+                return estimate
+        return self.object_list[:settings.ADMIN_EXACT_COUNT_LIMIT].count()
+
+
+def selected_only_filter(field_name, model):
+    '''
+    A list_filter for a foreign key that only lists the object being filtered on, rather than every row of model.
+    Filter with ?<field_name>=<id>, or find the rows with the search box.
+    '''
+    class SelectedOnlyFilter(admin.SimpleListFilter):
+        title = model._meta.verbose_name
+        parameter_name = field_name
+
+        def get_id(self):
+            value = self.value()
+            return int(value) if value and value.isdigit() else None
+
+        def lookups(self, request, model_admin):
+            selected = model.objects.filter(pk=self.get_id()).first() if self.get_id() else None
+            return [(str(selected.pk), unicode(selected))] if selected else []
+
+        def queryset(self, request, queryset):
+            if self.get_id():
+                return queryset.filter(**{field_name + "_id": self.get_id()})
+
+    return SelectedOnlyFilter
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    '''
+    For tables with millions of rows, so a changelist page takes the same time whatever their size
+    '''
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+
+def streaming_csv_response(filename, columns, queryset):
+    response = StreamingHttpResponse(csv_lines(columns, queryset), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
     return response
+
+
+def export_users_csv(modeladmin, request, queryset):
+    return streaming_csv_response('UserData.csv', USER_CSV_COLUMNS, queryset)
 export_users_csv.short_description = u"Export to CSV"
 
 
+def export_users_in_background(modeladmin, request, queryset):
+    job = ExportJob.objects.create(requested_by=request.user)
+    user_ids = list(queryset.values_list('pk', flat=True))
+    job.users.set(user_ids)
+    url = reverse('admin:app_exportjob_change', args=(job.id,))
+    modeladmin.message_user(request, format_html('Export job <a href="{}">{}</a> will build a zip of the {} selected users\' data.',
+                                                 url, job.id, len(user_ids)))
+export_users_in_background.short_description = u"Export all data of selected users in the background"
+
+
 @register(User)
 class UserAdmin(auth_admin.UserAdmin):
     list_display = auth_admin.UserAdmin.list_display
@@ -87,7 +145,7 @@ class UserAdmin(auth_admin.UserAdmin):
                                      'sleep_quality',
                                      'timezone')}),
     )
-    actions = [export_users_csv]
+    actions = [export_users_csv, export_users_in_background]
 
 
 class SerializedFieldWidget(AdminTextareaWidget):
@@ -95,99 +153,32 @@ class SerializedFieldWidget(AdminTextareaWidget):
     def render(self, name, value, attrs=None):
         return super(SerializedFieldWidget, self).render(name, simplejson.dumps(value, indent=4), attrs)
 
-class DateTimeEncoder(simplejson.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            return o.isoformat()
-        if isinstance(o, datetime.date):
-            return o.isoformat()
-
-        return simplejson.JSONEncoder.default(self, o)
-
-def export_experiments_csv(modeladmin,request, queryset):
-    import csv
-    from django.utils.encoding import smart_str
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=ExperimentData.csv'
-    writer = csv.writer(response, csv.excel)
-    response.write(u'\ufeff'.encode('utf8')) # BOM (optional...Excel needs it to open UTF-8 file properly)
-    writer.writerow([
-        smart_str(u"ID"),
-        smart_str(u"User"),
-        smart_str(u"Key"),
-        smart_str(u"ExperimentType"),
-        smart_str(u"StartTime"),
-        smart_str(u"EndTime"),
-        smart_str(u"SelfEfficacy"),
-        smart_str(u"AppEfficacy"),
-        smart_str(u"ExperientEfficacy"),
-        smart_str(u"IsActive"),
-        smart_str(u"IsCancelled"),
-        smart_str(u"CancelReason"),
-        smart_str(u"InitialStageAverage"),
-        smart_str(u"StageDates"),
-        smart_str(u"StageTargetValues"),
-        smart_str(u"StageRestartCount"),
-        smart_str(u"CurrentStage"),
-        smart_str(u"ResultValue"),
-        smart_str(u"ResultConfidence"),
-        smart_str(u"StageResults"),
-    ])
-    for obj in queryset:
-        writer.writerow([
-            smart_str(obj.pk),
-            smart_str(obj.user),
-            smart_str(obj.key),
-            smart_str(obj.experiment_type),
-            smart_str(obj.start_time),
-            smart_str(obj.end_time),
-            smart_str(obj.self_efficacy),
-            smart_str(obj.app_efficacy),
-            smart_str(obj.experiment_efficacy),
-            smart_str(obj.is_active),
-            smart_str(obj.is_cancelled),
-            smart_str(obj.cancel_reason),
-            smart_str(obj.initial_stage_average),
-            smart_str(obj.stage_dates),
-            smart_str(obj.stage_target_values),
-            smart_str(obj.stage_restart_count),
-            smart_str(obj.current_stage),
-            smart_str(obj.result_value),
-            smart_str(obj.result_confidence),
-            smart_str(obj.stage_results),
-        ])
-    return response
+def export_experiments_csv(modeladmin, request, queryset):
+    return streaming_csv_response('ExperimentData.csv', EXPERIMENT_CSV_COLUMNS, queryset)
 export_experiments_csv.short_description = u"Export to CSV"
 
 
 @register(Experiment)
-class ExperimentAdmin(admin.ModelAdmin):
+class ExperimentAdmin(LargeTableAdmin):
     actions = ('download_json',)
     list_display = ('user', 'experiment_type', 'start_time', 'end_time', 'is_active', 'is_cancelled')
-    list_filter = ('user',)
+    list_filter = (selected_only_filter('user', User), 'is_active')
+    list_select_related = ('user',)
+    search_fields = ('=key', '^user__username')
     # actions = [export_experiments_csv]
 
     def download_json(self, request, experiments):
-
-        today = datetime.date.today()
-
-        data = [dict(user=experiment.user.username,
-                     stage_data=[experiment.get_stage_data(stage, False) for stage in range(0, 4)],
-                     all_data=experiment.get_all_data(),
-                     stage_targets=experiment.get_stage_targets(),
-                     stage_dates=simplejson.loads(experiment.stage_dates),
-                     **experiment.to_dict()) for experiment in experiments if experiment.get_experiment_type()]
-
-        response = HttpResponse(simplejson.dumps(data, cls=DateTimeEncoder, indent=2), content_type='text/json')
+        response = StreamingHttpResponse(experiments_json(experiments), content_type='text/json')
         response['Content-Disposition'] = 'attachment; filename=experiments.json'
         return response
     download_json.short_description = "Download JSON file for selected experiments."
 
 
 @register(Checkin)
-class CheckinAdmin(admin.ModelAdmin):
+class CheckinAdmin(LargeTableAdmin):
     list_display = ('user', 'experiment', 'checkin_time', 'did_follow_instructions', 'happiness', 'stress', 'productivity', 'leisure_time', 'app_version')
-    list_filter = ('experiment',)
+    list_filter = (selected_only_filter('experiment', Experiment),)
+    search_fields = ('=key', '=experiment__key', '^experiment__user__username')
     list_select_related = (
             'experiment__user',
         )
@@ -196,93 +187,92 @@ class CheckinAdmin(admin.ModelAdmin):
         return obj.experiment.user
 
     def export_checkins_csv(modeladmin, request, queryset):
-        import csv
-        from django.utils.encoding import smart_str
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=CheckinData.csv'
-        writer = csv.writer(response, csv.excel)
-        response.write(u'\ufeff'.encode('utf8'))  # BOM (optional...Excel needs it to open UTF-8 file properly)
-        writer.writerow([
-            smart_str(u"ID"),
-            smart_str(u"Key"),
-            smart_str(u"ExperimentKey"),
-            smart_str(u"CheckinTime"),
-            smart_str(u"DidFollowInstructions"),
-            smart_str(u"Happiness"),
-            smart_str(u"Stress"),
-            smart_str(u"Productivity"),
-            smart_str(u"LeisureTime"),
-            smart_str(u"AppVersion"),
-        ])
-        for obj in queryset:
-            writer.writerow([
-                smart_str(obj.pk),
-                smart_str(obj.key),
-                smart_str(obj.experiment),
-                smart_str(obj.checkin_time),
-                smart_str(obj.did_follow_instructions),
-                smart_str(obj.happiness),
-                smart_str(obj.stress),
-                smart_str(obj.productivity),
-                smart_str(obj.leisure_time),
-                smart_str(obj.app_version),
-            ])
-        return response
+        return streaming_csv_response('CheckinData.csv', CHECKIN_CSV_COLUMNS, queryset)
     export_checkins_csv.short_description = u"Export to CSV"
 
     actions=[export_checkins_csv]
 
-def export_jawbone_measurements_csv(modeladmin,request, queryset):
-    import csv
-    from django.utils.encoding import smart_str
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=JawboneMeasurementData.csv'
-    writer = csv.writer(response, csv.excel)
-    response.write(u'\ufeff'.encode('utf8')) # BOM (optional...Excel needs it to open UTF-8 file properly)
-    writer.writerow([
-        smart_str(u"ID"),
-        smart_str(u"User"),
-        smart_str(u"Type"),
-        smart_str(u"StartTime"),
-        smart_str(u"EndTime"),
-        smart_str(u"JawboneID"),
-        smart_str(u"JawboneTimezone"),
-        smart_str(u"JawboneDateString"),
-        smart_str(u"Latitude"),
-        smart_str(u"Longitude"),
-        smart_str(u"Duration"),
-        smart_str(u"Steps"),
-        smart_str(u"Distance"),
-        smart_str(u"AwakeTime"),
-        smart_str(u"RawJawboneObject"),
-    ])
-    for obj in queryset:
-        writer.writerow([
-            smart_str(obj.pk),
-            smart_str(obj.user),
-            smart_str(obj.type),
-            smart_str(obj.start_time),
-            smart_str(obj.end_time),
-            smart_str(obj.jawbone_id),
-            smart_str(obj.jawbone_timezone),
-            smart_str(obj.jawbone_datestring),
-            smart_str(obj.latitude),
-            smart_str(obj.longitude),
-            smart_str(obj.duration),
-            smart_str(obj.steps),
-            smart_str(obj.distance),
-            smart_str(obj.awake_time),
-            smart_str(obj.raw_jawbone_object),
-        ])
-    return response
+
+def export_jawbone_measurements_csv(modeladmin, request, queryset):
+    return streaming_csv_response('JawboneMeasurementData.csv', JAWBONE_MEASUREMENT_CSV_COLUMNS, queryset)
 export_jawbone_measurements_csv.short_description = u"Export to CSV"
 
 
 @register(JawboneMeasurement)
-class JawboneMeasurementAdmin(admin.ModelAdmin):
+class JawboneMeasurementAdmin(LargeTableAdmin):
     list_display = ('user', 'type', 'jawbone_id', 'start_time', 'end_time', 'duration')
-    list_filter = ('user',)
+    list_filter = (selected_only_filter('user', User),)
+    list_select_related = ('user',)
+    search_fields = ('=jawbone_id', '^user__username')
     actions = [export_jawbone_measurements_csv]
 
 
+@register(ProfiledUser)
+class ProfiledUserAdmin(admin.ModelAdmin):
+    list_display = ('user', 'sample_rate', 'date_created')
+    raw_id_fields = ('user',)
+
+
+@register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('date_created', 'path', 'view', 'user', 'reason', 'duration', 'size', 'download_link')
+    list_filter = ('reason', 'view')
+    list_select_related = ('user',)
+    readonly_fields = ('user', 'path', 'view', 'reason', 'duration', 'size', 'filename', 'date_created')
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            url(r'^(\d+)/download/$', self.admin_site.admin_view(self.download), name='app_requestprofile_download'),
+        ] + super(RequestProfileAdmin, self).get_urls()
 
+    def download_link(self, obj):
+        return format_html('<a href="{}">{}</a>', reverse('admin:app_requestprofile_download', args=(obj.id,)), obj.filename)
+    download_link.short_description = "Stats"
+
+    def download(self, request, profile_id):
+        profile = self.get_object(request, profile_id)
+        if profile is None or not os.path.exists(profile.get_path()):
+            raise Http404
+        response = FileResponse(open(profile.get_path(), 'rb'), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename=%s' % profile.filename
+        return response
+
+
+@register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'date_created', 'requested_by', 'status', 'progress', 'message', 'download_link')
+    list_filter = ('status',)
+    list_select_related = ('requested_by',)
+    raw_id_fields = ('users',)
+    fields = ('users', 'status', 'progress', 'message', 'download_link', 'requested_by', 'date_created', 'date_started',
+              'date_finished')
+    readonly_fields = ('status', 'progress', 'message', 'download_link', 'requested_by', 'date_created', 'date_started',
+                       'date_finished')
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.requested_by = request.user
+        super(ExportJobAdmin, self).save_model(request, obj, form, change)
+
+    def get_urls(self):
+        return [
+            url(r'^(\d+)/download/$', self.admin_site.admin_view(self.download), name='app_exportjob_download'),
+        ] + super(ExportJobAdmin, self).get_urls()
+
+    def download_link(self, obj):
+        if obj.status != ExportJob.DONE:
+            return ""
+        return format_html('<a href="{}">{}</a>', reverse('admin:app_exportjob_download', args=(obj.id,)),
+                           os.path.basename(obj.archive))
+    download_link.short_description = "Archive"
+
+    def download(self, request, job_id):
+        job = self.get_object(request, job_id)
+        if job is None or job.status != ExportJob.DONE or not os.path.exists(job.get_path()):
+            raise Http404
+        response = FileResponse(open(job.get_path(), 'rb'), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(job.archive)
+        return response
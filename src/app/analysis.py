@@ -85,19 +85,16 @@ class ExperimentType(object):
         :param attr:
         :return:
         '''
-        checkins = sorted(experiment.checkins.all(), key=lambda c: c.checkin_time)
+        # local_day is already the day the checkin asks about, so the first checkin of each day wins
+        checkins = experiment.get_checkins(start_date, end_date)
+        values_by_day = dict()
+        for checkin in checkins:
+            values_by_day.setdefault(checkin.local_day, getattr(checkin, attr))
+
         results = []
         date = start_date
         while date < end_date:
-            found = False
-            for checkin in checkins:
-                # we ask about yesterday's stuff, so we want the checkin for the day after we're interested in
-                if experiment.localize(checkin.checkin_time).date() == date + datetime.timedelta(days=1):
-                    results.append(getattr(checkin, attr))
-                    found = True
-                    break
-            if not found:
-                results.append(None)
+            results.append(values_by_day.get(date))
             date += datetime.timedelta(days=1)
 
         return results
@@ -190,16 +187,12 @@ class ExperimentType(object):
         :param end_date: exclusive
         :return:
         '''
-        events = experiment.get_jawbone_events("moves", start_date, end_date)
+        events = experiment.get_jawbone_events_by_day("moves", start_date, end_date)
         date = start_date
         durations = []
         while date < end_date:
-            duration = 0
-            for event in events:
-                if date == experiment.localize(event.start_time).date():
-                    duration = event.duration
-                    break
-            durations.append(duration)
+            event = events.get(date)
+            durations.append(event.duration if event else 0)
             date += datetime.timedelta(days=1)
         return durations
 
@@ -212,16 +205,12 @@ class ExperimentType(object):
         :param end_date: exclusive
         :return:
         '''
-        events = experiment.get_jawbone_events("moves", start_date, end_date)
+        events = experiment.get_jawbone_events_by_day("moves", start_date, end_date)
         date = start_date
         totals = []
         while date < end_date:
-            total = 0
-            for event in events:
-                if date == experiment.localize(event.start_time).date():
-                    total = event.steps
-                    break
-            totals.append(total)
+            event = events.get(date)
+            totals.append(event.steps if event else 0)
             date += datetime.timedelta(days=1)
         return totals
 
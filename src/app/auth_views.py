@@ -8,6 +8,7 @@ from django.contrib.auth import authenticate
 
 from .models import User
 from .decorators import app_view
+from .authentication import token_cache
 
 
 class AuthTokenSerializer(serializers.Serializer):
@@ -59,11 +60,14 @@ class ObtainExpiringAuthToken(ObtainAuthToken):
 
             if token.expired():
                 # If the token is expired, generate a new one.
+                token_cache.delete(token.key)
                 token.delete()
                 token = ExpiringToken.objects.create(
                     user=serializer.validated_data['user']
                 )
 
+            # the app uses the token straight away, so don't make its first request go to the database
+            token_cache.add(token)
             data = {'token': token.key}
             return Response(data)
 
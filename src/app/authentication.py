@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import router
+from django.db.models.signals import post_save, post_delete
+from rest_framework import exceptions
+from rest_framework.authentication import get_authorization_header
+
+from rest_framework_expiring_authtoken.authentication import ExpiringTokenAuthentication
+from rest_framework_expiring_authtoken.models import ExpiringToken
+
+from project.process_cache import ProcessCache
+
+from .models import User
+
+
+class TokenCache(ProcessCache):
+    '''
+    Tokens this process has already verified, as key -> (user id, token creation time), for AUTH_TOKEN_CACHE_TIMEOUT.
+    Deleting a token that hasn't expired, or deactivating a user, invalidates it in every process. Token expiry is
+    always checked against the cached creation time.
+    '''
+    version_key = "auth_token_cache_version"
+
+    def get_timeout(self):
+        return settings.AUTH_TOKEN_CACHE_TIMEOUT
+
+    def get_size(self):
+        return settings.AUTH_TOKEN_CACHE_SIZE
+
+    def add(self, token):
+        self.set(token.key, (token.user_id, token.created))
+
+
+token_cache = TokenCache()
+
+
+def token_deleted(sender, instance, **kwargs):
+    # an expired token is turned down anyway
+    if not instance.expired():
+        token_cache.invalidate()
+
+post_delete.connect(token_deleted, sender=ExpiringToken, dispatch_uid="app_token_deleted")
+
+
+def user_saved(sender, instance, **kwargs):
+    if not instance.is_active:
+        token_cache.invalidate()
+
+post_save.connect(user_saved, sender=User, dispatch_uid="app_user_saved")
+
+
+def get_cached_user_id(request):
+    '''
+    :return: the id of the user whose token the request carries, if this process has the token cached, otherwise None.
+    Doesn't check the token's expiry or touch the database.
+    '''
+    auth = get_authorization_header(request).split()
+    if len(auth) != 2 or auth[0].lower() != b"token":
+        return None
+    cached = token_cache.get(auth[1].decode("latin-1"))
+    return cached[0] if cached else None
+
+
+class CachedExpiringTokenAuthentication(ExpiringTokenAuthentication):
+    '''
+    ExpiringTokenAuthentication without the database on a cache hit. The user it returns only has its id loaded; the
+    rest of the row is loaded the first time a view reads it (see User.refresh_from_db).
+    '''
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            return self._authenticate_from_db(key)
+
+        user_id, created = cached
+        token = ExpiringToken(key=key, user_id=user_id, created=created)
+        if token.expired():
+            token_cache.delete(key)
+            raise exceptions.AuthenticationFailed('Token has expired')
+
+        user = User.from_db(router.db_for_read(User), ["id"], [user_id])
+        token.user = user
+        return user, token
+
+    def _authenticate_from_db(self, key):
+        try:
+            token = ExpiringToken.objects.select_related('user').get(key=key)
+        except ExpiringToken.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token')
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted')
+
+        if token.expired():
+            raise exceptions.AuthenticationFailed('Token has expired')
+
+        token_cache.add(token)
+        return token.user, token
@@ -0,0 +1,110 @@
+'''
+The cohort dashboard at /admin/cohorts/: how each experiment type's experiments are doing, from the ExperimentStats
+rollup rather than from checkins and measurements. manage.py refresh_experiment_stats keeps the rollup current,
+recomputing only experiments whose data changed and active ones that haven't been looked at in a while.
+'''
+
+import datetime, simplejson
+
+from django.conf import settings
+from django.db.models import Q, F, Count, Sum, Max, Case, When, IntegerField
+from django.shortcuts import render
+from django.utils import timezone
+
+from .exports import iterate_in_batches, DOWNLOAD_JSON_BATCH_SIZE
+from .models import Experiment, ExperimentStats, NUM_STAGES
+
+CONFIDENCE_BUCKETS = 10
+
+
+def get_stats(experiment):
+    '''
+    :return: an unsaved ExperimentStats for experiment, which should be preloaded
+    '''
+    stats = ExperimentStats(experiment=experiment, experiment_type=experiment.experiment_type,
+                            is_active=experiment.is_active, is_cancelled=experiment.is_cancelled,
+                            current_stage=experiment.current_stage,
+                            restart_count=sum(simplejson.loads(experiment.stage_restart_count)),
+                            result_value=experiment.result_value, result_confidence=experiment.result_confidence,
+                            data_version=experiment.data_version)
+    data = experiment.get_all_data()
+    if data["inputs"]:
+        start_date, end_date = data["inputs"][0][0], data["inputs"][-1][0] + datetime.timedelta(days=1)
+        stats.days = len(data["inputs"])
+        stats.checkin_days = len(set(checkin.local_day for checkin in experiment.get_checkins(start_date, end_date)))
+        stats.missed_days = sum(1 for (_, i), (_, o) in zip(data["inputs"], data["outputs"]) if i is None or o is None)
+    return stats
+
+
+def get_stale_experiments():
+    '''
+    Experiments without stats, whose data changed since, or that are active and haven't been refreshed for
+    settings.EXPERIMENT_STATS_MAX_AGE, since their missed days keep adding up without new data
+    '''
+    cutoff = timezone.now() - settings.EXPERIMENT_STATS_MAX_AGE
+    return Experiment.objects.filter(Q(stats__isnull=True) | Q(stats__data_version__lt=F("data_version")) |
+                                     Q(is_active=True, stats__date_updated__lt=cutoff))
+
+
+def refresh_experiment_stats(experiments=None):
+    '''
+    :return: number of experiments refreshed
+    '''
+    experiments = get_stale_experiments() if experiments is None else experiments
+    count = 0
+    for batch in iterate_in_batches(experiments.select_related("user"), DOWNLOAD_JSON_BATCH_SIZE):
+        Experiment.preload(batch)
+        for experiment in batch:
+            if not experiment.get_experiment_type():
+                continue
+            get_stats(experiment).save()
+            count += 1
+    return count
+
+
+def get_dashboard():
+    '''
+    :return: list of dicts with each experiment type's figures, from a handful of aggregate queries on ExperimentStats
+    '''
+    def count_if(**kwargs):
+        return Sum(Case(When(then=1, **kwargs), default=0, output_field=IntegerField()))
+
+    cohorts = dict()
+    for row in ExperimentStats.objects.values("experiment_type").annotate(
+            experiments=Count("pk"), active=count_if(is_active=True), cancelled=count_if(is_cancelled=True),
+            finished=count_if(is_active=False, is_cancelled=False), restarts=Sum("restart_count"), days=Sum("days"),
+            checkin_days=Sum("checkin_days"), missed_days=Sum("missed_days")):
+        days = row["days"] or 0
+        row.update(name=row["experiment_type"],
+                   restart_rate=float(row["restarts"] or 0) / row["experiments"],
+                   checkin_rate=float(row["checkin_days"]) / days if days else None,
+                   missed_rate=float(row["missed_days"]) / days if days else None,
+                   stages=[0] * (NUM_STAGES + 1),
+                   results=[],
+                   confidences=[0] * CONFIDENCE_BUCKETS)
+        cohorts[row["experiment_type"]] = row
+
+    for row in ExperimentStats.objects.filter(is_active=True).values("experiment_type", "current_stage").annotate(count=Count("pk")):
+        if 0 <= row["current_stage"] <= NUM_STAGES:
+            cohorts[row["experiment_type"]]["stages"][row["current_stage"]] += row["count"]
+
+    finished = ExperimentStats.objects.filter(is_active=False, is_cancelled=False)
+    for row in finished.values("experiment_type", "result_value").annotate(count=Count("pk")).order_by("experiment_type", "result_value"):
+        cohorts[row["experiment_type"]]["results"].append((row["result_value"], row["count"]))
+    for row in finished.values("experiment_type", "result_confidence").annotate(count=Count("pk")):
+        bucket = min(int(row["result_confidence"] * CONFIDENCE_BUCKETS), CONFIDENCE_BUCKETS - 1)
+        cohorts[row["experiment_type"]]["confidences"][bucket] += row["count"]
+
+    for cohort in cohorts.values():
+        cohort["confidences"] = [("%.1f-%.1f" % (float(index) / CONFIDENCE_BUCKETS, float(index + 1) / CONFIDENCE_BUCKETS), count)
+                                 for index, count in enumerate(cohort["confidences"])]
+    return [cohorts[name] for name in sorted(cohorts)]
+
+
+def cohort_dashboard_view(request):
+    return render(request, "admin/cohort_dashboard.html", dict(
+        title="Cohorts",
+        cohorts=get_dashboard(),
+        stages=range(NUM_STAGES + 1),
+        updated=ExperimentStats.objects.aggregate(updated=Max("date_updated"))["updated"],
+    ))
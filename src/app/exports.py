@@ -0,0 +1,469 @@
+'''
+Research exports, shared by the admin actions that stream them and by ExportJob, which builds them in the background
+(manage.py run_export_jobs) as a zip in MEDIA_ROOT.
+'''
+
+import array, csv, datetime, glob, mmap, os, shutil, struct, sys, tempfile, time, uuid, zipfile
+import simplejson
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import smart_str
+
+from .models import User, Experiment, JawboneMeasurement, Checkin, ExportJob, NUM_STAGES
+
+EXPORT_CHUNK_SIZE = 2000
+# experiments per batch in experiments_json, which holds all of their users' checkins and measurements in memory at once
+DOWNLOAD_JSON_BATCH_SIZE = 50
+# how often a running ExportJob reports how far it has got
+PROGRESS_EVERY_ROWS = 10000
+
+USER_CSV_COLUMNS = (
+    ("ID", "pk"),
+    ("User", "username"),
+    ("JawboneAccessToken", "jawbone_access_token"),
+    ("JawboneResetToken", "jawbone_reset_token"),
+    ("JawboneUserID", "jawbone_user_id"),
+    ("DateOfBirth", "date_of_birth"),
+    ("Race", "race"),
+    ("Gender", "gender"),
+    ("Happy", "happy"),
+    ("Stress", "stress"),
+    ("Activity", "activity"),
+    ("SleepQuality", "sleep_quality"),
+    ("Timezone", "timezone"),
+)
+
+EXPERIMENT_CSV_COLUMNS = (
+    ("ID", "pk"),
+    ("User", "user__username"),
+    ("Key", "key"),
+    ("ExperimentType", "experiment_type"),
+    ("StartTime", "start_time"),
+    ("EndTime", "end_time"),
+    ("SelfEfficacy", "self_efficacy"),
+    ("AppEfficacy", "app_efficacy"),
+    ("ExperientEfficacy", "experiment_efficacy"),
+    ("IsActive", "is_active"),
+    ("IsCancelled", "is_cancelled"),
+    ("CancelReason", "cancel_reason"),
+    ("InitialStageAverage", "initial_stage_average"),
+    ("StageDates", "stage_dates"),
+    ("StageTargetValues", "stage_target_values"),
+    ("StageRestartCount", "stage_restart_count"),
+    ("CurrentStage", "current_stage"),
+    ("ResultValue", "result_value"),
+    ("ResultConfidence", "result_confidence"),
+    ("StageResults", "stage_results"),
+)
+
+CHECKIN_CSV_COLUMNS = (
+    ("ID", "pk"),
+    ("Key", "key"),
+    ("ExperimentKey", "experiment__key"),
+    ("CheckinTime", "checkin_time"),
+    ("DidFollowInstructions", "did_follow_instructions"),
+    ("Happiness", "happiness"),
+    ("Stress", "stress"),
+    ("Productivity", "productivity"),
+    ("LeisureTime", "leisure_time"),
+    ("AppVersion", "app_version"),
+)
+
+JAWBONE_MEASUREMENT_CSV_COLUMNS = (
+    ("ID", "pk"),
+    ("User", "user__username"),
+    ("Type", "type"),
+    ("StartTime", "start_time"),
+    ("EndTime", "end_time"),
+    ("JawboneID", "jawbone_id"),
+    ("JawboneTimezone", "jawbone_timezone"),
+    ("JawboneDateString", "jawbone_datestring"),
+    ("Latitude", "latitude"),
+    ("Longitude", "longitude"),
+    ("Duration", "duration"),
+    ("Steps", "steps"),
+    ("Distance", "distance"),
+    ("AwakeTime", "awake_time"),
+    ("RawJawboneObject", "raw_jawbone_object"),
+)
+
+
+class Echo(object):
+    '''
+    Lets csv.writer hand back each row it formats, instead of writing it somewhere
+    '''
+    def write(self, value):
+        return value
+
+
+class DateTimeEncoder(simplejson.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+
+        return simplejson.JSONEncoder.default(self, o)
+
+
+def iterate_in_chunks(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    values_list rows of queryset in id order, fetched chunk_size rows at a time so memory doesn't grow with the table.
+    fields has to start with 'pk'.
+    '''
+    queryset = queryset.order_by('pk').values_list(*fields)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        count = 0
+        for row in chunk[:chunk_size].iterator():
+            count += 1
+            last_pk = row[0]
+            yield row
+        if count < chunk_size:
+            break
+
+
+def iterate_in_batches(queryset, batch_size=EXPORT_CHUNK_SIZE):
+    '''
+    Lists of at most batch_size objects from queryset, in id order, one query per batch
+    '''
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            break
+        last_pk = batch[-1].pk
+
+
+def csv_lines(columns, queryset):
+    '''
+    :param columns: (header, field) pairs, starting with the pk
+    :return: the lines of a CSV file of queryset, as utf8 strings
+    '''
+    header, fields = zip(*columns)
+    writer = csv.writer(Echo(), csv.excel)
+    yield u'\ufeff'.encode('utf8')  # BOM (optional...Excel needs it to open UTF-8 file properly)
+    yield writer.writerow([smart_str(column) for column in header])
+    for row in iterate_in_chunks(queryset, fields):
+        yield writer.writerow([smart_str(value) for value in row])
+
+
+def experiments_json(experiments):
+    '''
+    :return: the pieces of a JSON list with every experiment's stage data, all of its data and its settings
+    '''
+    separator = "[\n"
+    for batch in iterate_in_batches(experiments.select_related('user'), DOWNLOAD_JSON_BATCH_SIZE):
+        Experiment.preload(batch)
+        for experiment in batch:
+            if not experiment.get_experiment_type():
+                continue
+            experiment.cache_stage_data()
+            data = dict(user=experiment.user.username,
+                        stage_data=[experiment.get_stage_data(stage, False) for stage in range(0, 4)],
+                        all_data=experiment.get_all_data(),
+                        stage_targets=experiment.get_stage_targets(),
+                        stage_dates=simplejson.loads(experiment.stage_dates),
+                        **experiment.to_dict())
+            yield separator + simplejson.dumps(data, cls=DateTimeEncoder, indent=2)
+            separator = ",\n"
+    yield "[]" if separator == "[\n" else "\n]"
+
+
+
+##########################################################################################
+# Daily arrays
+
+DAILY_ARRAYS_MAGIC = "EXPDAYS1"
+DAILY_ARRAYS_VERSION = 1
+NO_STAGE = -1
+
+
+def get_daily_arrays(experiment):
+    '''
+    :return: the experiment's inputs and outputs for each day since it started (None where there's no data), and for
+    each stage its [first, last + 1) day, its target and how often it was restarted
+    '''
+    data = experiment.get_all_data()
+    start_date = experiment.localize(experiment.start_time).date()
+    bounds = []
+    for stage in xrange(NUM_STAGES + 1):
+        stage_start, stage_end = experiment.get_stage_dates(stage)
+        bounds.append(((stage_start - start_date).days, (stage_end - start_date).days) if stage_start else (NO_STAGE, NO_STAGE))
+    return dict(inputs=[value for _, value in data["inputs"]],
+                outputs=[value for _, value in data["outputs"]],
+                stage_bounds=bounds,
+                targets=experiment.get_stage_targets(),
+                restart_counts=simplejson.loads(experiment.stage_restart_count))
+
+
+def write_daily_arrays(experiments, f):
+    '''
+    Writes the daily data of experiments of one type as a JSON header followed by fixed-width little-endian arrays, one
+    row per experiment. The daily arrays have one column per day since the experiment started, padded past its last day
+    with NaN, or -1 for stage. The header gives each array's dtype, shape and offset in the file, so it maps straight
+    into numpy:
+
+        header = read_daily_arrays_header(path)
+        a = header["arrays"]["inputs"]
+        inputs = numpy.memmap(path, dtype=a["dtype"], mode="r", offset=a["offset"], shape=tuple(a["shape"]))
+
+    Arrays are inputs and outputs (f8, experiments x days), stage (i1, experiments x days, -1 outside every stage),
+    stage_bounds (i4, experiments x stages x 2, first and last + 1 day, -1 for stages not reached), targets (f8,
+    experiments x stages, NaN for stages without one) and restart_counts (i4, experiments x stages, 0 for stages not
+    reached).
+    '''
+    rows, keys, users, start_dates = [], [], [], []
+    experiment_types = set()
+    for batch in iterate_in_batches(experiments.select_related('user'), DOWNLOAD_JSON_BATCH_SIZE):
+        Experiment.preload(batch)
+        for experiment in batch:
+            if not experiment.get_experiment_type():
+                continue
+            experiment_types.add(experiment.experiment_type)
+            rows.append(get_daily_arrays(experiment))
+            keys.append(experiment.key)
+            users.append(experiment.user.username)
+            start_dates.append(experiment.localize(experiment.start_time).date().isoformat())
+
+    num_days = max([len(row["inputs"]) for row in rows] or [0])
+    num_stages = NUM_STAGES + 1
+    nan = float("nan")
+
+    def values(row_values, length, missing):
+        values = [missing if value is None else value for value in row_values]
+        return values + [missing] * (length - len(values))
+
+    def stages(row):
+        days = [NO_STAGE] * num_days
+        for stage, (first, last) in enumerate(row["stage_bounds"]):
+            for day in xrange(max(first, 0), min(last, num_days)):
+                days[day] = stage
+        return days
+
+    arrays = [
+        ("inputs", "d", "<f8", (num_days,), lambda row: values(row["inputs"], num_days, nan)),
+        ("outputs", "d", "<f8", (num_days,), lambda row: values(row["outputs"], num_days, nan)),
+        ("stage", "b", "|i1", (num_days,), stages),
+        ("stage_bounds", "i", "<i4", (num_stages, 2), lambda row: [day for bounds in row["stage_bounds"] for day in bounds]),
+        ("targets", "d", "<f8", (num_stages,), lambda row: values(row["targets"], num_stages, nan)),
+        ("restart_counts", "i", "<i4", (num_stages,), lambda row: values(row["restart_counts"], num_stages, 0)),
+    ]
+
+    data = []
+    for name, typecode, dtype, shape, get_values in arrays:
+        values_array = array.array(typecode)
+        for row in rows:
+            values_array.extend(get_values(row))
+        if sys.byteorder == "big":
+            values_array.byteswap()
+        data.append((name, dtype, [len(rows)] + list(shape), values_array))
+
+    def padding(size):
+        return -size % 8
+
+    # the header is padded so every array starts 8-byte aligned, and its offsets count from the start of the file
+    header_size = 0
+    while True:
+        layout = dict()
+        offset = header_size
+        for name, dtype, shape, values_array in data:
+            layout[name] = dict(dtype=dtype, shape=shape, offset=offset)
+            offset += len(values_array) * values_array.itemsize
+            offset += padding(offset)
+        header = simplejson.dumps(dict(version=DAILY_ARRAYS_VERSION, experiment_types=sorted(experiment_types),
+                                       num_stages=num_stages, keys=keys, users=users, start_dates=start_dates, arrays=layout))
+        size = len(DAILY_ARRAYS_MAGIC) + 4 + len(header)
+        size += padding(size)
+        if size <= header_size:
+            break
+        header_size = size
+
+    f.write(DAILY_ARRAYS_MAGIC + struct.pack("<I", header_size))
+    f.write(header.ljust(header_size - len(DAILY_ARRAYS_MAGIC) - 4))
+    for name, dtype, shape, values_array in data:
+        size = len(values_array) * values_array.itemsize
+        f.write(values_array.tostring())
+        f.write("\0" * padding(size))
+
+
+def read_daily_arrays_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(DAILY_ARRAYS_MAGIC)) != DAILY_ARRAYS_MAGIC:
+            raise ValueError("%s is not a daily arrays file" % path)
+        header_size, = struct.unpack("<I", f.read(4))
+        return simplejson.loads(f.read(header_size - len(DAILY_ARRAYS_MAGIC) - 4))
+
+
+def read_daily_arrays(path):
+    '''
+    For when numpy isn't around
+    :return: header, dict of array name -> flat array.array
+    '''
+    typecodes = {"<f8": "d", "|i1": "b", "<i4": "i"}
+    header = read_daily_arrays_header(path)
+    arrays = dict()
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for name, layout in header["arrays"].items():
+                values = array.array(typecodes[layout["dtype"]])
+                size = reduce(lambda a, b: a * b, layout["shape"], values.itemsize)
+                values.fromstring(mapped[layout["offset"]:layout["offset"] + size])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                arrays[name] = values
+        finally:
+            mapped.close()
+    return header, arrays
+
+
+##########################################################################################
+# Background jobs
+
+def claim_job():
+    '''
+    :return: the oldest pending ExportJob, now marked running, or None if there isn't one or settings.EXPORT_JOB_CONCURRENCY
+    jobs are running already. Locks the pending and running jobs while it decides, so two workers can't both claim the
+    last free place.
+    '''
+    with transaction.atomic():
+        jobs = list(ExportJob.objects.select_for_update().filter(status__in=(ExportJob.PENDING, ExportJob.RUNNING)).order_by("id"))
+        if sum(1 for job in jobs if job.status == ExportJob.RUNNING) >= settings.EXPORT_JOB_CONCURRENCY:
+            return None
+        pending = [job for job in jobs if job.status == ExportJob.PENDING]
+        if not pending:
+            return None
+
+        job = pending[0]
+        job.status = ExportJob.RUNNING
+        job.date_started = timezone.now()
+        job.save()
+        return job
+
+
+def run_job(job):
+    '''
+    Builds the job's archive. If fail_stuck_jobs gave up on the job meanwhile, it stays failed and the archive is deleted.
+    '''
+    try:
+        fields = dict(archive=build_archive(job), status=ExportJob.DONE, progress=100, message="")
+    except Exception as e:
+        fields = dict(status=ExportJob.FAILED, message="%s: %s" % (type(e).__name__, e))
+    fields["date_finished"] = timezone.now()
+
+    # an update rather than save, so a job marked failed isn't turned back into a done one
+    if ExportJob.objects.filter(id=job.id, status=ExportJob.RUNNING).update(**fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+    else:
+        job.refresh_from_db()
+        if fields.get("archive"):
+            os.remove(os.path.join(settings.MEDIA_ROOT, fields["archive"]))
+
+
+def build_archive(job):
+    '''
+    Writes each export to a temporary file and adds it to the zip, so only a chunk of rows is in memory at a time.
+    :return: the path of the zip, relative to MEDIA_ROOT
+    '''
+    user_ids = list(job.users.values_list("id", flat=True))
+    users = User.objects.filter(id__in=user_ids) if user_ids else User.objects.all()
+    experiments = Experiment.objects.filter(user__in=users)
+    files = [
+        ("users.csv", csv_lines(USER_CSV_COLUMNS, users)),
+        ("experiments.csv", csv_lines(EXPERIMENT_CSV_COLUMNS, experiments)),
+        ("checkins.csv", csv_lines(CHECKIN_CSV_COLUMNS, Checkin.objects.filter(experiment__in=experiments))),
+        ("jawbone_measurements.csv", csv_lines(JAWBONE_MEASUREMENT_CSV_COLUMNS, JawboneMeasurement.objects.filter(user__in=users))),
+        ("experiments.json", experiments_json(experiments)),
+    ]
+
+    archive = os.path.join(ExportJob.ARCHIVE_DIR, "export-%d-%s.zip" % (job.id, uuid.uuid4().hex))
+    path = os.path.join(settings.MEDIA_ROOT, archive)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    experiment_types = sorted(set(experiments.values_list("experiment_type", flat=True)))
+    steps = len(files) + len(experiment_types)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with zipfile.ZipFile(path + ".part", "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zip_file:
+            for i, (name, lines) in enumerate(files):
+                temp_path = os.path.join(temp_dir, name)
+                with open(temp_path, "wb") as f:
+                    for count, line in enumerate(lines):
+                        if count % PROGRESS_EVERY_ROWS == 0:
+                            job.set_progress(100 * i / steps, "Writing %s, %d rows so far" % (name, count))
+                        f.write(line)
+                zip_file.write(temp_path, name)
+                os.remove(temp_path)
+
+            for i, experiment_type in enumerate(experiment_types, len(files)):
+                name = "daily-%s.bin" % experiment_type
+                job.set_progress(100 * i / steps, "Writing %s" % name)
+                temp_path = os.path.join(temp_dir, name)
+                with open(temp_path, "wb") as f:
+                    write_daily_arrays(experiments.filter(experiment_type=experiment_type), f)
+                zip_file.write(temp_path, name)
+                os.remove(temp_path)
+        os.rename(path + ".part", path)
+    except Exception:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        raise
+    finally:
+        shutil.rmtree(temp_dir)
+    return archive
+
+
+def run_pending_jobs():
+    '''
+    Runs pending jobs one after another until there are none this worker may take
+    :return: number of jobs run
+    '''
+    count = 0
+    job = claim_job()
+    while job is not None:
+        run_job(job)
+        count += 1
+        job = claim_job()
+    return count
+
+
+def fail_stuck_jobs():
+    '''
+    Jobs whose worker died while running them would hold their place forever
+    '''
+    cutoff = timezone.now() - settings.EXPORT_JOB_TIMEOUT
+    return ExportJob.objects.filter(status=ExportJob.RUNNING, date_started__lt=cutoff).update(
+        status=ExportJob.FAILED, message="Timed out", date_finished=timezone.now())
+
+
+def expire_jobs():
+    '''
+    Deletes the archives of jobs that finished more than settings.EXPORT_JOB_LIFESPAN ago, and the partial archives of
+    builds that died, which haven't been written to for settings.EXPORT_JOB_TIMEOUT
+    '''
+    cutoff = timezone.now() - settings.EXPORT_JOB_LIFESPAN
+    jobs = ExportJob.objects.filter(status=ExportJob.DONE, date_finished__lt=cutoff)
+    for job in jobs:
+        job.delete_archive()
+        job.status = ExportJob.EXPIRED
+        job.save()
+
+    archive_dir = os.path.join(settings.MEDIA_ROOT, ExportJob.ARCHIVE_DIR)
+    stuck_cutoff = time.time() - settings.EXPORT_JOB_TIMEOUT.total_seconds()
+    for path in glob.glob(os.path.join(archive_dir, "*.part")):
+        try:
+            if os.path.getmtime(path) < stuck_cutoff:
+                os.remove(path)
+        except OSError:
+            pass  # finished or removed meanwhile
+    return len(jobs)
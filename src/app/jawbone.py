@@ -2,7 +2,7 @@ import requests, datetime, pytz, simplejson
 from decimal import Decimal
 from django.db import transaction
 
-from models import JawboneMeasurement
+from models import JawboneMeasurement, Experiment
 
 
 class JawboneEvent(object):
@@ -129,6 +129,8 @@ def _save_jawbone_to_db(user, activity_type, items):
 
     JawboneMeasurement.objects.bulk_create(new_measurements)
 
+    Experiment.data_changed_for_user(user)
+
 
 def get_user_id(user):
 
@@ -0,0 +1,57 @@
+import gc, time
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
+
+
+@csrf_exempt
+def api_view(request):
+    return HttpResponse()
+
+
+def admin_view(request):
+    return HttpResponse()
+
+
+class Command(BaseCommand):
+    help = ("Times MIDDLEWARE_CLASSES on an API request and an admin request, against the same stack with the full "
+            "middleware in place of the WebOnly versions. The views do nothing, so this is the middleware alone.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        lean = [import_string(path) for path in settings.MIDDLEWARE_CLASSES]
+        full = [getattr(middleware_class, "full_middleware", middleware_class) for middleware_class in lean]
+
+        factory = RequestFactory()
+        for path, view in (("/get_experiments/", api_view), ("/admin/", admin_view)):
+            timings = []
+            for middleware_classes in (full, lean):
+                middleware = [middleware_class() for middleware_class in middleware_classes]
+                requests = [factory.get(path, HTTP_AUTHORIZATION="Token benchmark") for _ in xrange(options["requests"])]
+                gc.collect()
+                gc.disable()
+                start = time.time()
+                for request in requests:
+                    self.run_request(middleware, request, view)
+                timings.append((time.time() - start) / options["requests"] * 1000000)
+                gc.enable()
+            self.stdout.write("%s: %.1fus per request with the full middleware, %.1fus lean" % (path, timings[0], timings[1]))
+
+    def run_request(self, middleware, request, view):
+        for m in middleware:
+            if hasattr(m, "process_request"):
+                m.process_request(request)
+        for m in middleware:
+            if hasattr(m, "process_view"):
+                m.process_view(request, view, (), {})
+        response = view(request)
+        for m in reversed(middleware):
+            if hasattr(m, "process_response"):
+                response = m.process_response(request, response)
+        return response
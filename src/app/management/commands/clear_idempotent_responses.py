@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+
+from app.models import IdempotentResponse
+
+
+class Command(BaseCommand):
+    help = "Deletes stored responses to idempotent requests older than IDEMPOTENT_RESPONSE_LIFESPAN. Run this from cron."
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - settings.IDEMPOTENT_RESPONSE_LIFESPAN
+        deleted, _ = IdempotentResponse.objects.filter(date_created__lt=cutoff).delete()
+        self.stdout.write("Deleted %d stored responses" % deleted)
@@ -0,0 +1,26 @@
+import simplejson
+
+from django.core.management.base import BaseCommand
+
+from project.slow_queries import get_slow_queries, clear_slow_queries
+
+
+class Command(BaseCommand):
+    help = "Prints the slow queries sampled while SLOW_QUERY_THRESHOLD is set, newest first."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="One JSON object per line")
+        parser.add_argument("--clear", action="store_true", help="Empty the buffer afterwards")
+
+    def handle(self, *args, **options):
+        for query in get_slow_queries():
+            if options["json"]:
+                self.stdout.write(simplejson.dumps(query))
+            else:
+                self.stdout.write("%s %.3fs %s" % (query["time"], query["duration"], query["path"] or ""))
+                for frame in query["stack"]:
+                    self.stdout.write("    " + frame)
+                self.stdout.write("    " + query["sql"] + "\n")
+
+        if options["clear"]:
+            clear_slow_queries()
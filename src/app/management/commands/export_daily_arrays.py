@@ -0,0 +1,25 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from app.models import Experiment
+from app.exports import write_daily_arrays
+
+
+class Command(BaseCommand):
+    help = "Writes each experiment type's daily inputs, outputs, stages, targets and restart counts to " \
+           "<directory>/daily-<type>.bin, in the memory-mappable format described in app.exports.write_daily_arrays."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--type", action="append", dest="types", help="Only this experiment type (repeatable)")
+
+    def handle(self, *args, **options):
+        types = options["types"] or sorted(set(Experiment.objects.values_list("experiment_type", flat=True)))
+        if not os.path.isdir(options["directory"]):
+            os.makedirs(options["directory"])
+        for experiment_type in types:
+            path = os.path.join(options["directory"], "daily-%s.bin" % experiment_type)
+            with open(path, "wb") as f:
+                write_daily_arrays(Experiment.objects.filter(experiment_type=experiment_type), f)
+            self.stdout.write("Wrote %s" % path)
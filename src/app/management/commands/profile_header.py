@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from app.profiling import make_header
+
+
+class Command(BaseCommand):
+    help = "Prints a value for the X-Profile header, which has a request profiled for PROFILE_HEADER_MAX_AGE."
+
+    def handle(self, *args, **options):
+        self.stdout.write(make_header())
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app.dashboard import refresh_experiment_stats
+from app.models import Experiment
+
+
+class Command(BaseCommand):
+    help = "Updates the ExperimentStats behind the cohort dashboard for experiments that changed, or every " \
+           "experiment with --all. Run this from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Recompute every experiment")
+
+    def handle(self, *args, **options):
+        count = refresh_experiment_stats(Experiment.objects.all() if options["all"] else None)
+        self.stdout.write("Refreshed %d experiments" % count)
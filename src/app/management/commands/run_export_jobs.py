@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app.exports import fail_stuck_jobs, run_pending_jobs, expire_jobs
+
+
+class Command(BaseCommand):
+    help = "Builds pending ExportJobs, up to EXPORT_JOB_CONCURRENCY at once across workers, and deletes expired archives. " \
+           "Run this from cron every minute or so."
+
+    def handle(self, *args, **options):
+        failed = fail_stuck_jobs()
+        expired = expire_jobs()
+        run = run_pending_jobs()
+        self.stdout.write("Ran %d export jobs, timed out %d, expired %d" % (run, failed, expired))
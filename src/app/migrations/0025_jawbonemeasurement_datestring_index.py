@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 02:27
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_auto_20161027_1824'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='jawbonemeasurement',
+            index_together=set([('user', 'type', 'jawbone_datestring')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 02:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_jawbonemeasurement_datestring_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkin',
+            name='local_day',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='checkin',
+            index_together=set([('experiment', 'local_day')]),
+        ),
+    ]
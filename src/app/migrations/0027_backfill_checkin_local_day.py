@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime, pytz
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def backfill_local_day(apps, schema_editor):
+    '''
+    We never stored the user's timezone at checkin time, so existing rows use the timezone the user has now. New
+    checkins store local_day as they are written.
+    '''
+    Checkin = apps.get_model('app', 'Checkin')
+
+    last_id = 0
+    while True:
+        batch = list(Checkin.objects.filter(local_day__isnull=True, id__gt=last_id)
+                     .select_related('experiment__user')
+                     .order_by('id')
+                     .only('id', 'checkin_time', 'experiment__user__timezone')[:BATCH_SIZE])
+        if not batch:
+            break
+
+        with transaction.atomic():
+            for checkin in batch:
+                tz = pytz.timezone(checkin.experiment.user.timezone)
+                local_day = checkin.checkin_time.astimezone(tz).date() - datetime.timedelta(days=1)
+                Checkin.objects.filter(id=checkin.id).update(local_day=local_day)
+
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_checkin_local_day'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_local_day, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 02:29
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_backfill_checkin_local_day'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='checkin',
+            index_together=set([('experiment', 'checkin_time'), ('experiment', 'local_day', 'checkin_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='experiment',
+            index_together=set([('user', 'start_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='jawbonemeasurement',
+            index_together=set([('user', 'type', 'start_time', 'end_time'), ('user', 'type', 'jawbone_datestring')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 02:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0029_idempotentresponse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='experiment',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
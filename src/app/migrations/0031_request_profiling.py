@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 02:55
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0030_experiment_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfiledUser',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('sample_rate', models.FloatField(default=0.1, help_text=b"Fraction of this user's requests to profile, from 0 to 1")),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profiling', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('path', models.CharField(max_length=255)),
+                ('view', models.CharField(blank=True, max_length=128)),
+                ('reason', models.CharField(choices=[(b'header', b'Signed header'), (b'sampled', b'Sampled user')], max_length=16)),
+                ('duration', models.FloatField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('filename', models.CharField(max_length=255)),
+                ('date_created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
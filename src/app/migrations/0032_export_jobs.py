@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 03:01
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0031_request_profiling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed'), (b'expired', b'Expired')], db_index=True, default=b'pending', max_length=16)),
+                ('progress', models.PositiveSmallIntegerField(default=0, help_text=b'Percent')),
+                ('message', models.TextField(blank=True, default=b'')),
+                ('archive', models.CharField(blank=True, default=b'', help_text=b'Relative to MEDIA_ROOT', max_length=255)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('users', models.ManyToManyField(blank=True, help_text=b'Leave empty to export every user', related_name='_exportjob_users_+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
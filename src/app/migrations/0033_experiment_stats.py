@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 03:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0032_export_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExperimentStats',
+            fields=[
+                ('experiment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='app.Experiment')),
+                ('experiment_type', models.CharField(db_index=True, max_length=32)),
+                ('is_active', models.BooleanField(default=False)),
+                ('is_cancelled', models.BooleanField(default=False)),
+                ('current_stage', models.IntegerField(default=0)),
+                ('restart_count', models.PositiveIntegerField(default=0)),
+                ('days', models.PositiveIntegerField(default=0)),
+                ('checkin_days', models.PositiveIntegerField(default=0)),
+                ('missed_days', models.PositiveIntegerField(default=0)),
+                ('result_value', models.FloatField(default=0)),
+                ('result_confidence', models.FloatField(default=0)),
+                ('data_version', models.PositiveIntegerField(default=0)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
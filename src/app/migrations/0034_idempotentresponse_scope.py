@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 03:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0033_experiment_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotentresponse',
+            name='scope',
+            field=models.CharField(blank=True, default=b'', max_length=255),
+        ),
+    ]
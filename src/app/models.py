@@ -1,16 +1,18 @@
 from django.core.files.storage import FileSystemStorage
 from django.db import models
 from django.contrib.auth import models as auth_models
-from django.db.models import Q, Sum
+from django.db.models import Q, F, Sum
 
 import dateutil.parser
 import string, random, os, math, datetime, pytz, simplejson
+from collections import defaultdict
 import analysis
 from analysis import mean
 
 from .fields import SerializedDataField
 
-from django.db.models.signals import post_delete, pre_delete
+from django.db.models.signals import post_delete, pre_delete, post_save
+from django.core.cache import cache
 from django.dispatch import receiver
 from django.utils import timezone
 from django.conf import settings
@@ -37,6 +39,19 @@ class BaseModel(models.Model):
                     self.key = key
                     break
 
+    @classmethod
+    def generate_keys(cls, objects, length=10):
+        '''
+        generate_key for a list of unsaved objects, with one query for collisions, since bulk_create doesn't call save
+        '''
+        objects = [obj for obj in objects if not obj.key]
+        for _ in range(10):
+            keys = [key_generator(length) for _ in objects]
+            if len(set(keys)) == len(keys) and not cls.objects.filter(key__in=keys).exists():
+                for obj, key in zip(objects, keys):
+                    obj.key = key
+                break
+
     def save(self, *args, **kwargs):
         self.generate_key()
         super(BaseModel, self).save(*args, **kwargs)
@@ -127,10 +142,21 @@ class User(auth_models.AbstractUser, BaseModel):
     sleep_quality = models.IntegerField(default=0)
     timezone = models.CharField(max_length=32, default="America/New_York")
 
+    def refresh_from_db(self, using=None, fields=None):
+        '''
+        Users from the token cache (see authentication.py) only have their id loaded. The first time a view reads any
+        other field, load the whole row rather than one query per field.
+        '''
+        deferred_fields = self.get_deferred_fields()
+        if fields is not None and deferred_fields and set(fields) <= deferred_fields:
+            fields = deferred_fields
+        super(User, self).refresh_from_db(using=using, fields=fields)
 
 
 NUM_STAGES = 3
 
+JAWBONE_DATESTRING_FORMAT = "%Y%m%d"
+
 
 class Experiment(BaseModel):
     experiment_type = models.CharField(max_length=32)
@@ -153,10 +179,42 @@ class Experiment(BaseModel):
 
     current_stage = models.IntegerField(default=0)
 
+    # bumped whenever something that feeds the stage data changes, so cached responses can be keyed on it
+    data_version = models.PositiveIntegerField(default=0)
+
     self_efficacy = models.IntegerField()
     app_efficacy = models.IntegerField()
     experiment_efficacy = models.IntegerField()
 
+    _stage_data_cache = None
+    _preloaded_checkins = None
+    _preloaded_measurements = None
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.data_version += 1
+            super(Experiment, self).save(*args, **kwargs)
+            return
+        # in the database, so a concurrent data_changed_for_user isn't overwritten. The new value is loaded the first
+        # time it's read, like a deferred field, since most saves don't read it again
+        self.data_version = F("data_version") + 1
+        super(Experiment, self).save(*args, **kwargs)
+        del self.__dict__["data_version"]
+
+    @staticmethod
+    def data_changed_for_user(user):
+        '''
+        Call when new measurements come in for a user, since they can change any of their active experiments' data
+        '''
+        Experiment.objects.filter(user=user, is_active=True).update(data_version=F("data_version") + 1)
+
+    def get_data_cache_key(self, name):
+        '''
+        Stage data depends on the experiment's data and on what day it is for the user
+        '''
+        today = self.localize(timezone.now()).date()
+        return "%s:%s:%d:%s" % (name, self.key, self.data_version, today.isoformat())
+
     def init(self):
         start = self.localize(timezone.now()).date()
         self.set_stage_dates(0, start, start + datetime.timedelta(days=7))
@@ -169,10 +227,104 @@ class Experiment(BaseModel):
     def get_experiment_type(self):
         return analysis.EXPERIMENT_TYPES.get(self.experiment_type)
 
+    @staticmethod
+    def preload(experiments):
+        '''
+        Loads the checkins and jawbone measurements of all the experiments with two queries, and has each experiment use
+        them instead of querying for its own. For exporting many experiments at once; select_related('user') on the
+        experiments too.
+        '''
+        checkins = defaultdict(list)
+        for checkin in Checkin.objects.filter(experiment__in=experiments):
+            checkins[checkin.experiment_id].append(checkin)
+
+        measurements = defaultdict(list)
+        user_ids = set(experiment.user_id for experiment in experiments)
+        for measurement in JawboneMeasurement.objects.filter(user_id__in=user_ids).defer("raw_jawbone_object"):
+            measurements[measurement.user_id].append(measurement)
+
+        for experiment in experiments:
+            experiment.preload_data(checkins[experiment.id], measurements[experiment.user_id])
+
+    def preload_data(self, checkins, measurements):
+        '''
+        :param checkins: all of this experiment's checkins
+        :param measurements: all of its user's jawbone measurements
+        '''
+        self._preloaded_checkins = sorted((checkin for checkin in checkins if checkin.local_day is not None),
+                                          key=lambda checkin: (checkin.local_day, checkin.checkin_time))
+        self._preloaded_measurements = defaultdict(list)
+        for measurement in sorted(measurements, key=lambda measurement: measurement.start_time):
+            self._preloaded_measurements[measurement.type].append(measurement)
+
     def get_jawbone_events(self, type_name, start_date, end_date):
         start_time = datetime.datetime.combine(start_date, datetime.time.min).replace(tzinfo=pytz.UTC)
         end_time = datetime.datetime.combine(end_date, datetime.time.min).replace(tzinfo=pytz.UTC)
-        return JawboneMeasurement.objects.filter(user=self.user).order_by("start_time").filter(type=type_name, end_time__gte=start_time, start_time__lt=end_time)
+        if self._preloaded_measurements is not None:
+            return [event for event in self._preloaded_measurements[type_name]
+                    if event.end_time is not None and event.start_time is not None and event.end_time >= start_time and event.start_time < end_time]
+        events = JawboneMeasurement.objects.filter(user=self.user).order_by("start_time").filter(type=type_name, end_time__gte=start_time, start_time__lt=end_time)
+        return self._cache_query(("jawbone", type_name, start_date, end_date), events)
+
+    def _cache_query(self, cache_key, queryset):
+        '''
+        While stage data is cached, inputs and outputs that need the same rows share one query
+        '''
+        if self._stage_data_cache is None:
+            return queryset
+        if cache_key not in self._stage_data_cache:
+            self._stage_data_cache[cache_key] = list(queryset)
+        return self._stage_data_cache[cache_key]
+
+    def get_checkins(self, start_date, end_date):
+        '''
+        :param start_date: inclusive
+        :param end_date: exclusive
+        :return: checkins by the local day they describe, earliest first within a day
+        '''
+        if self._preloaded_checkins is not None:
+            return [checkin for checkin in self._preloaded_checkins if start_date <= checkin.local_day < end_date]
+        checkins = self.checkins.filter(local_day__gte=start_date, local_day__lt=end_date).order_by("local_day", "checkin_time")
+        return self._cache_query(("checkins", start_date, end_date), checkins)
+
+    def get_jawbone_day_events(self, type_name, start_date, end_date):
+        '''
+        For daily summary events (moves), jawbone already tells us the user's local day in jawbone_datestring, so we look
+        the events up by that key. Rows saved without a datestring fall back to the timestamp window used by
+        get_jawbone_events.
+        :param type_name:
+        :param start_date: inclusive
+        :param end_date: exclusive
+        :return:
+        '''
+        datestrings = [(start_date + datetime.timedelta(days=d)).strftime(JAWBONE_DATESTRING_FORMAT) for d in xrange((end_date - start_date).days)]
+        start_time = datetime.datetime.combine(start_date, datetime.time.min).replace(tzinfo=pytz.UTC)
+        end_time = datetime.datetime.combine(end_date, datetime.time.min).replace(tzinfo=pytz.UTC)
+        if self._preloaded_measurements is not None:
+            datestrings = set(datestrings)
+            return [event for event in self._preloaded_measurements[type_name] if event.jawbone_datestring in datestrings or
+                    (not event.jawbone_datestring and event.end_time is not None and event.start_time is not None and
+                     event.end_time >= start_time and event.start_time < end_time)]
+        return JawboneMeasurement.objects.filter(user_id=self.user_id, type=type_name).order_by("start_time").filter(
+            Q(jawbone_datestring__in=datestrings) |
+            Q(jawbone_datestring="", end_time__gte=start_time, start_time__lt=end_time))
+
+    def get_jawbone_events_by_day(self, type_name, start_date, end_date):
+        '''
+        :param type_name:
+        :param start_date: inclusive
+        :param end_date: exclusive
+        :return: dict of local date -> first event of that day
+        '''
+        events_by_day = dict()
+        for event in self.get_jawbone_day_events(type_name, start_date, end_date):
+            if event.jawbone_datestring:
+                day = datetime.datetime.strptime(event.jawbone_datestring, JAWBONE_DATESTRING_FORMAT).date()
+            else:
+                day = self.localize(event.start_time).date()
+            if start_date <= day < end_date and day not in events_by_day:
+                events_by_day[day] = event
+        return events_by_day
 
     def get_stage_targets(self):
         return simplejson.loads(self.stage_target_values)
@@ -333,20 +485,17 @@ class Experiment(BaseModel):
         return sum([1 for i, o in data if i is None or o is None])
 
     def get_stage_inputs(self, stage, always_get_median=False):
-
-        use_variability = self.get_experiment_type().use_variability() if self.get_experiment_type() else False
-        use_variability = False if always_get_median else use_variability
-
-        experiment_type = self.get_experiment_type()
-        today = self.localize(timezone.now()).date()
-        start_date, end_date = self.get_stage_dates(stage, today=today)
-        return experiment_type.get_inputs(self, start_date, end_date, use_variability)
+        return self.get_stage_data(stage, always_get_median)[0]
 
     def get_stage_outputs(self, stage):
-        experiment_type = self.get_experiment_type()
-        today = self.localize(timezone.now()).date()
-        start_date, end_date = self.get_stage_dates(stage, today=today)
-        return experiment_type.get_outputs(self, start_date, end_date)
+        return self.get_stage_data(stage)[1]
+
+    def cache_stage_data(self):
+        '''
+        Remember stage data on this instance from now on, so evaluating the stage queries each stage window once. Only
+        call this once every checkin and measurement the caller cares about has been saved.
+        '''
+        self._stage_data_cache = dict()
 
     def get_stage_data(self, stage, always_get_median=False):
 
@@ -356,10 +505,18 @@ class Experiment(BaseModel):
         experiment_type = self.get_experiment_type()
         today = self.localize(timezone.now()).date()
         start_date, end_date = self.get_stage_dates(stage, today=today)
-        if not start_date:
+        if not start_date or start_date >= end_date:
             return [], []
+
+        # variability inputs depend on the initial average, which changes when the first stage ends
+        cache_key = (stage, use_variability, start_date, end_date, self.initial_stage_average)
+        if self._stage_data_cache is not None and cache_key in self._stage_data_cache:
+            return self._stage_data_cache[cache_key]
+
         inputs = experiment_type.get_inputs(self, start_date, end_date, use_variability)
         outputs = experiment_type.get_outputs(self, start_date, end_date)
+        if self._stage_data_cache is not None:
+            self._stage_data_cache[cache_key] = (inputs, outputs)
         return inputs, outputs
 
     def get_all_data(self):
@@ -442,6 +599,11 @@ class Experiment(BaseModel):
     def __unicode__(self):
         return self.key
 
+    class Meta:
+        index_together = [
+            ("user", "start_time"),
+        ]
+
 class Checkin(BaseModel):
     experiment = models.ForeignKey(Experiment, related_name="checkins")
     checkin_time = models.DateTimeField()
@@ -452,6 +614,42 @@ class Checkin(BaseModel):
     leisure_time = models.IntegerField()
     app_version = models.CharField(max_length=64, blank=True, default="")
 
+    # checkins ask about yesterday, so this is the day before checkin_time in the user's timezone at checkin time
+    local_day = models.DateField(null=True, blank=True)
+
+    def get_local_day(self):
+        return self.experiment.localize(self.checkin_time).date() - datetime.timedelta(days=1)
+
+    def save(self, *args, **kwargs):
+        if self.local_day is None and self.checkin_time:
+            self.local_day = self.get_local_day()
+        super(Checkin, self).save(*args, **kwargs)
+
+    class Meta:
+        index_together = [
+            ("experiment", "local_day", "checkin_time"),
+            ("experiment", "checkin_time"),
+        ]
+
+
+class IdempotentResponse(models.Model):
+    '''
+    The response we sent for a request that carried a client-generated idempotency key, so a retried request gets the
+    same answer without redoing the work. Cleared out after settings.IDEMPOTENT_RESPONSE_LIFESPAN.
+    '''
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(User, related_name="idempotent_responses")
+    key = models.CharField(max_length=64)
+    # the endpoint, path and experiment the key was used for
+    scope = models.CharField(max_length=255, default="", blank=True)
+    response = models.TextField()
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = [
+            ("user", "key"),
+        ]
+
 
 class JawboneMeasurement(models.Model):
     id = models.AutoField(primary_key=True)
@@ -492,4 +690,130 @@ class JawboneMeasurement(models.Model):
         self.raw_jawbone_object = event.raw
         self.awake_time = event.awake_time
 
+    class Meta:
+        index_together = [
+            ("user", "type", "jawbone_datestring"),
+            ("user", "type", "start_time", "end_time"),
+        ]
+
+
+
+PROFILED_USERS_CACHE_KEY = "profiled_users"
+
+
+class ProfiledUser(models.Model):
+    '''
+    A user some of whose requests are run under cProfile, see app/profiling.py
+    '''
+    id = models.AutoField(primary_key=True)
+    user = models.OneToOneField(User, related_name="profiling")
+    sample_rate = models.FloatField(default=0.1, help_text="Fraction of this user's requests to profile, from 0 to 1")
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def get_sample_rates():
+        '''
+        :return: dict of user id -> sample rate, from the cache. Changes to ProfiledUser clear it.
+        '''
+        rates = cache.get(PROFILED_USERS_CACHE_KEY)
+        if rates is None:
+            rates = dict(ProfiledUser.objects.values_list("user_id", "sample_rate"))
+            cache.set(PROFILED_USERS_CACHE_KEY, rates, None)
+        return rates
+
+
+@receiver([post_save, post_delete], sender=ProfiledUser)
+def clear_sample_rates(sender, **kwargs):
+    cache.delete(PROFILED_USERS_CACHE_KEY)
 
+
+class RequestProfile(models.Model):
+    '''
+    cProfile stats for one request, in a file in settings.PROFILE_DIR that loads with pstats, snakeviz or gprof2dot
+    '''
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    path = models.CharField(max_length=255)
+    view = models.CharField(max_length=128, blank=True)
+    reason = models.CharField(max_length=16, choices=(("header", "Signed header"), ("sampled", "Sampled user")))
+    duration = models.FloatField()
+    size = models.PositiveIntegerField(default=0)
+    filename = models.CharField(max_length=255)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def get_path(self):
+        return os.path.join(settings.PROFILE_DIR, self.filename)
+
+
+@receiver(post_delete, sender=RequestProfile)
+def delete_profile_file(sender, instance, **kwargs):
+    try:
+        os.remove(instance.get_path())
+    except OSError:
+        pass
+
+
+class ExportJob(models.Model):
+    '''
+    A zip of the research exports for some users (all of them if none are picked), built in the background by
+    manage.py run_export_jobs, see app/exports.py. The archive is deleted after settings.EXPORT_JOB_LIFESPAN.
+    '''
+    PENDING, RUNNING, DONE, FAILED, EXPIRED = "pending", "running", "done", "failed", "expired"
+    ARCHIVE_DIR = "exports"
+
+    id = models.AutoField(primary_key=True)
+    requested_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    users = models.ManyToManyField(User, blank=True, related_name="+", help_text="Leave empty to export every user")
+    status = models.CharField(max_length=16, default=PENDING, db_index=True,
+                              choices=((PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed"),
+                                       (EXPIRED, "Expired")))
+    progress = models.PositiveSmallIntegerField(default=0, help_text="Percent")
+    message = models.TextField(blank=True, default="")
+    archive = models.CharField(max_length=255, blank=True, default="", help_text="Relative to MEDIA_ROOT")
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    def get_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.archive) if self.archive else None
+
+    def set_progress(self, progress, message):
+        # an update rather than save, so it can't overwrite the status
+        self.progress = progress
+        self.message = message
+        ExportJob.objects.filter(id=self.id).update(progress=progress, message=message)
+
+    def delete_archive(self):
+        if self.archive:
+            try:
+                os.remove(self.get_path())
+            except OSError:
+                pass
+            self.archive = ""
+
+
+@receiver(post_delete, sender=ExportJob)
+def delete_export_archive(sender, instance, **kwargs):
+    instance.delete_archive()
+
+
+class ExperimentStats(models.Model):
+    '''
+    Summary of one experiment for the cohort dashboard, kept up to date by manage.py refresh_experiment_stats so the
+    dashboard never reads checkins or measurements. See app/dashboard.py.
+    '''
+    experiment = models.OneToOneField(Experiment, primary_key=True, related_name="stats")
+    experiment_type = models.CharField(max_length=32, db_index=True)
+    is_active = models.BooleanField(default=False)
+    is_cancelled = models.BooleanField(default=False)
+    current_stage = models.IntegerField(default=0)
+    restart_count = models.PositiveIntegerField(default=0)
+    days = models.PositiveIntegerField(default=0)
+    checkin_days = models.PositiveIntegerField(default=0)
+    # days missing an input or an output
+    missed_days = models.PositiveIntegerField(default=0)
+    result_value = models.FloatField(default=0)
+    result_confidence = models.FloatField(default=0)
+    # the experiment's data_version these were computed from
+    data_version = models.PositiveIntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
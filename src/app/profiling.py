@@ -0,0 +1,130 @@
+'''
+Runs a view under cProfile when the request carries a signed X-Profile header, or, at the rate set in the admin, when
+it comes from a ProfiledUser. The stats go to a file in settings.PROFILE_DIR with a RequestProfile row for the admin,
+and the oldest are deleted once there are more than PROFILE_MAX_COUNT of them or they take more than PROFILE_MAX_BYTES.
+'''
+
+import cProfile, os, random, time, uuid
+
+from django.conf import settings
+from django.core import signing
+
+from .authentication import get_cached_user_id
+from .models import ProfiledUser, RequestProfile
+
+HEADER_SALT = "app.profiling"
+
+
+def make_header():
+    '''
+    :return: a value for the X-Profile header, good for settings.PROFILE_HEADER_MAX_AGE
+    '''
+    return signing.TimestampSigner(salt=HEADER_SALT).sign(uuid.uuid4().hex)
+
+
+def has_signed_header(request):
+    header = request.META.get("HTTP_X_PROFILE")
+    if not header:
+        return False
+    try:
+        signing.TimestampSigner(salt=HEADER_SALT).unsign(header, max_age=settings.PROFILE_HEADER_MAX_AGE.total_seconds())
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def get_user_id(request):
+    '''
+    The session user for the admin and the token user for the app, whose requests don't go through the auth middleware.
+    Before the view runs the token user is only known if the token is cached, so an app user's first request to a
+    process isn't sampled; the view authenticates it, and sets request.user for after.
+    '''
+    user = getattr(request, "user", None)
+    if user is not None:
+        return user.pk
+    return get_cached_user_id(request)
+
+
+def get_reason(request):
+    '''
+    :return: why this request should be profiled, or None if it shouldn't be
+    '''
+    if has_signed_header(request):
+        return "header"
+
+    rates = ProfiledUser.get_sample_rates()
+    if rates:
+        rate = rates.get(get_user_id(request))
+        if rate and random.random() < rate:
+            return "sampled"
+    return None
+
+
+def save_profile(profiler, request, view_name, reason, duration):
+    if not os.path.isdir(settings.PROFILE_DIR):
+        os.makedirs(settings.PROFILE_DIR)
+
+    filename = "%s-%s.prof" % (view_name or "view", uuid.uuid4().hex)
+    profile = RequestProfile(user_id=get_user_id(request), path=request.path[:255], view=view_name, reason=reason,
+                             duration=duration, filename=filename)
+    profiler.dump_stats(profile.get_path())
+    profile.size = os.path.getsize(profile.get_path())
+    profile.save()
+
+    trim_profiles()
+    return profile
+
+
+def trim_profiles():
+    stale_ids = []
+    total_size = 0
+    for count, (profile_id, size) in enumerate(RequestProfile.objects.order_by("-date_created", "-id").values_list("id", "size")):
+        total_size += size
+        if count >= settings.PROFILE_MAX_COUNT or total_size > settings.PROFILE_MAX_BYTES:
+            stale_ids.append(profile_id)
+
+    # one by one, so post_delete removes the files
+    for profile in RequestProfile.objects.filter(id__in=stale_ids):
+        profile.delete()
+
+
+class ProfilingMiddleware(object):
+    '''
+    Goes last in MIDDLEWARE_CLASSES, so the profile covers the view and little else. A view that raises is profiled
+    too, and its exception goes on to the other middleware.
+    '''
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        reason = get_reason(request)
+        if reason is None:
+            return None
+
+        resolver_match = getattr(request, "resolver_match", None)
+        view_name = resolver_match.url_name if resolver_match else None
+
+        profiler = cProfile.Profile()
+        request._profiling = dict(profiler=profiler, view_name=view_name, reason=reason, start=time.time())
+        profiler.enable()
+        return None
+
+    def stop(self, request):
+        '''
+        :return: the saved RequestProfile, or None if the request isn't profiled or already was
+        '''
+        profiling = getattr(request, "_profiling", None)
+        if profiling is None:
+            return None
+        profiling["profiler"].disable()
+        del request._profiling
+        return save_profile(profiling["profiler"], request, profiling["view_name"], profiling["reason"],
+                            time.time() - profiling["start"])
+
+    def process_exception(self, request, exception):
+        self.stop(request)
+        return None
+
+    def process_response(self, request, response):
+        profile = self.stop(request)
+        if profile is not None:
+            response["X-Profile-Id"] = str(profile.id)
+        return response
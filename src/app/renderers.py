@@ -0,0 +1,19 @@
+import msgpack
+
+from rest_framework.renderers import BaseRenderer
+
+
+class MsgpackRenderer(BaseRenderer):
+    '''
+    Lets clients negotiate msgpack with their Accept header. Our views build their own responses (see
+    views.api_response), but the renderer has to be registered for rest_framework to accept the media type.
+    '''
+    media_type = "application/x-msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return ""
+        return msgpack.packb(data)
@@ -1,16 +1,76 @@
 import simplejson, datetime
 from freezegun import freeze_time
 from decimal import Decimal
-import mock, pytz
+import mock, pytz, StringIO, msgpack, os, shutil, pstats, csv, zipfile, subprocess, time
 
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+
+from django.db import transaction, connection
+from .models import Experiment, Checkin, User, JawboneMeasurement, IdempotentResponse, ProfiledUser, RequestProfile, \
+    PROFILED_USERS_CACHE_KEY, ExportJob
+from .analysis import EXPERIMENT_TYPES
+from .views import MAX_BATCH_CHECKINS
+
+from . import jawbone, profiling
+from project import metrics, slow_queries
+from .authentication import token_cache
+from rest_framework_expiring_authtoken.models import ExpiringToken
+import passwords
 
-from django.db import transaction
-from .models import Experiment, Checkin, User, JawboneMeasurement
+FROZEN_TIME = datetime.datetime(2012, 6, 14, 9)
+
+
+def make_user(email, timezone="America/New_York"):
+    return User.objects.create(username=email, email=email, timezone=timezone)
+
+
+def make_experiment(user, experiment_type="leisurehappiness", days=5, stage_dates=(), **fields):
+    '''
+    :param stage_dates: (stage, start date, end date) tuples
+    :return: a saved experiment of user's that started `days` ago, with fields set on it
+    '''
+    experiment = Experiment(user=user, experiment_type=experiment_type, self_efficacy=1, app_efficacy=1, experiment_efficacy=1)
+    experiment.init()
+    experiment.start_time = timezone.now() - datetime.timedelta(days=days)
+    for stage, start_date, end_date in stage_dates:
+        experiment.set_stage_dates(stage, start_date, end_date)
+    for name, value in fields.items():
+        setattr(experiment, name, value)
+    experiment.save()
+    return experiment
+
+
+class FrozenTimeMixin(object):
+    '''
+    Freezes time at FROZEN_TIME for each test
+    '''
+
+    def setUp(self):
+        super(FrozenTimeMixin, self).setUp()
+        self.freezer = freeze_time(FROZEN_TIME)
+        self.freezer.start()
+
+    def tearDown(self):
+        self.freezer.stop()
+        super(FrozenTimeMixin, self).tearDown()
+
+
+class AdminClientMixin(FrozenTimeMixin):
+    '''
+    Logs self.client in to the admin as a superuser, with time frozen
+    '''
+
+    def setUp(self):
+        super(AdminClientMixin, self).setUp()
+        self.admin = User.objects.create_superuser("admin", "admin@bob.johnson", "admin")
+        self.client = Client()
+        self.client.login(username="admin", password="admin")
 
-import passwords
 
 @mock.patch("app.jawbone.get_user_id", lambda x: "7890")
 class ExperimentTestCase(TestCase):
@@ -79,13 +139,14 @@ class ExperimentTestCase(TestCase):
                                          )
         measurement.save()
 
-    def _make_jawbone_steps_event(self, start_offset=0, end_offset=2, steps=1000):
+    def _make_jawbone_steps_event(self, start_offset=0, end_offset=2, steps=1000, datestring=""):
         now = timezone.now()
         measurement = JawboneMeasurement(user=self.user,
                                          type="moves",
                                          start_time=now + datetime.timedelta(hours=start_offset),
                                          end_time=now + datetime.timedelta(hours=end_offset),
                                          jawbone_id="34",
+                                         jawbone_datestring=datestring,
                                          steps=steps
                                          )
         measurement.save()
@@ -141,6 +202,117 @@ class ExperimentTestCase(TestCase):
         response = self._checkin(leisure_time=60)
         self.assertEqual(response['stage_inputs'], [120, 60])
 
+    def test_checkin_is_atomic(self):
+        self._create_experiment()
+
+        # missing the first few days restarts the stage, so this checkin has to save the experiment too
+        self.tick(4)
+        with mock.patch.object(Experiment, "save", side_effect=RuntimeError), mock.patch("project.middleware.logging"):
+            self.assertRaises(RuntimeError, self._checkin)
+        self.assertEqual(Checkin.objects.filter(experiment__key=self.experiment_key).count(), 0)
+
+        response = self._checkin()
+        self.assertEqual(response['restarted_stage'], True)
+        self.assertEqual(Checkin.objects.filter(experiment__key=self.experiment_key).count(), 1)
+
+    def test_checkin_idempotency_key(self):
+        self._create_experiment()
+
+        self.tick()
+        response = self._checkin(leisure_time=120, idempotency_key="retry-1")
+        replayed = self._checkin(leisure_time=120, idempotency_key="retry-1")
+        self.assertEqual(response, replayed)
+        self.assertEqual(Checkin.objects.filter(experiment__key=self.experiment_key).count(), 1)
+
+        response = self._checkin(leisure_time=60, idempotency_key="retry-2")
+        self.assertEqual(response['stage_inputs'], [120])
+        self.assertEqual(Checkin.objects.filter(experiment__key=self.experiment_key).count(), 2)
+
+        # the same key for another endpoint or experiment isn't answered with this response
+        checkins = simplejson.dumps([dict(checkin_time=timezone.now().isoformat(), did_follow_instructions=3, happy=4,
+                                          stress=5, productivity=6, leisure_time=60)])
+        response = self.client.post('/batch_checkin/', dict(experiment_key=self.experiment_key, checkins=checkins,
+                                                            idempotency_key="retry-1"))
+        self.assertEqual(response.status_code, 409)
+        first_key = self.experiment_key
+        self._create_experiment()
+        response = self.client.post('/experiment_checkin/', dict(experiment_key=self.experiment_key, did_follow_instructions=3,
+                                                                 happy=4, stress=5, productivity=6, leisure_time=120,
+                                                                 idempotency_key="retry-1"))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Checkin.objects.filter(experiment__key__in=[first_key, self.experiment_key]).count(), 2)
+
+        # a concurrent request with the same key for another experiment stored its response first
+        with mock.patch("app.views._get_idempotent_response", return_value=None):
+            response = self.client.post('/experiment_checkin/', dict(experiment_key=first_key, did_follow_instructions=3,
+                                                                     happy=4, stress=5, productivity=6, leisure_time=120,
+                                                                     idempotency_key="retry-1"))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Checkin.objects.filter(experiment__key__in=[first_key, self.experiment_key]).count(), 2)
+
+        self.tick(3)
+        call_command("clear_idempotent_responses", stdout=StringIO.StringIO())
+        self.assertFalse(IdempotentResponse.objects.exists())
+
+    def test_batch_checkin(self):
+        self._create_experiment()
+
+        checkins = []
+        for leisure_time in (120, 60, 220):
+            self.tick()
+            checkins.append(dict(checkin_time=timezone.now().isoformat(), did_follow_instructions=3, happy=4, stress=5,
+                                 productivity=6, leisure_time=leisure_time))
+        self.tick()
+        checkins.append(dict(checkin_time=timezone.now().isoformat(), did_follow_instructions=3, happy=4, stress=5,
+                             productivity=6, leisure_time=50))
+
+        # the order they arrive in doesn't matter, and the response is what the last checkin would have returned
+        response = self.post('/batch_checkin/', dict(experiment_key=self.experiment_key, checkins=simplejson.dumps(checkins[::-1])))
+        self.assertEqual(response['success'], True)
+        self.assertEqual(response['result']['day'], 5)
+        self.assertEqual(response['result']['current_stage'], 0)
+        self.assertEqual(response['result']['stage_inputs'], [120, 60, 220, 50])
+        self.assertEqual(Checkin.objects.filter(experiment__key=self.experiment_key).count(), 4)
+
+        self.tick()
+        response = self._checkin(leisure_time=70)
+        self.assertEqual(response['stage_inputs'], [120, 60, 220, 50, 70])
+
+    def test_batch_checkin_invalid(self):
+        self._create_experiment()
+
+        response = self.post('/batch_checkin/', dict(experiment_key=self.experiment_key, checkins="not json"))
+        self.assertEqual(response['success'], False)
+        response = self.post('/batch_checkin/', dict(experiment_key=self.experiment_key, checkins=simplejson.dumps([dict(happy=3)])))
+        self.assertEqual(response['success'], False)
+
+        self.tick()
+        checkin = dict(checkin_time=timezone.now().isoformat(), did_follow_instructions=3, happy=4, stress=5,
+                       productivity=6, leisure_time=60)
+        response = self.client.post('/batch_checkin/', dict(experiment_key=self.experiment_key,
+                                                            checkins=simplejson.dumps([checkin] * (MAX_BATCH_CHECKINS + 1))))
+        self.assertEqual(response.status_code, 400)
+
+        early = dict(checkin, checkin_time=(self._get_experiment().start_time - datetime.timedelta(hours=1)).isoformat())
+        response = self.client.post('/batch_checkin/', dict(experiment_key=self.experiment_key,
+                                                            checkins=simplejson.dumps([checkin, early])))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Checkin.objects.exists())
+
+    def test_checkin_local_day(self):
+        self._create_experiment()
+
+        self.tick()
+        self._checkin()
+        checkin = Checkin.objects.get(experiment__key=self.experiment_key)
+        # 9am UTC on the 15th is 4am in New York, and the checkin asks about the day before
+        self.assertEqual(checkin.local_day, datetime.date(2012, 1, 14))
+
+        self.user.timezone = "Asia/Tokyo"
+        self.user.save()
+        checkin.save()
+        self.assertEqual(Checkin.objects.get(pk=checkin.pk).local_day, datetime.date(2012, 1, 14))
+
     def test_refresh_instructions(self):
         self._create_experiment()
 
@@ -157,6 +329,84 @@ class ExperimentTestCase(TestCase):
         self.assertEqual(response['stage_outputs'], refresh_result["stage_outputs"])
 
 
+    def test_stage_delta(self):
+        self._create_experiment()
+
+        self.tick()
+        self._checkin(leisure_time=120)
+        self.tick()
+        response = self._checkin(leisure_time=60)
+        stage_version = response['stage_version']
+
+        # nothing changed, so there's nothing to send
+        refresh = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key, stage_version=stage_version))['result']
+        self.assertNotIn('stage_inputs', refresh)
+        self.assertEqual(refresh['stage_delta'], dict(length=2, days=[]))
+        self.assertEqual(refresh['stage_version'], stage_version)
+
+        self.tick()
+        response = self._checkin(leisure_time=220, stage_version=stage_version)
+        self.assertEqual(response['stage_delta'], dict(length=3, days=[[2, 220, 4]]))
+        self.assertNotEqual(response['stage_version'], stage_version)
+
+        # a client without a version, or with one for another stage, gets everything
+        refresh = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key, stage_version="1.2012-01-01."))['result']
+        self.assertEqual(refresh['stage_inputs'], [120, 60, 220])
+
+    def test_msgpack_response(self):
+        self._create_experiment()
+
+        self.tick()
+        response = self.client.post('/experiment_checkin/', dict(experiment_key=self.experiment_key, did_follow_instructions=3,
+                                                                  happy=4, stress=5, productivity=6, leisure_time=120),
+                                    HTTP_ACCEPT="application/x-msgpack")
+        self.assertEqual(response['Content-Type'], "application/x-msgpack")
+        self.assertEqual(msgpack.unpackb(response.content)['result']['stage_inputs'], [120])
+
+        response = self.client.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+        self.assertEqual(simplejson.loads(response.content)['result']['stage_inputs'], [120])
+
+    def test_refresh_instructions_cache(self):
+        self._create_experiment(type="stepssleepefficiency")
+
+        self.tick()
+        self._checkin()
+        first = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+        self.assertEqual(first, cached)
+        tables = " ".join(query["sql"] for query in queries.captured_queries)
+        self.assertNotIn("app_checkin", tables)
+        self.assertNotIn("app_jawbonemeasurement", tables)
+
+        # new measurements bump the data version of the user's active experiments
+        self._make_jawbone_steps_event(start_offset=-12, end_offset=-10, steps=9000)
+        jawbone._save_jawbone_to_db(self.user, "moves", [])
+        response = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+        self.assertEqual(response['result']['stage_inputs'], [9000])
+
+        # and so does a new day
+        self.tick()
+        response = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+        self.assertEqual(response['result']['stage_inputs'], [9000, 0])
+
+        self._checkin()
+        response = self.get("/refresh_instructions/", dict(experiment_key=self.experiment_key))
+        self.assertEqual(response['result']['stage_outputs'], [None, None])
+        self.assertEqual(Experiment.objects.get(key=self.experiment_key).data_version, 4)
+
+    def test_data_version_concurrent_bump(self):
+        self._create_experiment()
+        experiment = Experiment.objects.get(key=self.experiment_key)
+        version = experiment.data_version
+
+        # new measurements come in while the experiment is loaded elsewhere
+        Experiment.data_changed_for_user(self.user)
+        experiment.save()
+        self.assertEqual(experiment.data_version, version + 2)
+        self.assertEqual(Experiment.objects.get(key=self.experiment_key).data_version, version + 2)
+
     def test_complete_initial_stage(self):
         self._create_experiment()
 
@@ -450,6 +700,53 @@ class ExperimentTestCase(TestCase):
         experiment = Experiment.objects.get(key=self.experiment_key)
         self.assertEqual(experiment.get_stage_targets(), [105, 90, 30, 60])
 
+    def test_token_cache(self):
+        self._create_experiment()
+        token_cache.clear()
+        with CaptureQueriesContext(connection) as miss:
+            self.get('/get_experiments/')
+        with CaptureQueriesContext(connection) as hit:
+            self.get('/get_experiments/')
+        self.assertTrue(any("authtoken_token" in query["sql"] for query in miss.captured_queries))
+        self.assertFalse(any("authtoken_token" in query["sql"] for query in hit.captured_queries))
+        self.assertEqual(len(hit), len(miss) - 1)
+
+    @override_settings(AUTH_CACHE_VERSION_INTERVAL=datetime.timedelta(0))
+    def test_token_cache_invalidated(self):
+        self.assertEqual(self.client.get('/get_experiments/').status_code, 200)
+        self.assertIsNotNone(token_cache.get(ExpiringToken.objects.get().key))
+
+        # deleted by another process, which can't reach this one's cache
+        ExpiringToken.objects.all().delete()
+        self.assertEqual(self.client.get('/get_experiments/').status_code, 401)
+
+        token = simplejson.loads(Client(HTTP_X_APPKEY=passwords.APP_KEY).post("/obtain_token/", {"email": self.email}).content)['token']
+        self.client = Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + token)
+        self.assertEqual(self.client.get('/get_experiments/').status_code, 200)
+        User.objects.filter(email=self.email).update(is_active=False)
+        self.assertEqual(self.client.get('/get_experiments/').status_code, 200)
+        user = User.objects.get(email=self.email)
+        user.save()
+        self.assertEqual(self.client.get('/get_experiments/').status_code, 401)
+
+    def test_token_cache_expired(self):
+        def obtain_token():
+            token = simplejson.loads(Client(HTTP_X_APPKEY=passwords.APP_KEY).post("/obtain_token/", {"email": self.email}).content)['token']
+            return token, Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + token)
+
+        ExpiringToken.objects.all().delete()
+        old_token, old_client = obtain_token()
+        self.assertEqual(old_client.get('/get_experiments/').status_code, 200)
+
+        self.tick(2)
+        self.assertEqual(old_client.get('/get_experiments/').status_code, 401)
+
+        token, self.client = obtain_token()
+        self.assertNotEqual(token, old_token)
+        self.assertIsNone(token_cache.get(old_token))
+        self.assertEqual(old_client.get('/get_experiments/').status_code, 401)
+        self.assertEqual(self.get('/get_experiments/')['experiments'], [])
+
     def test_get_experiments(self):
         self._create_experiment()
         response = self.get('/get_experiments/')
@@ -459,7 +756,81 @@ class ExperimentTestCase(TestCase):
         self._create_experiment()
         response = self.get('/get_experiments/')
         self.assertEqual(len(response['experiments']), 2)
-        self.assertEqual(response['experiments'][1]['key'], self.experiment_key)
+        # same start time, so the newest comes first
+        self.assertEqual(response['experiments'][0]['key'], self.experiment_key)
+
+    def test_get_experiments_conditional(self):
+        self._create_experiment()
+        response = self.client.get('/get_experiments/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get('/get_experiments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/get_experiments/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        self.tick(0.1)
+        self._create_experiment()
+        response = self.client.get('/get_experiments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(simplejson.loads(response.content)['experiments']), 2)
+
+        # the day count of active experiments changes every day
+        etag = response['ETag']
+        self.tick()
+        response = self.client.get('/get_experiments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_experiments_since(self):
+        self._create_experiment()
+        first_key = self.experiment_key
+        self.post('/cancel_experiment/', dict(experiment_key=first_key, reason="testing"))
+        response = self.get('/get_experiments/')
+        since = response['last_updated']
+
+        self.tick(0.1)
+        self._create_experiment()
+        response = self.get('/get_experiments/', dict(since=since))
+        self.assertEqual([e['key'] for e in response['experiments']], [self.experiment_key])
+
+        # once it's cancelled, it only comes back because it changed after "since"
+        self.tick(0.1)
+        self.post('/cancel_experiment/', dict(experiment_key=self.experiment_key, reason="testing"))
+        response = self.get('/get_experiments/', dict(since=since))
+        self.assertEqual([e['key'] for e in response['experiments']], [self.experiment_key])
+        self.assertEqual(response['experiments'][0]['is_cancelled'], True)
+        response = self.get('/get_experiments/', dict(since=response['last_updated']))
+        self.assertEqual(response['experiments'], [])
+
+        response = self.client.get('/get_experiments/', dict(since="not a time"))
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_experiments_pages(self):
+        keys = []
+        for _ in xrange(5):
+            self.tick()
+            self._create_experiment()
+            keys.insert(0, self.experiment_key)
+
+        response = self.get('/get_experiments/', dict(limit=2))
+        self.assertEqual([e['key'] for e in response['experiments']], keys[:2])
+        response = self.get('/get_experiments/', dict(limit=2, cursor=response['next_cursor']))
+        self.assertEqual([e['key'] for e in response['experiments']], keys[2:4])
+        response = self.get('/get_experiments/', dict(limit=2, cursor=response['next_cursor']))
+        self.assertEqual([e['key'] for e in response['experiments']], keys[4:])
+        self.assertEqual(response['next_cursor'], None)
+
+    def test_get_experiments_pages_same_start_time(self):
+        keys = []
+        for _ in xrange(3):
+            self._create_experiment()
+            keys.insert(0, self.experiment_key)
+
+        response = self.get('/get_experiments/', dict(limit=2))
+        self.assertEqual([e['key'] for e in response['experiments']], keys[:2])
+        response = self.get('/get_experiments/', dict(limit=2, cursor=response['next_cursor']))
+        self.assertEqual([e['key'] for e in response['experiments']], keys[2:])
 
     def test_sleep_duration_experiment(self):
         self._create_experiment(type="sleepdurationproductivity")
@@ -778,6 +1149,23 @@ class ExperimentTestCase(TestCase):
         steps = experiment.get_experiment_type()._get_jawbone_activity_steps(experiment, start_date, end_date)
         self.assertEqual(steps, [0,0,20000,0, 1000])
 
+    def test_jawbone_activity_steps_datestring(self):
+        self._create_experiment(type="stepssleepefficiency")
+        now = timezone.now()
+        experiment = Experiment.objects.get(key=self.experiment_key)
+
+        # jawbone's datestring is the user's local day, and wins over whatever day start_time localizes to
+        self._make_jawbone_steps_event(start_offset=-36, end_offset=-24, steps=3000, datestring="20120113")
+        self._make_jawbone_steps_event(start_offset=-60, end_offset=-48, steps=20000)
+
+        start_date = (now - datetime.timedelta(days=4)).date()
+        end_date = (now + datetime.timedelta(days=1)).date()
+        steps = experiment.get_experiment_type()._get_jawbone_activity_steps(experiment, start_date, end_date)
+        self.assertEqual(steps, [0, 20000, 0, 3000, 0])
+
+        events = experiment.get_jawbone_events_by_day("moves", start_date, end_date)
+        self.assertEqual(sorted(events.keys()), [datetime.date(2012, 1, 11), datetime.date(2012, 1, 13)])
+
     def test_realistic_experiment(self):
         self._create_experiment()
         experiment = Experiment.objects.get(key=self.experiment_key)
@@ -821,6 +1209,7 @@ class ExperimentTestCase(TestCase):
         self.assertEqual(response["is_complete"], True)
         self.assertEqual(response['result_value'],90)
         self.assertEqual(response['result_confidence'],.2)
+        self.assertEqual([r['input'] for r in response['stage_results']], [90, 30, 60])
 
     def todo_test_realistic_experiment_with_redo_stages(self):
         self._create_experiment()
@@ -936,4 +1325,815 @@ class ExperimentTestCase(TestCase):
         print response
 
 
+class QueryPlanTestCase(TestCase):
+    '''
+    Runs EXPLAIN on the canonical queries against our biggest tables, and fails if one of them goes back to a full table
+    scan or a filesort. Works against sqlite (the test database) and MySQL (production).
+    '''
+
+    def setUp(self):
+        self.user = User.objects.create(email="plan@bob.johnson", username="plan@bob.johnson")
+        self.experiment = Experiment(user=self.user, experiment_type="leisurehappiness", self_efficacy=1, app_efficacy=1, experiment_efficacy=1)
+        self.experiment.init()
+        self.experiment.save()
+        self.start_date = datetime.date(2012, 1, 1)
+        self.end_date = datetime.date(2012, 1, 8)
+
+    def explain(self, queryset):
+        '''
+        :return: list of (step, is_full_scan, is_filesort), one per step in the query plan
+        '''
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                steps = [row[-1] for row in cursor.fetchall()]
+                return [(step, step.startswith("SCAN"), "TEMP B-TREE" in step) for step in steps]
+
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in cursor.description]
+            steps = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return [(str(step), step["type"] in ("ALL", "index"), "filesort" in (step["Extra"] or "")) for step in steps]
+
+    def assertIndexedPlan(self, queryset, allow_filesort=False):
+        plan = self.explain(queryset)
+        for step, is_full_scan, is_filesort in plan:
+            self.assertFalse(is_full_scan, "Full scan in query plan: %s" % step)
+            if not allow_filesort:
+                self.assertFalse(is_filesort, "Filesort in query plan: %s" % step)
+
+    def test_jawbone_events_plan(self):
+        self.assertIndexedPlan(self.experiment.get_jawbone_events("sleeps", self.start_date, self.end_date))
+
+    def test_jawbone_day_events_plan(self):
+        # the datestring lookup and its timestamp fallback are merged, so we sort the (at most one per day) rows
+        self.assertIndexedPlan(self.experiment.get_jawbone_day_events("moves", self.start_date, self.end_date), allow_filesort=True)
+
+    def test_checkins_plan(self):
+        self.assertIndexedPlan(self.experiment.get_checkins(self.start_date, self.end_date))
+
+    def test_checkins_by_time_plan(self):
+        self.assertIndexedPlan(self.experiment.checkins.filter(checkin_time__gte=timezone.now()).order_by("checkin_time"))
+
+    def test_experiments_plan(self):
+        self.assertIndexedPlan(Experiment.objects.filter(user=self.user).order_by('-start_time', '-id'))
+
+
+class MiddlewareTestCase(TestCase):
+
+    def test_api_requests_skip_sessions(self):
+        client = Client(HTTP_X_APPKEY=passwords.APP_KEY)
+        response = client.post("/obtain_token/", {"email": "middleware@bob.johnson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.wsgi_request, "session"))
+        self.assertNotIn("sessionid", response.cookies)
+
+        response = client.get("/admin/")
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(hasattr(response.wsgi_request, "session"))
+
+    def test_admin_still_checks_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post("/admin/login/", {"username": "bob", "password": "bob"})
+        self.assertEqual(response.status_code, 403)
+
+    def test_benchmark_middleware(self):
+        out = StringIO.StringIO()
+        call_command("benchmark_middleware", requests=10, stdout=out)
+        self.assertIn("/get_experiments/", out.getvalue())
+        self.assertIn("/admin/", out.getvalue())
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        for filename in os.listdir(settings.METRICS_DIR):
+            os.remove(os.path.join(settings.METRICS_DIR, filename))
+        metrics.registry.counters.clear()
+        metrics.registry.histograms.clear()
+        metrics.registry.pid = None
+
+    def get_metrics(self, **kwargs):
+        response = Client().get("/metrics", HTTP_AUTHORIZATION="Bearer " + passwords.METRICS_KEY, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_metrics(self):
+        client = Client(HTTP_X_APPKEY=passwords.APP_KEY)
+        token = simplejson.loads(client.post("/obtain_token/", {"email": "metrics@bob.johnson"}).content)['token']
+        client = Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + token)
+        client.get("/get_experiments/")
+        client.get("/get_experiments/")
+        Client().get("/get_experiments/")
+
+        content = self.get_metrics()
+        self.assertIn('django_requests_total{method="GET",status="200",view="get_experiments"} 2', content)
+        self.assertIn('django_requests_total{method="GET",status="400",view="get_experiments"} 1', content)
+        self.assertIn('django_requests_total{method="POST",status="200",view="obtain_token"} 1', content)
+        self.assertIn('django_request_duration_seconds_count{view="get_experiments"} 3', content)
+        self.assertIn('django_request_queries_bucket{view="get_experiments",le="0.0"} 1', content)
+        self.assertIn('django_request_queries_bucket{view="get_experiments",le="+Inf"} 3', content)
+        self.assertIn('django_response_size_bytes_count{view="obtain_token"} 1', content)
+        self.assertIn('django_db_query_seconds_total{view="obtain_token"}', content)
+
+    def test_metrics_adds_up_processes(self):
+        Client().get("/get_experiments/")
+        self.get_metrics()
+        other_process = os.path.join(settings.METRICS_DIR, "%d-other.json" % os.getppid())
+        shutil.copy(os.path.join(settings.METRICS_DIR, metrics.registry.filename), other_process)
+
+        content = self.get_metrics()
+        self.assertIn('django_requests_total{method="GET",status="400",view="get_experiments"} 2', content)
+        self.assertIn('django_request_duration_seconds_count{view="get_experiments"} 2', content)
+
+    def test_metrics_archives_dead_processes(self):
+        Client().get("/get_experiments/")
+        self.get_metrics()
+        process = subprocess.Popen(["true"])
+        process.wait()
+        dead_process = os.path.join(settings.METRICS_DIR, "%d-dead.json" % process.pid)
+        shutil.copy(os.path.join(settings.METRICS_DIR, metrics.registry.filename), dead_process)
+
+        for _ in xrange(2):
+            content = self.get_metrics()
+            self.assertIn('django_requests_total{method="GET",status="400",view="get_experiments"} 2', content)
+            self.assertFalse(os.path.exists(dead_process))
+
+    def test_metrics_archives_idle_processes(self):
+        Client().get("/get_experiments/")
+        self.get_metrics()
+        path = os.path.join(settings.METRICS_DIR, metrics.registry.filename)
+        old = time.time() - settings.METRICS_FILE_MAX_AGE.total_seconds() - 60
+        os.utime(path, (old, old))
+
+        # archived by a scrape served by another process, and this process's earlier requests aren't counted again
+        self.assertIn('django_request_duration_seconds_count{view="get_experiments"} 1', metrics.render(*metrics.read_all()))
+        self.assertFalse(os.path.exists(path))
+        Client().get("/get_experiments/")
+        self.assertIn('django_request_duration_seconds_count{view="get_experiments"} 2', self.get_metrics())
+
+    def test_metrics_archived_at_exit(self):
+        Client().get("/get_experiments/")
+        metrics.registry.flush(force=True)
+        filename = metrics.registry.filename
+        metrics.registry.close()
+        self.assertEqual(sorted(name for name in os.listdir(settings.METRICS_DIR) if name.endswith(".json")),
+                         [metrics.ARCHIVE_FILENAME])
+        self.assertNotIn(filename, os.listdir(settings.METRICS_DIR))
+        self.assertIn('django_request_duration_seconds_count{view="get_experiments"} 1',
+                      metrics.render(*metrics.read_all()))
+
+    def test_metrics_needs_key(self):
+        self.assertEqual(Client().get("/metrics").status_code, 403)
+        self.assertEqual(Client().get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        with self.settings(METRICS_KEY=""):
+            self.assertEqual(Client().get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+
+@override_settings(SLOW_QUERY_THRESHOLD=datetime.timedelta(0), SLOW_QUERY_BUFFER_SIZE=1000)
+class SlowQueryTestCase(TestCase):
+
+    def setUp(self):
+        slow_queries.clear_slow_queries()
+        client = Client(HTTP_X_APPKEY=passwords.APP_KEY)
+        token = simplejson.loads(client.post("/obtain_token/", {"email": "slow@bob.johnson"}).content)['token']
+        self.client = Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + token)
+        slow_queries.clear_slow_queries()
+
+    def test_slow_queries(self):
+        self.client.get("/get_experiments/")
+        samples = slow_queries.get_slow_queries()
+        self.assertTrue(samples)
+        self.assertTrue(all(sample["path"] == "/get_experiments/" for sample in samples))
+        self.assertTrue(any(sample["frame"].startswith("app/views.py:") and "get_experiments" in sample["frame"] for sample in samples))
+        self.assertIn("app_experiment", samples[0]["sql"])
+
+    def test_slow_queries_threshold(self):
+        with self.settings(SLOW_QUERY_THRESHOLD=None):
+            self.client.get("/get_experiments/")
+        with self.settings(SLOW_QUERY_THRESHOLD=datetime.timedelta(seconds=10)):
+            self.client.get("/get_experiments/")
+        self.assertEqual(slow_queries.get_slow_queries(), [])
+
+    def test_slow_queries_ring_buffer(self):
+        with self.settings(SLOW_QUERY_BUFFER_SIZE=3):
+            for _ in xrange(3):
+                self.client.get("/get_experiments/")
+            self.assertEqual(len(slow_queries.get_slow_queries()), 3)
+
+    def test_slow_queries_admin(self):
+        User.objects.create_superuser("admin", "admin@bob.johnson", "admin")
+        client = Client()
+        client.login(username="admin", password="admin")
+        self.client.get("/get_experiments/")
+        response = client.get("/admin/slow_queries/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/get_experiments/", response.content)
+        self.assertEqual(Client().get("/admin/slow_queries/").status_code, 302)
+
+    def test_dump_slow_queries(self):
+        self.client.get("/get_experiments/")
+        out = StringIO.StringIO()
+        call_command("dump_slow_queries", json=True, clear=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(simplejson.loads(lines[0])["path"], "/get_experiments/")
+        self.assertEqual(slow_queries.get_slow_queries(), [])
+
+
+class ProfilingTestCase(TestCase):
+
+    email = "profile@bob.johnson"
+
+    def setUp(self):
+        client = Client(HTTP_X_APPKEY=passwords.APP_KEY)
+        token = simplejson.loads(client.post("/obtain_token/", {"email": self.email}).content)['token']
+        self.client = Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + token)
+        self.user = User.objects.get(email=self.email)
+
+    def tearDown(self):
+        # the rates are cached outside the test transaction
+        cache.delete(PROFILED_USERS_CACHE_KEY)
+
+    def test_profile_header(self):
+        response = self.client.get("/get_experiments/", HTTP_X_PROFILE=profiling.make_header())
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get(id=response["X-Profile-Id"])
+        self.assertEqual((profile.user, profile.view, profile.reason, profile.path), (self.user, "get_experiments", "header", "/get_experiments/"))
+        self.assertEqual(profile.size, os.path.getsize(profile.get_path()))
+        stats = pstats.Stats(profile.get_path())
+        self.assertTrue(any(function == "_get_experiments_internal" for _, _, function in stats.stats))
+
+    def test_profile_header_invalid(self):
+        response = self.client.get("/get_experiments/", HTTP_X_PROFILE="1234:abcd")
+        self.assertNotIn("X-Profile-Id", response)
+
+        header = profiling.make_header()
+        with freeze_time(timezone.now() + settings.PROFILE_HEADER_MAX_AGE + datetime.timedelta(minutes=1)):
+            response = self.client.get("/get_experiments/", HTTP_X_PROFILE=header)
+        self.assertNotIn("X-Profile-Id", response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_profiled_user(self):
+        profiled_user = ProfiledUser.objects.create(user=self.user, sample_rate=0)
+        self.assertNotIn("X-Profile-Id", self.client.get("/get_experiments/"))
+
+        profiled_user.sample_rate = 1
+        profiled_user.save()
+        response = self.client.get("/get_experiments/")
+        profile = RequestProfile.objects.get(id=response["X-Profile-Id"])
+        self.assertEqual((profile.user, profile.reason), (self.user, "sampled"))
+
+        profiled_user.delete()
+        self.assertNotIn("X-Profile-Id", self.client.get("/get_experiments/"))
+
+    def test_profiled_user_not_sampled_before_token_is_cached(self):
+        ProfiledUser.objects.create(user=self.user, sample_rate=1)
+        token_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertNotIn("X-Profile-Id", self.client.get("/get_experiments/"))
+        self.assertEqual(sum("authtoken" in query["sql"] for query in queries.captured_queries), 1)
+        self.assertIn("X-Profile-Id", self.client.get("/get_experiments/"))
+
+    def test_view_exception(self):
+        with mock.patch("app.views._get_experiments_internal", side_effect=ValueError), \
+                mock.patch("project.middleware.logging.exception") as log_exception:
+            with self.assertRaises(ValueError):
+                self.client.get("/get_experiments/", HTTP_X_PROFILE=profiling.make_header())
+        self.assertTrue(log_exception.called)
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.user, profile.view, profile.reason), (self.user, "get_experiments", "header"))
+        self.assertTrue(os.path.exists(profile.get_path()))
+
+    def test_profiles_are_trimmed(self):
+        def profile():
+            return RequestProfile.objects.get(id=self.client.get("/get_experiments/", HTTP_X_PROFILE=profiling.make_header())["X-Profile-Id"])
+
+        with self.settings(PROFILE_MAX_COUNT=2):
+            oldest = profile()
+            kept = [profile(), profile()]
+        self.assertEqual(list(RequestProfile.objects.order_by("id")), kept)
+        self.assertFalse(os.path.exists(oldest.get_path()))
+        self.assertTrue(all(os.path.exists(profile.get_path()) for profile in kept))
+
+    def test_profile_admin(self):
+        response = self.client.get("/get_experiments/", HTTP_X_PROFILE=profiling.make_header())
+        profile = RequestProfile.objects.get(id=response["X-Profile-Id"])
+
+        User.objects.create_superuser("admin", "admin@bob.johnson", "admin")
+        client = Client()
+        client.login(username="admin", password="admin")
+        self.assertIn(profile.filename, client.get("/admin/app/requestprofile/").content)
+        response = client.get("/admin/app/requestprofile/%d/download/" % profile.id)
+        self.assertEqual(response.status_code, 200)
+        with open(profile.get_path(), "rb") as f:
+            self.assertEqual("".join(response.streaming_content), f.read())
+
+
+class AdminExportTestCase(AdminClientMixin, TestCase):
+
+    def setUp(self):
+        super(AdminExportTestCase, self).setUp()
+        self.user = make_user("export@bob.johnson")
+        self.experiment = make_experiment(self.user)
+        now = timezone.now()
+        for day in xrange(5):
+            time = now - datetime.timedelta(days=day)
+            Checkin.objects.create(experiment=self.experiment, checkin_time=time, did_follow_instructions=1, happiness=day,
+                                   stress=5, productivity=5, leisure_time=60 + day)
+            JawboneMeasurement.objects.create(user=self.user, type="moves", jawbone_id="M%d" % day, steps=8000 + day,
+                                              start_time=time - datetime.timedelta(hours=8), end_time=time, raw_jawbone_object="{}")
+
+    def export(self, url, action, queryset):
+        response = self.client.post(url, {"action": action, "_selected_action": [obj.pk for obj in queryset]})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return "".join(response.streaming_content)
+
+    def read_csv(self, content):
+        self.assertTrue(content.startswith(u'\ufeff'.encode('utf8')))
+        return list(csv.reader(StringIO.StringIO(content[3:])))
+
+    def test_export_users_csv(self):
+        rows = self.read_csv(self.export("/admin/app/user/", "export_users_csv", User.objects.filter(id=self.user.id)))
+        self.assertEqual(rows[0][:3], ["ID", "User", "JawboneAccessToken"])
+        self.assertEqual(rows[1][:2], [str(self.user.id), "export@bob.johnson"])
+        self.assertEqual(rows[1][-1], "America/New_York")
+
+    def test_export_checkins_csv(self):
+        checkins = Checkin.objects.order_by("id")
+        rows = self.read_csv(self.export("/admin/app/checkin/", "export_checkins_csv", checkins))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1], [str(checkins[0].id), checkins[0].key, self.experiment.key, str(checkins[0].checkin_time),
+                                   "1", "0", "5", "5", "60", str(checkins[0].app_version)])
+
+    def test_export_jawbone_measurements_csv(self):
+        measurements = JawboneMeasurement.objects.order_by("id")
+        rows = self.read_csv(self.export("/admin/app/jawbonemeasurement/", "export_jawbone_measurements_csv", measurements))
+        self.assertEqual([row[0] for row in rows[1:]], [str(measurement.id) for measurement in measurements])
+        self.assertEqual(rows[1][1:3], ["export@bob.johnson", "moves"])
+        self.assertEqual(rows[1][11], "8000")
+
+    def _make_history(self, email, experiment_type):
+        '''
+        :return: an experiment in its second stage with 10 days of checkins and jawbone data
+        '''
+        user = make_user(email, timezone="America/Los_Angeles")
+        start_date = (timezone.now() - datetime.timedelta(days=10)).date()
+        experiment = make_experiment(user, experiment_type, days=10, stage_dates=[
+            (0, start_date, start_date + datetime.timedelta(days=7)),
+            (1, start_date + datetime.timedelta(days=7), timezone.now().date() + datetime.timedelta(days=4))])
+        for day in xrange(10):
+            time = timezone.now() - datetime.timedelta(days=day)
+            Checkin.objects.create(experiment=experiment, checkin_time=time, did_follow_instructions=1, happiness=day % 7,
+                                   stress=5, productivity=5, leisure_time=30 * day)
+            JawboneMeasurement.objects.create(user=user, type="moves", jawbone_id="M%d" % day, steps=1000 * day, duration=60 * day,
+                                              start_time=time - datetime.timedelta(hours=8), end_time=time,
+                                              jawbone_datestring=experiment.localize(time).strftime("%Y%m%d") if day % 2 else "")
+            JawboneMeasurement.objects.create(user=user, type="sleeps", jawbone_id="S%d" % day, awake_time=10 * day,
+                                              start_time=time - datetime.timedelta(hours=10), end_time=time - datetime.timedelta(hours=2 + day % 3))
+        return experiment
+
+    def test_download_json(self):
+        from .exports import DateTimeEncoder
+        self._make_history("steps@bob.johnson", "stepssleepefficiency")
+        self._make_history("sleep@bob.johnson", "sleepvariabilitystress")
+        experiments = Experiment.objects.order_by("id")
+
+        expected = []
+        for experiment in experiments:
+            expected.append(dict(user=experiment.user.username,
+                                 stage_data=[experiment.get_stage_data(stage, False) for stage in range(0, 4)],
+                                 all_data=experiment.get_all_data(),
+                                 stage_targets=experiment.get_stage_targets(),
+                                 stage_dates=simplejson.loads(experiment.stage_dates),
+                                 **experiment.to_dict()))
+
+        with CaptureQueriesContext(connection) as one_experiment_queries:
+            self.export("/admin/app/experiment/", "download_json", experiments[:1])
+        with CaptureQueriesContext(connection) as queries:
+            content = self.export("/admin/app/experiment/", "download_json", experiments)
+        self.assertEqual(simplejson.loads(content), simplejson.loads(simplejson.dumps(expected, cls=DateTimeEncoder)))
+        self.assertEqual(len(queries), len(one_experiment_queries))
+
+    def test_daily_arrays(self):
+        from .exports import write_daily_arrays, read_daily_arrays, read_daily_arrays_header
+        first = self._make_history("steps@bob.johnson", "stepssleepefficiency")
+        second = self._make_history("steps2@bob.johnson", "stepssleepefficiency")
+        second.stage_restart_count = simplejson.dumps([1, 2, 0, 0])
+        second.stage_target_values = simplejson.dumps([None, 8000, 11000, 14000])
+        second.start_time = timezone.now() - datetime.timedelta(days=4)
+        second.save()
+
+        path = os.path.join(settings.MEDIA_ROOT, "daily.bin")
+        with open(path, "wb") as f:
+            write_daily_arrays(Experiment.objects.filter(experiment_type="stepssleepefficiency"), f)
+        header, arrays = read_daily_arrays(path)
+        self.assertEqual(header, read_daily_arrays_header(path))
+        self.assertEqual(header["keys"], [first.key, second.key])
+        for name, layout in header["arrays"].items():
+            self.assertEqual(layout["offset"] % 8, 0)
+        days = header["arrays"]["inputs"]["shape"][1]
+        self.assertEqual(header["arrays"]["inputs"]["shape"], [2, 10])
+        self.assertEqual(header["arrays"]["stage_bounds"]["shape"], [2, 4, 2])
+
+        def nan_to_none(values):
+            return [None if value != value else value for value in values]
+
+        data = first.get_all_data()
+        self.assertEqual(nan_to_none(arrays["inputs"][:days]), [value for _, value in data["inputs"]])
+        self.assertEqual(nan_to_none(arrays["outputs"][:days]), [value for _, value in data["outputs"]])
+        # the second experiment is shorter, so padded
+        self.assertEqual(nan_to_none(arrays["inputs"][days + 4:]), [None] * 6)
+        self.assertEqual(list(arrays["stage"][:days]), [0] * 7 + [1] * 3)
+        self.assertEqual(list(arrays["stage_bounds"][:8]), [0, 7, 7, 14, -1, -1, -1, -1])
+        self.assertEqual(list(arrays["restart_counts"]), [0, 0, 0, 0, 1, 2, 0, 0])
+        self.assertEqual(nan_to_none(arrays["targets"][4:]), [None, 8000, 11000, 14000])
+
+    def test_iterate_in_chunks(self):
+        from .exports import iterate_in_chunks
+        measurements = JawboneMeasurement.objects.exclude(jawbone_id="M2")
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(iterate_in_chunks(measurements, ("pk", "jawbone_id"), chunk_size=2))
+        self.assertEqual([jawbone_id for _, jawbone_id in rows], ["M0", "M1", "M3", "M4"])
+        self.assertEqual(len(queries), 3)
+
+
+class AdminChangelistTestCase(AdminClientMixin, TestCase):
+
+    def setUp(self):
+        super(AdminChangelistTestCase, self).setUp()
+        self.users = [User.objects.create(username="list%d@bob.johnson" % i, email="list%d@bob.johnson" % i) for i in xrange(3)]
+        for user in self.users:
+            for i in xrange(4):
+                JawboneMeasurement.objects.create(user=user, type="moves", jawbone_id="%s-%d" % (user.id, i), raw_jawbone_object="{}")
+
+    def test_filter_lists_only_selected(self):
+        response = self.client.get("/admin/app/jawbonemeasurement/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].filter_specs, [])
+        self.assertEqual(response.context["cl"].result_count, 12)
+
+        response = self.client.get("/admin/app/jawbonemeasurement/?user=%d" % self.users[1].id)
+        self.assertEqual(len(response.context["cl"].result_list), 4)
+        self.assertTrue(all(m.user_id == self.users[1].id for m in response.context["cl"].result_list))
+        self.assertEqual([spec.lookup_choices for spec in response.context["cl"].filter_specs],
+                         [[(str(self.users[1].id), "list1@bob.johnson")]])
+
+        response = self.client.get("/admin/app/jawbonemeasurement/", {"q": "list2@"})
+        self.assertEqual(len(response.context["cl"].result_list), 4)
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=5)
+    def test_approximate_counts(self):
+        response = self.client.get("/admin/app/jawbonemeasurement/", {"q": "list"})
+        self.assertEqual(response.context["cl"].result_count, 5)
+
+        with mock.patch("app.admin.estimate_row_count", lambda model: 1000000):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/admin/app/jawbonemeasurement/")
+        self.assertEqual(response.context["cl"].result_count, 1000000)
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"]])
+
+    def test_changelist_queries(self):
+        def changelist_queries(url):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(queries)
+
+        for url in ("/admin/app/jawbonemeasurement/", "/admin/app/experiment/", "/admin/app/checkin/"):
+            before = changelist_queries(url)
+            for user in self.users:
+                experiment = Experiment(user=user, experiment_type="leisurehappiness", self_efficacy=1, app_efficacy=1, experiment_efficacy=1,
+                                        start_time=timezone.now())
+                experiment.save()
+                Checkin.objects.create(experiment=experiment, checkin_time=timezone.now(), did_follow_instructions=1, happiness=1,
+                                       stress=1, productivity=1, leisure_time=1)
+                JawboneMeasurement.objects.create(user=user, type="sleeps", raw_jawbone_object="{}")
+            self.assertEqual(changelist_queries(url), before, url)
+
+
+class CohortDashboardTestCase(AdminClientMixin, TestCase):
+
+    def setUp(self):
+        super(CohortDashboardTestCase, self).setUp()
+        self.active = make_experiment(make_user("active@bob.johnson"))
+        for day in (1, 2, 4):
+            Checkin.objects.create(experiment=self.active, checkin_time=timezone.now() - datetime.timedelta(days=day),
+                                   did_follow_instructions=1, happiness=3, stress=5, productivity=5, leisure_time=60)
+        self.finished = make_experiment(make_user("finished@bob.johnson"), is_active=False, current_stage=4, result_value=45,
+                                        result_confidence=0.55, stage_restart_count=simplejson.dumps([1, 0, 2, 0]))
+        self.cancelled = make_experiment(make_user("cancelled@bob.johnson"), is_active=False, is_cancelled=True)
+
+    def refresh(self):
+        output = StringIO.StringIO()
+        call_command("refresh_experiment_stats", stdout=output)
+        return int(output.getvalue().split()[1])
+
+    def test_dashboard(self):
+        self.assertEqual(self.refresh(), 3)
+        stats = self.active.stats
+        self.assertEqual((stats.days, stats.checkin_days, stats.missed_days), (5, 3, 2))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/admin/cohorts/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries
+                          if "app_checkin" in query["sql"] or "app_jawbonemeasurement" in query["sql"] or '"app_experiment"' in query["sql"]])
+
+        cohort, = response.context["cohorts"]
+        self.assertEqual(cohort["name"], "leisurehappiness")
+        self.assertEqual((cohort["experiments"], cohort["active"], cohort["finished"], cohort["cancelled"]), (3, 1, 1, 1))
+        self.assertEqual(cohort["stages"], [1, 0, 0, 0])
+        self.assertEqual(cohort["restart_rate"], 1.0)
+        self.assertEqual(cohort["checkin_rate"], 3.0 / 15)
+        self.assertEqual(cohort["results"], [(45, 1)])
+        self.assertEqual(dict(cohort["confidences"])["0.5-0.6"], 1)
+
+    def test_refresh_is_incremental(self):
+        self.refresh()
+        self.assertEqual(self.refresh(), 0)
+
+        self.finished.save()
+        Experiment.data_changed_for_user(self.active.user)
+        self.assertEqual(self.refresh(), 2)
+
+        self.freezer.stop()
+        with freeze_time(FROZEN_TIME + settings.EXPERIMENT_STATS_MAX_AGE + datetime.timedelta(minutes=1)):
+            self.assertEqual(self.refresh(), 1)
+        self.freezer.start()
+
+
+class ExportJobTestCase(AdminClientMixin, TestCase):
+
+    def setUp(self):
+        super(ExportJobTestCase, self).setUp()
+        self.user = make_user("export@bob.johnson")
+        experiment = make_experiment(self.user, days=3)
+        for day in xrange(3):
+            time = timezone.now() - datetime.timedelta(days=day)
+            Checkin.objects.create(experiment=experiment, checkin_time=time, did_follow_instructions=1, happiness=day,
+                                   stress=5, productivity=5, leisure_time=60)
+            JawboneMeasurement.objects.create(user=self.user, type="moves", jawbone_id="M%d" % day, steps=8000,
+                                              start_time=time - datetime.timedelta(hours=8), end_time=time, raw_jawbone_object="{}")
+
+    def run_jobs(self):
+        call_command("run_export_jobs", stdout=StringIO.StringIO())
+
+    def test_export_users_in_background(self):
+        response = self.client.post("/admin/app/user/", {"action": "export_users_in_background", "_selected_action": [self.user.id]})
+        self.assertEqual(response.status_code, 302)
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.PENDING)
+        self.assertEqual(job.requested_by.username, "admin")
+        self.assertEqual(list(job.users.all()), [self.user])
+
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertEqual(job.progress, 100)
+        self.assertTrue(job.get_path().startswith(settings.MEDIA_ROOT))
+
+        response = self.client.get("/admin/app/exportjob/")
+        self.assertContains(response, "/admin/app/exportjob/%d/download/" % job.id)
+        response = self.client.get("/admin/app/exportjob/%d/download/" % job.id)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        archive = zipfile.ZipFile(StringIO.StringIO("".join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()),
+                         ["checkins.csv", "daily-leisurehappiness.bin", "experiments.csv", "experiments.json",
+                          "jawbone_measurements.csv", "users.csv"])
+        users = list(csv.reader(StringIO.StringIO(archive.read("users.csv")[3:])))
+        self.assertEqual([row[1] for row in users], ["User", "export@bob.johnson"])
+        self.assertEqual(len(list(csv.reader(StringIO.StringIO(archive.read("checkins.csv")[3:])))), 4)
+        self.assertEqual(len(list(csv.reader(StringIO.StringIO(archive.read("jawbone_measurements.csv")[3:])))), 4)
+        self.assertEqual([experiment["user"] for experiment in simplejson.loads(archive.read("experiments.json"))],
+                         ["export@bob.johnson"])
+
+    def test_all_users(self):
+        job = ExportJob.objects.create()
+        self.run_jobs()
+        job.refresh_from_db()
+        users = list(csv.reader(StringIO.StringIO(zipfile.ZipFile(job.get_path()).read("users.csv")[3:])))
+        self.assertEqual(sorted(row[1] for row in users[1:]), ["admin", "export@bob.johnson"])
+
+    @override_settings(EXPORT_JOB_CONCURRENCY=1)
+    def test_concurrency(self):
+        running = ExportJob.objects.create(status=ExportJob.RUNNING, date_started=timezone.now())
+        pending = ExportJob.objects.create()
+        self.run_jobs()
+        self.assertEqual(ExportJob.objects.get(id=pending.id).status, ExportJob.PENDING)
+
+        # a worker that died doesn't hold its place forever
+        self.freezer.stop()
+        with freeze_time(FROZEN_TIME + settings.EXPORT_JOB_TIMEOUT + datetime.timedelta(minutes=1)):
+            self.run_jobs()
+        self.freezer.start()
+        self.assertEqual(ExportJob.objects.get(id=running.id).status, ExportJob.FAILED)
+        self.assertEqual(ExportJob.objects.get(id=pending.id).status, ExportJob.DONE)
+
+    def test_expiry(self):
+        job = ExportJob.objects.create()
+        self.run_jobs()
+        job.refresh_from_db()
+        path = job.get_path()
+        self.assertTrue(os.path.exists(path))
+
+        self.freezer.stop()
+        with freeze_time(FROZEN_TIME + settings.EXPORT_JOB_LIFESPAN + datetime.timedelta(minutes=1)):
+            self.run_jobs()
+        self.freezer.start()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.EXPIRED)
+        self.assertEqual(job.archive, "")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.client.get("/admin/app/exportjob/%d/download/" % job.id).status_code, 404)
+
+    def archive_files(self):
+        archive_dir = os.path.join(settings.MEDIA_ROOT, ExportJob.ARCHIVE_DIR)
+        return [name for name in os.listdir(archive_dir) if name.startswith("export-")] if os.path.isdir(archive_dir) else []
+
+    def test_failure(self):
+        job = ExportJob.objects.create()
+        files = self.archive_files()
+        with mock.patch("app.exports.write_daily_arrays", side_effect=IOError("disk full")):
+            self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message, job.archive), (ExportJob.FAILED, "IOError: disk full", ""))
+        self.assertEqual(self.archive_files(), files)
+
+    def test_timed_out_job_stays_failed(self):
+        from .exports import build_archive
+        job = ExportJob.objects.create()
+        files = self.archive_files()
+
+        def slow_build_archive(job):
+            archive = build_archive(job)
+            with freeze_time(FROZEN_TIME + settings.EXPORT_JOB_TIMEOUT + datetime.timedelta(minutes=1)):
+                call_command("run_export_jobs", stdout=StringIO.StringIO())
+            return archive
+
+        with mock.patch("app.exports.build_archive", side_effect=slow_build_archive):
+            self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message, job.archive), (ExportJob.FAILED, "Timed out", ""))
+        self.assertEqual(self.archive_files(), files)
+
+    def test_stale_partial_archives(self):
+        archive_dir = os.path.join(settings.MEDIA_ROOT, ExportJob.ARCHIVE_DIR)
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        stale, recent = os.path.join(archive_dir, "export-1-stale.zip.part"), os.path.join(archive_dir, "export-2-recent.zip.part")
+        for path in (stale, recent):
+            open(path, "w").close()
+        for path, modified in ((stale, FROZEN_TIME - settings.EXPORT_JOB_TIMEOUT - datetime.timedelta(minutes=1)), (recent, FROZEN_TIME)):
+            modified = (modified - datetime.datetime(1970, 1, 1)).total_seconds()
+            os.utime(path, (modified, modified))
+
+        self.run_jobs()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(recent))
+        os.remove(recent)
+
+
+# Maximum number of queries each endpoint in app/urls.py may issue, whatever the size of the user's history
+QUERY_BUDGETS = {
+    "obtain_token": 2,
+    "set_user_data": 2,
+    "start_experiment": 3,
+    "experiment_checkin": 8,
+    "batch_checkin": 8,
+    "get_experiments": 2,
+    "refresh_instructions": 3,
+    "cancel_experiment": 3,
+    "jawbone_webhook": 1,
+    "update_jawbone": 0,
+}
+
+
+@mock.patch("app.jawbone.get_user_id", lambda x: "7890")
+class QueryBudgetTestCase(FrozenTimeMixin, TestCase):
+    '''
+    Records the SQL each API endpoint issues against 1, 30 and 90 days of history, and fails if an endpoint goes over
+    its budget in QUERY_BUDGETS or if its query count grows with the history.
+    '''
+
+    email = "budget@bob.johnson"
+    history_sizes = (1, 30, 90)
+
+    def setUp(self):
+        super(QueryBudgetTestCase, self).setUp()
+        self.client = Client(HTTP_X_APPKEY=passwords.APP_KEY)
+        self.token = simplejson.loads(self.client.post("/obtain_token/", {"email": self.email}).content)['token']
+        self.client = Client(HTTP_X_APPKEY=passwords.APP_KEY, HTTP_AUTHORIZATION='Token ' + self.token)
+        self.user = User.objects.get(email=self.email)
+        self.user.jawbone_user_id = "7890"
+        self.user.save()
+
+    def _make_history(self, days, experiment_type):
+        '''
+        An active experiment that started `days` ago with a checkin and jawbone data for every one of those days. Its
+        current stage always started yesterday, so every history size asks the same question of the same stage.
+        '''
+        now = timezone.now()
+        today = now.date()
+
+        experiment = make_experiment(self.user, experiment_type, days=days,
+                                     stage_dates=[(0, today - datetime.timedelta(days=1), today + datetime.timedelta(days=6))])
+
+        checkins = []
+        measurements = []
+        for day in xrange(days):
+            time = now - datetime.timedelta(days=day)
+            checkins.append(Checkin(experiment=experiment, key="C%d" % day, checkin_time=time, did_follow_instructions=1,
+                                    happiness=5, stress=5, productivity=5, leisure_time=60,
+                                    local_day=experiment.localize(time).date() - datetime.timedelta(days=1)))
+            measurements.append(JawboneMeasurement(user=self.user, type="moves", jawbone_id="M%d" % day, steps=8000,
+                                                   start_time=time - datetime.timedelta(hours=8), end_time=time,
+                                                   jawbone_datestring=experiment.localize(time).strftime("%Y%m%d")))
+            measurements.append(JawboneMeasurement(user=self.user, type="sleeps", jawbone_id="S%d" % day, awake_time=30,
+                                                   start_time=time - datetime.timedelta(hours=10), end_time=time - datetime.timedelta(hours=2)))
+        Checkin.objects.bulk_create(checkins)
+        JawboneMeasurement.objects.bulk_create(measurements)
+        return experiment
+
+    def _request(self, url_name, experiment):
+        checkin = dict(experiment_key=experiment.key, did_follow_instructions=3, happy=4, stress=5, productivity=6, leisure_time=120)
+        user_data = dict(jawbone_access="1234", jawbone_reset="5678", date_of_birth="1985-01-13", race="white", gender="m",
+                         happy=4, stress=3, activity="three", sleep_quality=6, timezone="America/New_York")
+        start = dict(type=experiment.experiment_type, self_efficacy=3, app_efficacy=5, experiment_efficacy=8)
+        batch = dict(experiment_key=experiment.key, checkins=simplejson.dumps([
+            dict(checkin_time=(timezone.now() - datetime.timedelta(hours=hours)).isoformat(), did_follow_instructions=3,
+                 happy=4, stress=5, productivity=6, leisure_time=120) for hours in (2, 1, 0)]))
+        webhook = simplejson.dumps(dict(events=[dict(action="creation", type="move", user_xid="7890")]))
+
+        requests = {
+            "obtain_token": lambda: Client(HTTP_X_APPKEY=passwords.APP_KEY).post("/obtain_token/", {"email": self.email}),
+            "set_user_data": lambda: self.client.post("/set_user_data/", user_data),
+            "start_experiment": lambda: self.client.post("/start_experiment/", start),
+            "experiment_checkin": lambda: self.client.post("/experiment_checkin/", checkin),
+            "batch_checkin": lambda: self.client.post("/batch_checkin/", batch),
+            "get_experiments": lambda: self.client.get("/get_experiments/"),
+            "refresh_instructions": lambda: self.client.get("/refresh_instructions/", dict(experiment_key=experiment.key)),
+            "cancel_experiment": lambda: self.client.post("/cancel_experiment/", dict(experiment_key=experiment.key, reason="budget")),
+            "jawbone_webhook": lambda: self.client.post("/jawbone_webhook", webhook, content_type="application/json"),
+            "update_jawbone": lambda: self.client.get("/update_jawbone"),
+        }
+        return requests[url_name]()
+
+    def count_queries(self, url_name, days, experiment_type="leisurehappiness"):
+        '''
+        :return: list of SQL statements issued by one request to the endpoint
+        '''
+        experiment = self._make_history(days, experiment_type)
+        with mock.patch("app.jawbone.update_jawbone_moves"), mock.patch("app.jawbone.update_jawbone_all"):
+            with CaptureQueriesContext(connection) as queries:
+                response = self._request(url_name, experiment)
+        self.assertEqual(response.status_code, 200)
+        return [query["sql"] for query in queries.captured_queries]
+
+    def assertQueryBudget(self, url_name, experiment_type="leisurehappiness"):
+        counts = []
+        for days in self.history_sizes:
+            with transaction.atomic():
+                queries = self.count_queries(url_name, days, experiment_type)
+                transaction.set_rollback(True)
+            self.assertLessEqual(len(queries), QUERY_BUDGETS[url_name],
+                                 "%s issued %d queries for %d days of history, budget is %d:\n%s" %
+                                 (url_name, len(queries), days, QUERY_BUDGETS[url_name], "\n".join(queries)))
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, "%s query count grows with history: %s" % (url_name, dict(zip(self.history_sizes, counts))))
+
+    def test_every_endpoint_has_a_budget(self):
+        from .urls import urlpatterns
+        self.assertEqual(set(pattern.name for pattern in urlpatterns), set(QUERY_BUDGETS.keys()))
+
+    def test_obtain_token(self):
+        self.assertQueryBudget("obtain_token")
+
+    def test_set_user_data(self):
+        self.assertQueryBudget("set_user_data")
+
+    def test_start_experiment(self):
+        self.assertQueryBudget("start_experiment")
+
+    def test_experiment_checkin(self):
+        for experiment_type in EXPERIMENT_TYPES:
+            self.assertQueryBudget("experiment_checkin", experiment_type)
+
+    def test_batch_checkin(self):
+        for experiment_type in EXPERIMENT_TYPES:
+            self.assertQueryBudget("batch_checkin", experiment_type)
+
+    def test_get_experiments(self):
+        self.assertQueryBudget("get_experiments")
+
+    def test_refresh_instructions(self):
+        for experiment_type in EXPERIMENT_TYPES:
+            self.assertQueryBudget("refresh_instructions", experiment_type)
+
+    def test_cancel_experiment(self):
+        self.assertQueryBudget("cancel_experiment")
+
+    def test_jawbone_webhook(self):
+        self.assertQueryBudget("jawbone_webhook")
 
+    def test_update_jawbone(self):
+        self.assertQueryBudget("update_jawbone")
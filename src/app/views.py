@@ -1,4 +1,4 @@
-import simplejson, pytz, StringIO
+import simplejson, pytz, StringIO, base64, zlib
 import datetime, random, math
 from decimal import Decimal
 from dateutil.parser import parse as parse_date
@@ -13,21 +13,46 @@ from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.shortcuts import get_object_or_404
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.utils.cache import patch_vary_headers
 from django.utils import timezone
+from django.db import transaction, IntegrityError
+from django.core.cache import cache
+from django.db.models import Q, Max, Count
 
 from .decorators import app_view
+from .renderers import MsgpackRenderer
 from django.conf import settings
 from django import forms
 
-from models import User, races, genders, Experiment, Checkin
+from models import User, races, genders, Experiment, Checkin, IdempotentResponse
 
 import jawbone
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+RESPONSE_CACHE_TIMEOUT = 60 * 60 * 24
+
+MAX_EXPERIMENTS_PAGE_SIZE = 100
+
+# the app uploads at most a few weeks of offline checkins at once
+MAX_BATCH_CHECKINS = 200
+
 def json_response(**kwargs):
     return HttpResponse(simplejson.dumps(kwargs))
 
+def api_response(request, **kwargs):
+    '''
+    Like json_response, but sends msgpack to clients that ask for it in their Accept header, since it's smaller and
+    faster to parse on low-end phones
+    '''
+    if MsgpackRenderer.media_type in request.META.get("HTTP_ACCEPT", ""):
+        response = HttpResponse(MsgpackRenderer().render(kwargs), content_type=MsgpackRenderer.media_type)
+    else:
+        response = json_response(**kwargs)
+    patch_vary_headers(response, ("Accept",))
+    return response
+
 def context(**extra):
     return dict(**extra)
 
@@ -149,8 +174,7 @@ def start_experiment(request):
     return json_response(success=False)
 
 
-class ExperimentCheckinForm(forms.Form):
-    experiment_key = forms.CharField(required=True)
+class CheckinDataForm(forms.Form):
     did_follow_instructions = forms.IntegerField(required=True)
     happy = forms.IntegerField(required=True)
     stress = forms.IntegerField(required=True)
@@ -159,6 +183,166 @@ class ExperimentCheckinForm(forms.Form):
     app_version = forms.CharField(required=False)
 
 
+class ExperimentCheckinForm(CheckinDataForm):
+    experiment_key = forms.CharField(required=True)
+    idempotency_key = forms.CharField(required=False, max_length=64)
+    stage_version = forms.CharField(required=False)
+
+
+class BatchCheckinItemForm(CheckinDataForm):
+    checkin_time = forms.CharField(required=True)
+
+    def clean_checkin_time(self):
+        try:
+            checkin_time = parse_date(self.cleaned_data["checkin_time"])
+        except (ValueError, OverflowError):
+            raise forms.ValidationError("Invalid checkin time.")
+        if timezone.is_naive(checkin_time):
+            checkin_time = timezone.make_aware(checkin_time, pytz.UTC)
+        # phones' clocks drift, and a checkin can't come from the future
+        return min(checkin_time, timezone.now())
+
+
+class BatchCheckinForm(forms.Form):
+    experiment_key = forms.CharField(required=True)
+    checkins = forms.CharField(required=True)  # json'ed list of checkins, each with a checkin_time
+    idempotency_key = forms.CharField(required=False, max_length=64)
+    stage_version = forms.CharField(required=False)
+
+    def clean_checkins(self):
+        try:
+            checkins = simplejson.loads(self.cleaned_data["checkins"])
+        except simplejson.JSONDecodeError:
+            raise forms.ValidationError("Checkins must be a JSON list.")
+        if not isinstance(checkins, list) or not checkins:
+            raise forms.ValidationError("Checkins must be a JSON list.")
+        if len(checkins) > MAX_BATCH_CHECKINS:
+            raise forms.ValidationError("Too many checkins.", code="too_many")
+
+        cleaned_checkins = []
+        for checkin in checkins:
+            form = BatchCheckinItemForm(checkin if isinstance(checkin, dict) else None)
+            if not form.is_valid():
+                raise forms.ValidationError("Invalid checkin.")
+            cleaned_checkins.append(form.cleaned_data)
+        return sorted(cleaned_checkins, key=lambda c: c["checkin_time"])
+
+
+def _make_checkin(experiment, data, checkin_time):
+    checkin = Checkin()
+    checkin.experiment = experiment
+    checkin.checkin_time = checkin_time
+    checkin.did_follow_instructions = data.get("did_follow_instructions")
+    checkin.happiness = data.get("happy")
+    checkin.stress = data.get("stress")
+    checkin.productivity = data.get("productivity")
+    checkin.leisure_time = data.get("leisure_time")
+    checkin.app_version = data.get("app_version", "")
+    checkin.local_day = checkin.get_local_day()
+    return checkin
+
+
+def _get_idempotent_scope(request, experiment):
+    return "%s %s %s" % (request.resolver_match.url_name, request.path, experiment.key)
+
+
+def _get_idempotent_response(request, idempotency_key, experiment):
+    '''
+    The app retries checkins on flaky networks. A retry gets the response we stored the first time, so we don't check
+    in twice. A key the app already used for another endpoint or experiment gets a 409, rather than that response.
+    :return: the response to send, or None if the request is new
+    '''
+    if not idempotency_key:
+        return None
+    previous = IdempotentResponse.objects.filter(user=request.user, key=idempotency_key).first()
+    if previous is None:
+        return None
+    # responses stored before scopes were have none
+    if previous.scope and previous.scope != _get_idempotent_scope(request, experiment):
+        return HttpResponse(status=409)
+    return api_response(request, **simplejson.loads(previous.response))
+
+
+def _save_idempotent_payload(request, idempotency_key, experiment, payload):
+    '''
+    Must be called in the transaction that did the work, which is rolled back if a concurrent request with the same key
+    for another experiment stored its response first.
+    :return: the 409 to send in that case, otherwise None
+    '''
+    if not idempotency_key:
+        return None
+    try:
+        with transaction.atomic():
+            IdempotentResponse.objects.create(user=request.user, key=idempotency_key, response=simplejson.dumps(payload),
+                                              scope=_get_idempotent_scope(request, experiment))
+    except IntegrityError:
+        transaction.set_rollback(True)
+        return HttpResponse(status=409)
+    return None
+
+
+def _get_stage_version(experiment, inputs, outputs):
+    '''
+    Identifies the stage data the client holds: the stage, when it started, and a checksum for each day
+    '''
+    start, _ = experiment.get_stage_dates(experiment.current_stage)
+    days = "".join("%08x" % (zlib.crc32(simplejson.dumps(day)) & 0xffffffff) for day in zip(inputs, outputs))
+    return "%d.%s.%s" % (experiment.current_stage, start.isoformat() if start else "", days)
+
+
+def _apply_stage_delta(result, client_version):
+    '''
+    If the client already holds data for the same stage, replace the full stage_inputs and stage_outputs with just
+    the days that are new or changed since its stage_version, as [day index, input, output].
+    '''
+    if not client_version or 'stage_version' not in result:
+        return result
+
+    stage, _, days = result['stage_version'].rpartition(".")
+    client_stage, _, client_days = client_version.rpartition(".")
+    if stage != client_stage:
+        return result
+
+    result = dict(result)
+    inputs = result.pop('stage_inputs')
+    outputs = result.pop('stage_outputs')
+    changed = [i for i in xrange(len(inputs)) if days[i * 8:i * 8 + 8] != client_days[i * 8:i * 8 + 8]]
+    result['stage_delta'] = dict(length=len(inputs), days=[[i, inputs[i], outputs[i]] for i in changed])
+    return result
+
+
+def _evaluate_stage(experiment, result):
+    '''
+    Runs the stage state machine once the experiment's checkins are saved, and fills in the checkin result. Stage data
+    is computed once and shared by every step. The caller saves the experiment.
+    '''
+    experiment.cache_stage_data()
+
+    should_end, ended_early, restarted_stage = experiment.should_end_stage()
+
+    if restarted_stage:
+        result['restarted_stage'] = restarted_stage
+
+    if should_end:
+        result['new_stage'] = True
+        result['ended_early'] = ended_early
+        experiment.end_stage()
+
+    inputs, outputs = experiment.get_stage_data(experiment.current_stage, always_get_median=True)
+    result['stage_inputs'] = inputs
+    result['stage_outputs'] = outputs
+    result['stage_version'] = _get_stage_version(experiment, inputs, outputs)
+    result['target'] = experiment.get_daily_target(experiment.current_stage, len(result['stage_inputs']) - 1)
+    result['current_stage'] = experiment.current_stage
+
+    if not experiment.is_active:
+        experiment.calculate_results()
+        result['is_complete'] = True
+        result['result_value'] = experiment.result_value
+        result['result_confidence'] = experiment.result_confidence
+        result['stage_results'] = simplejson.loads(experiment.stage_results)
+
+
 @app_view
 @api_view(['POST'])
 @permission_classes((IsAuthenticated,))
@@ -169,51 +353,82 @@ def experiment_checkin(request):
     if form.is_valid():
         data = form.cleaned_data
 
-        experiment = Experiment.objects.get(key=data.get("experiment_key"))
+        with transaction.atomic():
+            # lock the experiment, so concurrent checkins can't both advance the stage
+            experiment = Experiment.objects.select_for_update().select_related('user').get(key=data.get("experiment_key"))
 
-        checkin = Checkin()
-        checkin.experiment = experiment
-        checkin.checkin_time = timezone.now()
-        checkin.did_follow_instructions = data.get("did_follow_instructions")
-        checkin.happiness = data.get("happy")
-        checkin.stress = data.get("stress")
-        checkin.productivity = data.get("productivity")
-        checkin.leisure_time = data.get("leisure_time")
-        checkin.app_version = data.get("app_version", "")
+            response = _get_idempotent_response(request, data.get("idempotency_key"), experiment)
+            if response is not None:
+                return response
 
-        day = (checkin.checkin_time.date() - experiment.start_time.date()).days + 1
+            checkin = _make_checkin(experiment, data, timezone.now())
 
-        checkin.save()
+            day = (checkin.checkin_time.date() - experiment.start_time.date()).days + 1
 
-        result = dict(day=day)
+            checkin.save()
 
-        should_end, ended_early, restarted_stage = experiment.should_end_stage()
+            result = dict(day=day)
 
-        if restarted_stage:
-            result['restarted_stage'] = restarted_stage
+            _evaluate_stage(experiment, result)
+            # saved even if the stage didn't change, to bump its data version for the new checkins
             experiment.save()
 
-        if should_end:
-            result['new_stage'] = True
-            result['ended_early'] = ended_early
-            experiment.end_stage()
-            experiment.save()
+            payload = dict(success=True, key=experiment.key, result=_apply_stage_delta(result, data.get("stage_version")))
+            response = _save_idempotent_payload(request, data.get("idempotency_key"), experiment, payload)
+            if response is not None:
+                return response
 
-        inputs, outputs = experiment.get_stage_data(experiment.current_stage, always_get_median=True)
-        result['stage_inputs'] = inputs
-        result['stage_outputs'] = outputs
-        result['target'] = experiment.get_daily_target(experiment.current_stage, len(result['stage_inputs']) - 1)
-        result['current_stage'] = experiment.current_stage
+        return api_response(request, **payload)
+
+    return json_response(success=False)
+
+
+@app_view
+@api_view(['POST'])
+@permission_classes((IsAuthenticated,))
+def batch_checkin(request):
+    '''
+    Checkins the app saved while offline, uploaded together. They're inserted in one go, and the stage is only
+    evaluated for the final state. The response is the same as experiment_checkin's.
+    '''
+
+    form = BatchCheckinForm(request.POST)
+
+    if form.has_error("checkins", code="too_many"):
+        return HttpResponseBadRequest()
+
+    if form.is_valid():
+        data = form.cleaned_data
+
+        with transaction.atomic():
+            experiment = Experiment.objects.select_for_update().select_related('user').get(key=data.get("experiment_key"))
 
-        if not experiment.is_active:
-            experiment.calculate_results()
+            response = _get_idempotent_response(request, data.get("idempotency_key"), experiment)
+            if response is not None:
+                return response
+
+            # the checkins are sorted, so only the first can be from before the experiment started
+            if data["checkins"][0]["checkin_time"] < experiment.start_time:
+                return HttpResponseBadRequest()
+
+            checkins = [_make_checkin(experiment, item, item["checkin_time"]) for item in data["checkins"]]
+            Checkin.generate_keys(checkins)
+            Checkin.objects.bulk_create(checkins)
+
+            day = (checkins[-1].checkin_time.date() - experiment.start_time.date()).days + 1
+
+            result = dict(day=day)
+
+            _evaluate_stage(experiment, result)
+            # saved even if the stage didn't change, to bump its data version for the new checkins
             experiment.save()
-            result['is_complete'] = True
-            result['result_value'] = experiment.result_value
-            result['result_confidence'] = experiment.result_confidence
-            result['stage_results'] = experiment.stage_results
 
-        return json_response(success=True, key=experiment.key, result=result)
+            payload = dict(success=True, key=experiment.key, result=_apply_stage_delta(result, data.get("stage_version")))
+            response = _save_idempotent_payload(request, data.get("idempotency_key"), experiment, payload)
+            if response is not None:
+                return response
+
+        return api_response(request, **payload)
 
     return json_response(success=False)
 
@@ -222,14 +437,22 @@ def experiment_checkin(request):
 @api_view(['GET'])
 @permission_classes((IsAuthenticated,))
 def refresh_instructions(request):
-    experiment = Experiment.objects.get(key=request.GET.get("experiment_key"))
-    inputs, outputs = experiment.get_stage_data(experiment.current_stage, always_get_median=True)
-    result = dict()
-    result['stage_inputs'] = inputs
-    result['stage_outputs'] = outputs
-    result['target'] = experiment.get_daily_target(experiment.current_stage, len(result['stage_inputs']) - 1)
-    result['current_stage'] = experiment.current_stage
-    return json_response(success=True, key=experiment.key, result=result)
+    experiment = Experiment.objects.select_related('user').get(key=request.GET.get("experiment_key"))
+
+    # the app polls this, and the answer only changes with the experiment's data version or the user's day
+    cache_key = experiment.get_data_cache_key("refresh_instructions")
+    result = cache.get(cache_key)
+    if result is None:
+        inputs, outputs = experiment.get_stage_data(experiment.current_stage, always_get_median=True)
+        result = dict()
+        result['stage_inputs'] = inputs
+        result['stage_outputs'] = outputs
+        result['stage_version'] = _get_stage_version(experiment, inputs, outputs)
+        result['target'] = experiment.get_daily_target(experiment.current_stage, len(result['stage_inputs']) - 1)
+        result['current_stage'] = experiment.current_stage
+        cache.set(cache_key, result, RESPONSE_CACHE_TIMEOUT)
+
+    return api_response(request, success=True, key=experiment.key, result=_apply_stage_delta(result, request.GET.get("stage_version")))
 
 
 @app_view
@@ -251,19 +474,104 @@ def cancel_experiment(request):
     return _get_experiments_internal(request)
 
 
+def _get_experiments_version(request):
+    '''
+    The last time any of the user's experiments changed, and how many there are. Computed once per request.
+    '''
+    if not hasattr(request, "experiments_version"):
+        request.experiments_version = Experiment.objects.filter(user=request.user).aggregate(last_updated=Max('date_updated'), count=Count('id'))
+    return request.experiments_version
+
+
+def _get_experiments_etag(request):
+    version = _get_experiments_version(request)
+    last_updated = version['last_updated'].isoformat() if version['last_updated'] else ""
+    # "days" in Experiment.to_dict moves on every day without the experiment being saved
+    return "%d-%s-%s" % (version['count'], last_updated, timezone.now().date().isoformat())
+
+
+def _get_experiments_last_modified(request):
+    last_updated = _get_experiments_version(request)['last_updated']
+    today = datetime.datetime.combine(timezone.now().date(), datetime.time.min).replace(tzinfo=pytz.UTC)
+    return max(last_updated, today) if last_updated else today
+
+
+def _make_experiments_cursor(experiment):
+    return base64.urlsafe_b64encode("%s|%d" % (experiment.start_time.isoformat(), experiment.id))
+
+
+def _parse_experiments_cursor(cursor):
+    start_time, experiment_id = base64.urlsafe_b64decode(str(cursor)).split("|")
+    return parse_date(start_time), int(experiment_id)
+
+
+class GetExperimentsForm(forms.Form):
+    since = forms.CharField(required=False)
+    cursor = forms.CharField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=MAX_EXPERIMENTS_PAGE_SIZE)
+
+    def clean_since(self):
+        since = self.cleaned_data.get("since")
+        if not since:
+            return None
+        try:
+            since = parse_date(since)
+        except (ValueError, OverflowError):
+            raise forms.ValidationError("Invalid since time.")
+        return timezone.make_aware(since, pytz.UTC) if timezone.is_naive(since) else since
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data.get("cursor")
+        if not cursor:
+            return None
+        try:
+            return _parse_experiments_cursor(cursor)
+        except (TypeError, ValueError, OverflowError):
+            raise forms.ValidationError("Invalid cursor.")
+
+
 @app_view
 @api_view(['GET'])
 @permission_classes((IsAuthenticated,))
+@condition(etag_func=_get_experiments_etag, last_modified_func=_get_experiments_last_modified)
 def get_experiments(request):
-    return _get_experiments_internal(request)
+    '''
+    Supports conditional GETs, "since" to only get experiments that changed after a time, and "limit" and "cursor" to
+    page through long histories.
+    '''
+
+    form = GetExperimentsForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest()
+
+    data = form.cleaned_data
+    return _get_experiments_internal(request, since=data["since"], cursor=data["cursor"], limit=data["limit"],
+                                     last_updated=_get_experiments_version(request)['last_updated'])
+
+
+def _get_experiments_internal(request, since=None, cursor=None, limit=None, last_updated=None):
+    experiments = Experiment.objects.filter(user=request.user).order_by('-start_time', '-id')
+
+    if since:
+        # active experiments' day counts change without them being saved, so those always come along
+        experiments = experiments.filter(Q(date_updated__gt=since) | Q(is_active=True))
+
+    if cursor:
+        start_time, experiment_id = cursor
+        experiments = experiments.filter(Q(start_time__lt=start_time) | Q(start_time=start_time, id__lt=experiment_id))
 
+    extra = dict()
+    if last_updated:
+        extra['last_updated'] = last_updated.isoformat()
 
-def _get_experiments_internal(request):
-    experiments = Experiment.objects.filter(user=request.user).order_by('-start_time')
+    if limit:
+        experiments = list(experiments[:limit + 1])
+        extra['next_cursor'] = _make_experiments_cursor(experiments[limit - 1]) if len(experiments) > limit else None
+        experiments = experiments[:limit]
 
     experiments_json = [experiment.to_dict() for experiment in experiments]
 
-    return json_response(success=True, experiments=experiments_json)
+    return json_response(success=True, experiments=experiments_json, **extra)
 
 
 @csrf_exempt
@@ -0,0 +1,372 @@
+'''
+Request metrics in the Prometheus text format.
+
+Each worker process keeps its own totals in memory and writes them to a file of its own in METRICS_DIR every
+METRICS_FLUSH_INTERVAL. The /metrics view adds up every file, so it reports the whole server whichever worker serves
+it, and no two processes ever write to the same file. Totals are never reset: a process that exits, or whose file
+hasn't been written for METRICS_FILE_MAX_AGE, has its file folded into the archive file, which counts towards them.
+'''
+
+import atexit, errno, fcntl, os, threading, time, uuid, tempfile
+import simplejson
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+ARCHIVE_FILENAME = "archive.json"
+LOCK_FILENAME = "metrics.lock"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+HELP = {
+    "django_requests_total": ("counter", "Requests by view, method and response status."),
+    "django_request_duration_seconds": ("histogram", "Time from the first middleware to the response, by view."),
+    "django_response_size_bytes": ("histogram", "Size of non-streaming responses, by view."),
+    "django_request_queries": ("histogram", "SQL queries issued per request, by view."),
+    "django_db_query_seconds_total": ("counter", "Time spent in SQL queries, by view."),
+}
+
+
+class Registry(object):
+    '''
+    Counters and histograms for this process. Metrics are keyed by name and a sorted tuple of label pairs.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = time.time()
+        self.pid = None
+        self.filename = None
+        # (counters, histograms) as last written to filename
+        self.flushed = None
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = dict(buckets=list(buckets), counts=[0] * len(buckets), sum=0, count=0)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        '''
+        :return: copies of (counters, histograms)
+        '''
+        with self.lock:
+            return dict(self.counters), dict((key, dict(histogram, counts=list(histogram["counts"])))
+                                             for key, histogram in self.histograms.items())
+
+    def subtract(self, counters, histograms):
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] -= value
+            for key, histogram in histograms.items():
+                total = self.histograms[key]
+                total["counts"] = [a - b for a, b in zip(total["counts"], histogram["counts"])]
+                total["sum"] -= histogram["sum"]
+                total["count"] -= histogram["count"]
+
+    def flush(self, force=False):
+        '''
+        Writes this process's totals to its file in METRICS_DIR, at most once every METRICS_FLUSH_INTERVAL unless forced.
+        The file is replaced with a rename, so readers never see half of it.
+        '''
+        now = time.time()
+        if not force and now - self.last_flush < settings.METRICS_FLUSH_INTERVAL.total_seconds():
+            return
+        self.last_flush = now
+
+        if self.pid != os.getpid():
+            # a new worker, which may have been forked after this module was imported
+            self.pid = os.getpid()
+            self.filename = _make_filename()
+            self.flushed = None
+        with _locked():
+            if self.flushed is not None and not os.path.exists(os.path.join(settings.METRICS_DIR, self.filename)):
+                # archived while this process was idle; the archive has what we last wrote
+                self.subtract(*self.flushed)
+                self.filename = _make_filename()
+            self.flushed = self.snapshot()
+            _write(self.filename, *self.flushed)
+
+    def close(self):
+        '''
+        Folds this process's totals into the archive, at exit
+        '''
+        if self.pid != os.getpid():
+            return
+        self.flush(force=True)
+        with _locked():
+            _archive([self.filename])
+        self.pid = self.filename = self.flushed = None
+
+
+registry = Registry()
+atexit.register(registry.close)
+
+
+def _make_filename():
+    return "%d-%s.json" % (os.getpid(), uuid.uuid4().hex)
+
+
+@contextmanager
+def _locked():
+    '''
+    Held while writing a process's file or the archive, so a process's file isn't archived half way through a flush
+    '''
+    if not os.path.isdir(settings.METRICS_DIR):
+        os.makedirs(settings.METRICS_DIR)
+    with open(os.path.join(settings.METRICS_DIR, LOCK_FILENAME), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _to_json(counters, histograms, **extra):
+    return dict(counters=[[name, dict(labels), value] for (name, labels), value in counters.items()],
+                histograms=[[name, dict(labels), histogram] for (name, labels), histogram in histograms.items()],
+                **extra)
+
+
+def _write(filename, counters, histograms, **extra):
+    fd, path = tempfile.mkstemp(dir=settings.METRICS_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        simplejson.dump(_to_json(counters, histograms, **extra), f)
+    os.rename(path, os.path.join(settings.METRICS_DIR, filename))
+
+
+def _read(filename):
+    '''
+    :return: the file's data, or None if it's gone
+    '''
+    try:
+        with open(os.path.join(settings.METRICS_DIR, filename)) as f:
+            return simplejson.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _add(counters, histograms, data):
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, histogram in data["histograms"]:
+        key = (name, tuple(sorted(labels.items())))
+        total = histograms.setdefault(key, dict(buckets=histogram["buckets"], counts=[0] * len(histogram["buckets"]), sum=0, count=0))
+        total["counts"] = [a + b for a, b in zip(total["counts"], histogram["counts"])]
+        total["sum"] += histogram["sum"]
+        total["count"] += histogram["count"]
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _is_stale(filename):
+    '''
+    Whether a process's file is left by one that died, or that hasn't written it for METRICS_FILE_MAX_AGE, which also
+    catches a dead process whose pid was reused
+    '''
+    try:
+        pid = int(filename.split("-", 1)[0])
+        age = time.time() - os.path.getmtime(os.path.join(settings.METRICS_DIR, filename))
+    except (ValueError, OSError):
+        return False
+    return not _is_running(pid) or age > settings.METRICS_FILE_MAX_AGE.total_seconds()
+
+
+def _archive(filenames):
+    '''
+    Adds the files to the archive and deletes them; call with the lock held. The archive lists the files it took, so a
+    file it took but that wasn't deleted isn't counted twice.
+    '''
+    counters, histograms = {}, {}
+    archive = _read(ARCHIVE_FILENAME)
+    if archive is not None:
+        _add(counters, histograms, archive)
+    taken = [filename for filename in (archive or {}).get("taken", [])
+             if os.path.exists(os.path.join(settings.METRICS_DIR, filename))]
+
+    for filename in filenames:
+        data = _read(filename)
+        if data is not None and filename not in taken:
+            _add(counters, histograms, data)
+            taken.append(filename)
+    _write(ARCHIVE_FILENAME, counters, histograms, taken=taken)
+
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(settings.METRICS_DIR, filename))
+        except OSError:
+            pass
+
+
+def read_all():
+    '''
+    Archives the files of processes that are gone first
+    :return: (counters, histograms) added up over the archive and the files of every process, each keyed like Registry's
+    '''
+    with _locked():
+        filenames = [filename for filename in os.listdir(settings.METRICS_DIR)
+                     if filename.endswith(".json") and filename != ARCHIVE_FILENAME]
+        stale = [filename for filename in filenames if _is_stale(filename)]
+        if stale:
+            _archive(stale)
+
+        counters = {}
+        histograms = {}
+        archive = _read(ARCHIVE_FILENAME)
+        taken = set(archive["taken"]) if archive else set()
+        if archive is not None:
+            _add(counters, histograms, archive)
+        for filename in filenames:
+            if filename in stale or filename in taken:
+                continue
+            data = _read(filename)
+            if data is not None:
+                _add(counters, histograms, data)
+    return counters, histograms
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, unicode(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels)
+
+
+def render(counters, histograms):
+    lines = []
+    for name, (metric_type, help_text) in sorted(HELP.items()):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append("%s%s %s" % (name, _format_labels(labels), repr(value)))
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                lines.append("%s_bucket%s %d" % (name, _format_labels(labels, le=repr(float(bound))), count))
+            lines.append("%s_bucket%s %d" % (name, _format_labels(labels, le="+Inf"), histogram["count"]))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), repr(histogram["sum"])))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    '''
+    For the Prometheus scraper, which sends METRICS_KEY as a bearer token. Disabled while METRICS_KEY is empty.
+    '''
+    authorization = request.META.get("HTTP_AUTHORIZATION", "").split()
+    if not settings.METRICS_KEY or len(authorization) != 2 or authorization[0].lower() != "bearer" or \
+            not constant_time_compare(authorization[1], settings.METRICS_KEY):
+        return HttpResponseForbidden()
+
+    registry.flush(force=True)
+    return HttpResponse(render(*read_all()), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+##########################################################################################
+# SQL timing. Django 1.10 has no hook for wrapping queries, so the cursor classes are swapped in
+# install_cursor_wrapper.
+
+query_observers = []
+
+
+class TimingMixin(object):
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(TimingMixin, self).execute(sql, params)
+        finally:
+            _observe_query(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(TimingMixin, self).executemany(sql, param_list)
+        finally:
+            _observe_query(sql, time.time() - start)
+
+
+class TimingCursorWrapper(TimingMixin, CursorWrapper):
+    pass
+
+
+class TimingCursorDebugWrapper(TimingMixin, CursorDebugWrapper):
+    pass
+
+
+def _observe_query(sql, duration):
+    for observer in query_observers:
+        observer(sql, duration)
+
+
+def install_cursor_wrapper():
+    if BaseDatabaseWrapper.make_cursor.__func__ is not _make_cursor:
+        BaseDatabaseWrapper.make_cursor = _make_cursor
+        BaseDatabaseWrapper.make_debug_cursor = _make_debug_cursor
+
+
+def _make_cursor(self, cursor):
+    return TimingCursorWrapper(cursor, self)
+
+
+def _make_debug_cursor(self, cursor):
+    return TimingCursorDebugWrapper(cursor, self)
+
+
+##########################################################################################
+# SQL done by the request the current thread is handling
+
+_current_request = threading.local()
+
+
+def start_request(request):
+    _current_request.path = request.path
+    _current_request.count = 0
+    _current_request.duration = 0
+
+
+def end_request():
+    '''
+    :return: (number of queries, seconds spent in them) since start_request
+    '''
+    count, duration = getattr(_current_request, "count", 0), getattr(_current_request, "duration", 0)
+    _current_request.path = _current_request.count = _current_request.duration = None
+    return count, duration
+
+
+def current_request_path():
+    return getattr(_current_request, "path", None)
+
+
+def _count_request_query(sql, duration):
+    if getattr(_current_request, "count", None) is not None:
+        _current_request.count += 1
+        _current_request.duration += duration
+
+query_observers.append(_count_request_query)
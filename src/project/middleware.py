@@ -1,8 +1,104 @@
 
 
-import logging
+import logging, re, time
+
+from functools import wraps
+
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils import lru_cache
+from django.utils.module_loading import import_module
+
+from . import metrics, slow_queries
 
 class ExceptionLoggingMiddleware(object):
 
     def process_exception(self, request, exception):
         logging.exception('Exception handling request for ' + request.path)
+
+
+API_URLCONF = 'app.urls'
+
+
+@lru_cache.lru_cache(maxsize=None)
+def get_api_regex():
+    api_urlpatterns = import_module(API_URLCONF).api_urlpatterns
+    return re.compile("|".join("(?:%s)" % pattern.regex.pattern for pattern in api_urlpatterns))
+
+
+def is_api_request(request):
+    '''
+    Requests for the app's API (api_urlpatterns in app/urls.py, which is included at the root). They authenticate with
+    a token and the app key, so they never need a session, CSRF protection or messages.
+    '''
+    if not hasattr(request, "is_api_request"):
+        request.is_api_request = get_api_regex().match(request.path_info[1:]) is not None
+    return request.is_api_request
+
+
+def _skip_api_requests(method, default_result):
+
+    @wraps(method)
+    def wrap(self, request, *args):
+        if is_api_request(request):
+            return default_result(*args)
+        return method(self, request, *args)
+
+    return wrap
+
+
+def web_only(middleware_class):
+    '''
+    :return: a subclass of middleware_class that leaves API requests alone, so they skip the session and cookie work
+    the admin needs
+    '''
+    methods = dict(full_middleware=middleware_class)
+    if hasattr(middleware_class, "process_request"):
+        methods["process_request"] = _skip_api_requests(middleware_class.process_request, lambda: None)
+    if hasattr(middleware_class, "process_view"):
+        methods["process_view"] = _skip_api_requests(middleware_class.process_view, lambda *args: None)
+    if hasattr(middleware_class, "process_response"):
+        methods["process_response"] = _skip_api_requests(middleware_class.process_response, lambda response: response)
+    return type("WebOnly" + middleware_class.__name__, (middleware_class,), methods)
+
+
+WebOnlySessionMiddleware = web_only(SessionMiddleware)
+WebOnlyCsrfViewMiddleware = web_only(CsrfViewMiddleware)
+WebOnlyAuthenticationMiddleware = web_only(AuthenticationMiddleware)
+WebOnlyMessageMiddleware = web_only(MessageMiddleware)
+
+
+class MetricsMiddleware(object):
+    '''
+    Records the latency, status, response size and SQL of every request in project.metrics, labelled with the name of
+    the url it matched, and samples slow queries if SLOW_QUERY_THRESHOLD is set. Goes first in MIDDLEWARE_CLASSES so
+    that the time includes the other middleware.
+    '''
+
+    def __init__(self):
+        metrics.install_cursor_wrapper()
+        slow_queries.install()
+
+    def process_request(self, request):
+        request.metrics_start = time.time()
+        metrics.start_request(request)
+
+    def process_response(self, request, response):
+        if not hasattr(request, "metrics_start"):
+            return response
+
+        duration = time.time() - request.metrics_start
+        queries, query_duration = metrics.end_request()
+        resolver_match = getattr(request, "resolver_match", None)
+        view = resolver_match.url_name if resolver_match and resolver_match.url_name else "unnamed"
+
+        metrics.registry.inc("django_requests_total", dict(view=view, method=request.method, status=response.status_code))
+        metrics.registry.observe("django_request_duration_seconds", dict(view=view), duration, metrics.LATENCY_BUCKETS)
+        metrics.registry.observe("django_request_queries", dict(view=view), queries, metrics.QUERY_COUNT_BUCKETS)
+        metrics.registry.inc("django_db_query_seconds_total", dict(view=view), query_duration)
+        if not response.streaming:
+            metrics.registry.observe("django_response_size_bytes", dict(view=view), len(response.content), metrics.SIZE_BUCKETS)
+        metrics.registry.flush()
+        return response
@@ -0,0 +1,88 @@
+'''
+Credentials a worker process has already verified, kept in the process so the hot paths that check them don't go to
+the database or the shared cache on every request.
+
+Entries expire after the cache's timeout and the least recently used go once there are more than its size. Since each
+process has its own copy, invalidate() stores a new version number in the shared cache, and every process empties its
+copy when it sees the change, which it checks for at most every AUTH_CACHE_VERSION_INTERVAL.
+'''
+
+import threading, time, uuid
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ProcessCache(object):
+    '''
+    Subclasses set version_key, the shared cache key of their version number, and get_timeout and get_size from settings
+    '''
+    version_key = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+        self.version_checked_at = 0
+
+    def get_timeout(self):
+        '''
+        :return: timedelta
+        '''
+        raise NotImplementedError
+
+    def get_size(self):
+        raise NotImplementedError
+
+    def check_version(self):
+        now = time.time()
+        # the clock may have been set back
+        if 0 <= now - self.version_checked_at < settings.AUTH_CACHE_VERSION_INTERVAL.total_seconds():
+            return
+        version = cache.get(self.version_key)
+        with self.lock:
+            self.version_checked_at = now
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key):
+        '''
+        :return: the cached value, or None if the key isn't cached
+        '''
+        self.check_version()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            value, cached_at = entry
+            if time.time() - cached_at > self.get_timeout().total_seconds():
+                return None
+
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.get_size():
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def invalidate(self):
+        '''
+        Empties this cache in every process
+        '''
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+        self.clear()
@@ -48,15 +48,17 @@ INSTALLED_APPS = (
     'acra',
 )
 
+# the WebOnly middleware skips requests to the app's API, which authenticate with tokens (see project/middleware.py)
 MIDDLEWARE_CLASSES = (
+    'project.middleware.MetricsMiddleware',
     'project.middleware.ExceptionLoggingMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'project.middleware.WebOnlySessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'project.middleware.WebOnlyCsrfViewMiddleware',
+    'project.middleware.WebOnlyAuthenticationMiddleware',
+    'project.middleware.WebOnlyMessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.profiling.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'project.urls'
@@ -121,6 +123,14 @@ DATABASES = {
     }
 }
 
+# Cache for API responses (see refresh_instructions). It has to be shared between the web server's processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -229,9 +239,65 @@ APP_KEY = passwords.APP_KEY
 
 EXPIRING_TOKEN_LIFESPAN = datetime.timedelta(hours=24)
 
+# each worker process writes its request metrics here for /metrics to add up (see project/metrics.py)
+METRICS_DIR = os.path.join(BASE_DIR, "../metrics")
+METRICS_FLUSH_INTERVAL = datetime.timedelta(seconds=10)
+# files of workers that exited, or that weren't written for this long, are folded into one archive file
+METRICS_FILE_MAX_AGE = datetime.timedelta(days=1)
+# queries slower than this are sampled, with where they came from, for /admin/slow_queries/. None turns it off
+SLOW_QUERY_THRESHOLD = None
+SLOW_QUERY_BUFFER_SIZE = 500
+# requests with a signed X-Profile header (manage.py profile_header) or from a ProfiledUser are run under cProfile,
+# and the stats kept here. The oldest are deleted past either limit
+PROFILE_DIR = os.path.join(BASE_DIR, "../profiles")
+PROFILE_HEADER_MAX_AGE = datetime.timedelta(hours=1)
+PROFILE_MAX_COUNT = 200
+PROFILE_MAX_BYTES = 200 * 1024 * 1024
+# bearer token the Prometheus scraper sends to /metrics. /metrics is disabled while this is empty
+METRICS_KEY = passwords.METRICS_KEY
+
+# verified tokens and ACRA basic auth credentials are cached in each process for this long, and this many are kept.
+# Deleting a token, deactivating a user or changing a password empties every process's cache, which each notices
+# within AUTH_CACHE_VERSION_INTERVAL (see project/process_cache.py)
+AUTH_TOKEN_CACHE_TIMEOUT = datetime.timedelta(minutes=5)
+AUTH_TOKEN_CACHE_SIZE = 10000
+ACRA_AUTH_CACHE_TIMEOUT = datetime.timedelta(minutes=5)
+ACRA_AUTH_CACHE_SIZE = 1000
+AUTH_CACHE_VERSION_INTERVAL = datetime.timedelta(seconds=1)
+# crash reports with the same stack trace and app version are counted in one CrashGroup, which stores this many of them
+ACRA_SAMPLES_PER_GROUP = 10
+# with a directory here, crash reports are appended to a file in it and inserted in batches by
+# manage.py flush_crash_reports --loop, every ACRA_FLUSH_INTERVAL seconds or once ACRA_FLUSH_BYTES are waiting. Only set
+# it where that runs (see the README), or the reports are never inserted. None inserts each one in the request
+ACRA_BUFFER_DIR = None
+ACRA_FLUSH_INTERVAL = 5
+ACRA_FLUSH_BYTES = 1024 * 1024
+ACRA_FLUSH_BATCH_SIZE = 500
+
+# how long we keep the response to a request with an idempotency key, in case the app retries it
+IDEMPOTENT_RESPONSE_LIFESPAN = datetime.timedelta(days=2)
+
+# filtered admin changelists of big tables count at most this many rows, see app.admin.ApproximateCountPaginator
+ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# manage.py refresh_experiment_stats recomputes the cohort dashboard's figures for active experiments this often even
+# if their data didn't change, since their missed days keep adding up
+EXPERIMENT_STATS_MAX_AGE = datetime.timedelta(hours=6)
+
+# ExportJobs, run by manage.py run_export_jobs from cron. At most this many are built at once, one that has been
+# running longer than the timeout is taken for dead, and archives are deleted after the lifespan
+EXPORT_JOB_CONCURRENCY = 2
+EXPORT_JOB_TIMEOUT = datetime.timedelta(hours=6)
+EXPORT_JOB_LIFESPAN = datetime.timedelta(days=7)
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_expiring_authtoken.authentication.ExpiringTokenAuthentication',
-    )
+        'app.authentication.CachedExpiringTokenAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'app.renderers.MsgpackRenderer',
+    ),
 }
 
@@ -0,0 +1,97 @@
+'''
+Opt-in sampling of slow SQL. With SLOW_QUERY_THRESHOLD set, every query that takes longer is kept with where in our
+code it came from and the request it was part of.
+
+Samples go in a ring buffer of SLOW_QUERY_BUFFER_SIZE slots in the cache, so every worker process writes to the same
+buffer and the admin page and the dump_slow_queries command can read it. A counter in the cache picks the next slot,
+and the oldest sample is overwritten once the buffer is full.
+'''
+
+import os, threading, traceback
+
+from django.conf import settings
+from django.core.cache import cache
+from django.shortcuts import render
+from django.utils import timezone
+
+from . import metrics
+
+CACHE_KEY = "slow_queries:%d"
+COUNTER_CACHE_KEY = "slow_queries:next"
+MAX_SQL_LENGTH = 4000
+MAX_STACK_DEPTH = 5
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_recording = threading.local()
+
+
+def get_app_stack():
+    '''
+    :return: the frames of the current stack in our own code, innermost first, as "file:line in function" strings.
+    Frames in project/ are left out, since that's the middleware and this instrumentation.
+    '''
+    frames = []
+    for filename, lineno, function, _ in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(filename)
+        if not filename.startswith(SOURCE_DIR + os.sep) or filename.startswith(PROJECT_DIR + os.sep):
+            continue
+        frames.append("%s:%d in %s" % (os.path.relpath(filename, SOURCE_DIR), lineno, function))
+        if len(frames) == MAX_STACK_DEPTH:
+            break
+    return frames
+
+
+def record_slow_query(sql, duration):
+    threshold = settings.SLOW_QUERY_THRESHOLD
+    if threshold is None or duration < threshold.total_seconds():
+        return
+    # the cache may itself be in the database
+    if getattr(_recording, "active", False):
+        return
+
+    _recording.active = True
+    try:
+        stack = get_app_stack()
+        sample = dict(sql=sql[:MAX_SQL_LENGTH], duration=duration, frame=stack[0] if stack else None, stack=stack,
+                      path=metrics.current_request_path(), time=timezone.now().isoformat())
+        cache.set(CACHE_KEY % _next_slot(), sample, None)
+    finally:
+        _recording.active = False
+
+
+def _next_slot():
+    cache.add(COUNTER_CACHE_KEY, 0, None)
+    try:
+        count = cache.incr(COUNTER_CACHE_KEY)
+    except ValueError:
+        # evicted since the add
+        cache.set(COUNTER_CACHE_KEY, 1, None)
+        count = 1
+    return count % settings.SLOW_QUERY_BUFFER_SIZE
+
+
+def get_slow_queries():
+    '''
+    :return: the samples in the buffer, newest first
+    '''
+    samples = cache.get_many([CACHE_KEY % slot for slot in xrange(settings.SLOW_QUERY_BUFFER_SIZE)]).values()
+    return sorted(samples, key=lambda sample: sample["time"], reverse=True)
+
+
+def clear_slow_queries():
+    cache.delete_many([CACHE_KEY % slot for slot in xrange(settings.SLOW_QUERY_BUFFER_SIZE)] + [COUNTER_CACHE_KEY])
+
+
+def slow_queries_view(request):
+    return render(request, "admin/slow_queries.html", dict(
+        title="Slow queries",
+        threshold=settings.SLOW_QUERY_THRESHOLD,
+        slow_queries=get_slow_queries(),
+    ))
+
+
+def install():
+    if record_slow_query not in metrics.query_observers:
+        metrics.query_observers.append(record_slow_query)
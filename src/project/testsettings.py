@@ -17,6 +17,11 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
 PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
@@ -27,3 +32,11 @@ import warnings
 warnings.filterwarnings(
     'error', r"DateTimeField .* received a naive datetime",
     RuntimeWarning, r'django\.db\.models\.fields')
+
+import tempfile
+METRICS_DIR = tempfile.mkdtemp()
+PROFILE_DIR = tempfile.mkdtemp()
+MEDIA_ROOT = tempfile.mkdtemp()
+
+# the pipeline storage needs collectstatic before the admin can render
+STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
@@ -4,10 +4,17 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.staticfiles.views import serve
 
+from .metrics import metrics_view
+from .slow_queries import slow_queries_view
+from app.dashboard import cohort_dashboard_view
+
 urlpatterns = [
     url(r'^grappelli/', include('grappelli.urls')),
     url(r'^acra/', include('acra.urls')),
+    url(r'^admin/slow_queries/$', admin.site.admin_view(slow_queries_view), name='slow_queries'),
+    url(r'^admin/cohorts/$', admin.site.admin_view(cohort_dashboard_view), name='cohort_dashboard'),
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^metrics$', metrics_view, name='metrics'),
 
     url(r'', include('app.urls')),
 